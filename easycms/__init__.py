@@ -8,18 +8,20 @@ import re
 import functools
 
 import sqlalchemy.sql
+from sqlalchemy.orm import defer, joinedload, contains_eager, selectinload, aliased
 from littlefish.pager import SimplePager
 import flaskfilemanager
 from littlefish import util
 import sqlalchemy.exc
-from flask import g
 
-from . import models, accesscontrol
+from . import models, accesscontrol, dbhealth, querystats, commenttree, pagecache, invalidation, querycache, \
+    search
 from .editor import editor as blueprint  # noqa
-from .settings import init as init_settings
+from .settings import init as init_settings, get_settings
 from . import datautil
 from . import migration
 from .datautil import create_user  # noqa
+from .keysetpager import KeysetPager
 
 log = logging.getLogger(__name__)
 
@@ -35,12 +37,14 @@ post_types = None
 # too
 
 MAJOR_VERSION = 0
-MINOR_VERSION = 3
+MINOR_VERSION = 14
 VERSION = '{}.{}.X'.format(MAJOR_VERSION, MINOR_VERSION)
 
 
 def init(app, engine_or_connection, metadata=None, all_post_types=['post'], table_prefix='cms',
-         access_control_config=None, settings=None, page_defs=[], update_db=False):
+         access_control_config=None, settings=None, page_defs=[], update_db=False,
+         use_scoped_session=False, db_ping_interval=dbhealth.DEFAULT_PING_INTERVAL,
+         instrument_queries=False, query_stats_header=querystats.DEFAULT_HEADER_NAME):
 
     global bind, post_types
 
@@ -53,8 +57,16 @@ def init(app, engine_or_connection, metadata=None, all_post_types=['post'], tabl
     
     if bind.dialect.name != 'postgresql':
         raise Exception('Only postgresql is supported by EasyCMS')
+
+    # Pass in db_ping_interval=None to disable connection health checking (i.e. if you are already
+    # using pool_pre_ping on your engine)
+    if db_ping_interval is not None:
+        dbhealth.init(bind, ping_interval=db_ping_interval)
     
-    models.init(table_prefix, metadata, bind)
+    models.init(table_prefix, metadata, bind, scoped=use_scoped_session)
+
+    # Some of the migrations use the settings
+    init_settings(settings, page_defs)
 
     try:
         current_version = migration.check_current_version(update_db=update_db)
@@ -79,7 +91,9 @@ def init(app, engine_or_connection, metadata=None, all_post_types=['post'], tabl
     post_types = all_post_types
     accesscontrol.init(access_control_config)
 
-    init_settings(settings, page_defs)
+    pagecache.init(get_settings())
+    querycache.init(get_settings())
+    invalidation.init(bind)
 
     if settings.init_filemanager:
         ac = accesscontrol.get_access_control()
@@ -94,6 +108,9 @@ def init(app, engine_or_connection, metadata=None, all_post_types=['post'], tabl
         # Make sure this directory exists
         snippet_path = settings.snippet_image_file_path
         util.ensure_dir(snippet_path)
+
+    if settings.post_main_image_enabled and settings.main_image_widths:
+        util.ensure_dir(settings.main_image_variant_file_path)
     
     # Create al tables
     models.create_all()
@@ -101,42 +118,80 @@ def init(app, engine_or_connection, metadata=None, all_post_types=['post'], tabl
     # Ensure all pages are up to date
     datautil.update_all_pages()
 
+    if use_scoped_session:
+        # Each thread gets its own session, which is thrown away at the end of every request so
+        # that no state leaks between requests
+        log.info('Using scoped sessions')
+
+        @app.teardown_appcontext
+        def remove_easycms_session(exception=None):
+            models.remove_session()
+
+        # Discard the session that was used during initialisation
+        models.remove_session()
+
+    if instrument_queries:
+        querystats.init(app, bind, header_name=query_stats_header)
+
     log.info('EasyCMS v{} Initialisation Complete'.format(VERSION))
 
 
-def db_pre_ping(f):
+def db_retry(f):
     """
-    This decorator detects disconnects and resets the connection when they happen
+    This decorator detects queries that fail because the database has disconnected and retries them
+    once on a new connection.  Dead connections sitting in the pool are detected when they are
+    checked out (see dbhealth.py) so there is no need to ping the database before every request
     """
     @functools.wraps(f)
     def decorated_function(*args, **kwargs):
-        do_db_ping = False
-
         try:
-            if not hasattr(g, 'easy_cms_pre_pinged_database'):
-                g.easy_cms_pre_pinged_database = True
-                do_db_ping = True
+            return f(*args, **kwargs)
+        except sqlalchemy.exc.DBAPIError as e:
+            if not dbhealth.is_disconnect(e):
+                raise
 
-        except RuntimeError:
-            # Outside app context - just do nothing
-            pass
+            session = kwargs.get('session')
+            if session is None:
+                session = models.session
 
-        if do_db_ping:
-            # Ping the database and make sure it is still alive
-            try:
-                result = models.db.session.execute('SELECT 1').fetchall()
-            except sqlalchemy.exc.OperationalError:
-                log.warn('Database has disconnected. Attempting recovery')
-                models.db.session.rollback()
+            if session.new or session.dirty or session.deleted:
+                # Rolling back would throw away unsaved changes, so we can't retry
+                raise
 
-        result = f(*args, **kwargs)
+            log.warning('Database has disconnected. Retrying query')
+            session.rollback()
 
-        return result
+            return f(*args, **kwargs)
 
     return decorated_function
 
 
-@db_pre_ping
+# Old name for db_retry
+db_pre_ping = db_retry
+
+
+def defer_post_content(query):
+    """
+    Stop the large text columns of the posts in the query (i.e. the content) from being loaded until
+    they are accessed.  Use this for listing pages, which usually only need the title, tagline,
+    description, snippet and dates
+    """
+    return query.options(
+        defer(models.CmsPost.content),
+        defer(models.CmsPost.content_images)
+    )
+
+
+def _load_post_relationships(query):
+    # These are cached along with the posts
+    return query.options(
+        joinedload(models.CmsPost.category),
+        joinedload(models.CmsPost.author),
+        selectinload(models.CmsPost.tags)
+    )
+
+
+@db_retry
 def get_all_users_query(session=None):
     if session is None:
         session = models.session
@@ -150,12 +205,15 @@ def get_all_users_query(session=None):
     return query
 
 
-@db_pre_ping
-def get_all_posts_query(post_type=None, allow_unpublished=False, session=None):
+@db_retry
+def get_all_posts_query(post_type=None, allow_unpublished=False, session=None, defer_content=False):
     if session is None:
         session = models.session
 
     query = session.query(models.CmsPost)
+
+    if defer_content:
+        query = defer_post_content(query)
     
     if post_type is not None:
         query = query.filter(models.CmsPost.post_type == post_type)
@@ -170,14 +228,48 @@ def get_all_posts_query(post_type=None, allow_unpublished=False, session=None):
     return query
 
 
-def get_all_posts_pager(page, num_per_page=10, post_type=None, allow_unpublished=False, session=None):
-    query = get_all_posts_query(post_type=post_type, allow_unpublished=allow_unpublished, session=session)
+def get_all_posts_pager(page, num_per_page=10, post_type=None, allow_unpublished=False, session=None,
+                        defer_content=False):
+    query = get_all_posts_query(post_type=post_type, allow_unpublished=allow_unpublished, session=session,
+                                defer_content=defer_content)
     
     return SimplePager(num_per_page, page, query)
 
 
-@db_pre_ping
-def get_posts_by_category_query(post_type, category_code, allow_unpublished=False, session=None):
+def get_post_keyset_pager(query, cursor, num_per_page=10, allow_unpublished=False):
+    """
+    Wrap a post query in a KeysetPager, sorted by published date (or created date for unpublished
+    posts if allow_unpublished is True) and then id
+    """
+    if allow_unpublished:
+        sort_column = sqlalchemy.sql.func.coalesce(models.CmsPost.published, models.CmsPost.created)
+
+        def get_key(post):
+            return post.published or post.created, post.id
+    else:
+        sort_column = models.CmsPost.published
+
+        def get_key(post):
+            return post.published, post.id
+
+    return KeysetPager(num_per_page, cursor, query, sort_column, models.CmsPost.id, get_key)
+
+
+def get_all_posts_keyset_pager(cursor=None, num_per_page=10, post_type=None, allow_unpublished=False,
+                               session=None, defer_content=False):
+    """
+    Like get_all_posts_pager, but uses keyset pagination so deep pages are as fast as the first page.
+    Pass in pager.next_cursor or pager.prev_cursor from the previous page to move between pages
+    """
+    query = get_all_posts_query(post_type=post_type, allow_unpublished=allow_unpublished, session=session,
+                                defer_content=defer_content)
+
+    return get_post_keyset_pager(query, cursor, num_per_page, allow_unpublished)
+
+
+@db_retry
+def get_posts_by_category_query(post_type, category_code, allow_unpublished=False, session=None,
+                                defer_content=False):
     if session is None:
         session = models.session
 
@@ -190,6 +282,9 @@ def get_posts_by_category_query(post_type, category_code, allow_unpublished=Fals
         models.CmsCategory.code == category_code
     )
 
+    if defer_content:
+        query = defer_post_content(query)
+
     if allow_unpublished:
         query = query.order_by(
             sqlalchemy.sql.func.coalesce(models.CmsPost.published, models.CmsPost.created).desc()
@@ -205,26 +300,44 @@ def get_posts_by_category_query(post_type, category_code, allow_unpublished=Fals
     return query
 
 
-def get_recent_posts(post_type, num_posts, allow_unpublished=False, session=None):
-    query = get_all_posts_query(post_type=post_type, allow_unpublished=allow_unpublished,
-                                session=session)
+def get_recent_posts(post_type, num_posts, allow_unpublished=False, session=None, defer_content=False):
+    """
+    The result is cached (see querycache.py)
+    """
+    def load(load_session):
+        query = get_all_posts_query(post_type=post_type, allow_unpublished=allow_unpublished,
+                                    session=load_session, defer_content=defer_content)
 
-    return query[:num_posts]
+        return _load_post_relationships(query)[:num_posts]
+
+    return querycache.get(querycache.POSTS, ['recent-posts', post_type, num_posts, allow_unpublished, defer_content],
+                          load, session=session)
 
 
 def get_posts_by_category_pager(post_type, category_code, page, num_per_page=10,
-                                allow_unpublished=False, session=None):
+                                allow_unpublished=False, session=None, defer_content=False):
 
     query = get_posts_by_category_query(post_type, category_code,
-                                        allow_unpublished=allow_unpublished, session=session)
+                                        allow_unpublished=allow_unpublished, session=session,
+                                        defer_content=defer_content)
 
     return SimplePager(num_per_page, page, query)
 
 
-@db_pre_ping
-def get_posts_by_tag_query(post_type, tag_name, allow_unpublished=False, session=None):
+def get_posts_by_category_keyset_pager(post_type, category_code, cursor=None, num_per_page=10,
+                                       allow_unpublished=False, session=None, defer_content=False):
+    query = get_posts_by_category_query(post_type, category_code,
+                                        allow_unpublished=allow_unpublished, session=session,
+                                        defer_content=defer_content)
+
+    return get_post_keyset_pager(query, cursor, num_per_page, allow_unpublished)
+
+
+@db_retry
+def get_posts_by_tag_query(post_type, tag_name, allow_unpublished=False, session=None,
+                           defer_content=False):
     query = get_all_posts_query(post_type=post_type, allow_unpublished=allow_unpublished,
-                                session=session)
+                                session=session, defer_content=defer_content)
     
     # Join and filter by tag
     query = query.join(
@@ -237,31 +350,208 @@ def get_posts_by_tag_query(post_type, tag_name, allow_unpublished=False, session
 
 
 def get_posts_by_tag_pager(post_type, tag, page, num_per_page=10,
-                           allow_unpublished=False, session=None):
+                           allow_unpublished=False, session=None, defer_content=False):
     query = get_posts_by_tag_query(post_type, tag, allow_unpublished=allow_unpublished,
-                                   session=session)
+                                   session=session, defer_content=defer_content)
 
     return SimplePager(num_per_page, page, query)
 
 
-@db_pre_ping
+def get_posts_by_tag_keyset_pager(post_type, tag, cursor=None, num_per_page=10,
+                                  allow_unpublished=False, session=None, defer_content=False):
+    query = get_posts_by_tag_query(post_type, tag, allow_unpublished=allow_unpublished,
+                                   session=session, defer_content=defer_content)
+
+    return get_post_keyset_pager(query, cursor, num_per_page, allow_unpublished)
+
+
+@db_retry
+def search_posts_query(search_terms, post_type=None, allow_unpublished=False, session=None, defer_content=True):
+    """
+    Full text search of the title, tagline and content of the posts (see search.py)
+
+    :param search_terms: The search, i.e. 'python -snake' or '"keyset pagination"'
+    :return: Query of the matching CmsPosts, best match first
+    """
+    query = get_all_posts_query(post_type=post_type, allow_unpublished=allow_unpublished, session=session,
+                                defer_content=defer_content)
+
+    if not search_terms or not search_terms.strip():
+        return query.filter(sqlalchemy.sql.false())
+
+    ts_query = search.get_ts_query(search_terms)
+
+    return query.filter(
+        models.CmsPost.search_vector.op('@@')(ts_query)
+    ).order_by(None).order_by(
+        search.get_rank(ts_query).desc(),
+        models.CmsPost.id.desc()
+    )
+
+
+def search_posts_keyset_pager(search_terms, cursor=None, num_per_page=10, post_type=None, allow_unpublished=False,
+                              session=None, defer_content=True, highlight=True):
+    """
+    Search the posts, one page at a time.  The items of the pager are search.SearchResult objects
+
+    :param highlight: Set to False if the headlines (the matching parts of the content, with the search
+                      terms highlighted) aren't needed
+    """
+    query = search_posts_query(search_terms, post_type=post_type, allow_unpublished=allow_unpublished,
+                               session=session, defer_content=defer_content)
+
+    rank = search.get_rank(search.get_ts_query(search_terms or ''))
+
+    def get_key(result):
+        return result.rank, result.post.id
+
+    pager = KeysetPager(num_per_page, cursor, query.add_columns(rank.label('rank')), rank, models.CmsPost.id,
+                        get_key)
+
+    headlines = {}
+    if highlight and pager.items:
+        headlines = search.get_headlines(search_terms, [post.id for post, _ in pager.items], session=session)
+
+    pager.items = [search.SearchResult(post, rank, headlines.get(post.id)) for post, rank in pager.items]
+
+    return pager
+
+
+@db_retry
 def get_post_by_code(post_type, code, allow_unpublished=False, session=None):
+    """
+    The post is cached (see querycache.py)
+    """
+    def load(load_session):
+        query = load_session.query(
+            models.CmsPost
+        ).filter(
+            models.CmsPost.post_type == post_type, models.CmsPost.code == code
+        )
+
+        if not allow_unpublished:
+            query = query.filter(models.CmsPost.published < datetime.datetime.utcnow())
+
+        return _load_post_relationships(query).one_or_none()
+
+    return querycache.get(querycache.POSTS, ['post', post_type, code, allow_unpublished], load, session=session)
+
+
+@db_retry
+def get_related_posts(post, num_posts=4, allow_unpublished=False, session=None, defer_content=True):
+    """
+    Get the posts that are most related to a post, by shared tags and category (see relatedposts.py).
+    The result is cached (see querycache.py)
+
+    :return: List of CmsPosts, most related first
+    """
+    post_id = post.id
+
+    def load(load_session):
+        query = load_session.query(
+            models.CmsPost
+        ).join(
+            models.CmsRelatedPost, models.CmsRelatedPost.related_post_id == models.CmsPost.id
+        ).filter(
+            models.CmsRelatedPost.post_id == post_id
+        ).order_by(
+            models.CmsRelatedPost.score.desc(), models.CmsRelatedPost.related_post_id.desc()
+        )
+
+        if not allow_unpublished:
+            query = query.filter(models.CmsPost.published < datetime.datetime.utcnow())
+
+        if defer_content:
+            query = defer_post_content(query)
+
+        return _load_post_relationships(query)[:num_posts]
+
+    return querycache.get(querycache.POSTS, ['related-posts', post_id, num_posts, allow_unpublished, defer_content],
+                          load, session=session)
+
+
+@db_retry
+def get_prev_and_next_posts(posts, include_non_published=False, session=None):
+    """
+    Find the previous and next post (as returned by CmsPost.get_prev_post and get_next_post) for every
+    post in a listing, using one query for each post type.  The lag() and lead() window functions are
+    only evaluated over the range of dates covered by the listing, plus the post either side of it
+
+    :param posts: List of CmsPosts
+    :param include_non_published: If True, unpublished posts are included, sorted by their created date
+    :return: Dict mapping each post id to a tuple of (previous post, next post).  Either may be None.
+             The content of the previous and next posts is deferred
+    """
     if session is None:
         session = models.session
-    
-    query = session.query(
-        models.CmsPost
-    ).filter(
-        models.CmsPost.post_type == post_type, models.CmsPost.code == code
-    )
 
-    if not allow_unpublished:
-        query = query.filter(models.CmsPost.published < datetime.datetime.utcnow())
+    CmsPost = models.CmsPost
 
-    return query.one_or_none()
+    if include_non_published:
+        sort_column = sqlalchemy.sql.func.coalesce(CmsPost.published, CmsPost.created)
 
+        def get_date(post):
+            return post.published or post.created
+    else:
+        sort_column = CmsPost.published
+
+        def get_date(post):
+            return post.published
+
+    neighbours = {post.id: (None, None) for post in posts}
+
+    posts_by_type = {}
+    for post in posts:
+        if get_date(post) is not None:
+            posts_by_type.setdefault(post.post_type, []).append(post)
+
+    for post_type, type_posts in posts_by_type.items():
+        first_date = min(get_date(post) for post in type_posts)
+        last_date = max(get_date(post) for post in type_posts)
+
+        date_query = session.query(sort_column).filter(CmsPost.post_type == post_type)
+        start_date = sqlalchemy.sql.func.coalesce(
+            date_query.filter(sort_column < first_date).order_by(sort_column.desc()).limit(1).as_scalar(),
+            first_date
+        )
+        end_date = sqlalchemy.sql.func.coalesce(
+            date_query.filter(sort_column > last_date).order_by(sort_column).limit(1).as_scalar(),
+            last_date
+        )
+
+        order_by = (sort_column, CmsPost.id)
+        window = session.query(
+            CmsPost.id,
+            sqlalchemy.sql.func.lag(CmsPost.id).over(order_by=order_by).label('prev_id'),
+            sqlalchemy.sql.func.lead(CmsPost.id).over(order_by=order_by).label('next_id')
+        ).filter(
+            CmsPost.post_type == post_type,
+            sort_column.between(start_date, end_date)
+        ).subquery()
+
+        PrevPost = aliased(CmsPost)
+        NextPost = aliased(CmsPost)
+
+        query = session.query(
+            window.c.id, PrevPost, NextPost
+        ).outerjoin(
+            PrevPost, PrevPost.id == window.c.prev_id
+        ).outerjoin(
+            NextPost, NextPost.id == window.c.next_id
+        ).filter(
+            window.c.id.in_([post.id for post in type_posts])
+        ).options(
+            defer(PrevPost.content), defer(PrevPost.content_images),
+            defer(NextPost.content), defer(NextPost.content_images)
+        )
+
+        for post_id, prev_post, next_post in query:
+            neighbours[post_id] = (prev_post, next_post)
+
+    return neighbours
 
-@db_pre_ping
+
+@db_retry
 def get_all_pages_query(allow_disabled=False, session=None):
     if session is None:
         session = models.session
@@ -280,18 +570,26 @@ def get_all_pages_query(allow_disabled=False, session=None):
     return query
 
 
-@db_pre_ping
+@db_retry
 def get_page_by_code(code, allow_disabled=True, session=None):
-    query = get_all_pages_query(
-        allow_disabled=allow_disabled, session=session
-    ).filter(
-        models.CmsPage.code == code
-    )
+    """
+    The page is cached (see pagecache.py)
+    """
+    def load(load_session):
+        query = get_all_pages_query(
+            allow_disabled=allow_disabled, session=load_session
+        ).options(
+            joinedload(models.CmsPage.author)
+        ).filter(
+            models.CmsPage.code == code
+        )
 
-    return query.one_or_none()
+        return query.one_or_none()
 
+    return pagecache.get_page(pagecache.PAGE, code, allow_disabled, load, session=session)
 
-@db_pre_ping
+
+@db_retry
 def get_all_published_pages_query(allow_disabled=False, session=None):
     if session is None:
         session = models.session
@@ -313,63 +611,91 @@ def get_all_published_pages_query(allow_disabled=False, session=None):
 
 
 def get_published_page_by_code(code, allow_disabled=True, session=None):
-    query = get_all_published_pages_query(
-        allow_disabled=allow_disabled, session=session
-    ).filter(
-        models.CmsPage.code == code
-    )
+    """
+    The published page is cached (see pagecache.py)
+    """
+    def load(load_session):
+        query = get_all_published_pages_query(
+            allow_disabled=allow_disabled, session=load_session
+        ).options(
+            contains_eager(models.CmsPublishedPage.page).joinedload(models.CmsPage.author),
+            joinedload(models.CmsPublishedPage.published_by)
+        ).filter(
+            models.CmsPage.code == code
+        )
 
-    return query.one_or_none()
+        return query.one_or_none()
 
+    return pagecache.get_page(pagecache.PUBLISHED_PAGE, code, allow_disabled, load, session=session)
 
-@db_pre_ping
+
+def invalidate_page_cache(code=None):
+    """
+    Remove a page from the page cache.  This is done automatically when pages are edited or published
+    in the editor
+
+    :param code: The page code, or None to clear the whole cache
+    """
+    pagecache.invalidate(code)
+
+
+@db_retry
 def get_category_by_code(post_type, code, session=None):
-    if session is None:
-        session = models.session
+    """
+    The category is cached (see querycache.py)
+    """
+    def load(load_session):
+        query = load_session.query(
+            models.CmsCategory
+        ).filter(
+            models.CmsCategory.post_type == post_type,
+            models.CmsCategory.code == code
+        )
 
-    query = session.query(
-        models.CmsCategory
-    ).filter(
-        models.CmsCategory.post_type == post_type,
-        models.CmsCategory.code == code
-    )
+        return query.one_or_none()
 
-    return query.one_or_none()
+    return querycache.get(querycache.CATEGORIES, ['category', post_type, code], load, session=session)
 
 
-@db_pre_ping
+@db_retry
 def get_all_categories(post_type, session=None):
-    if session is None:
-        session = models.session
+    """
+    The categories are cached (see querycache.py)
+    """
+    def load(load_session):
+        query = load_session.query(
+            models.CmsCategory
+        ).filter(
+            models.CmsCategory.post_type == post_type
+        ).order_by(
+            models.CmsCategory.name
+        )
 
-    query = session.query(
-        models.CmsCategory
-    ).filter(
-        models.CmsCategory.post_type == post_type
-    ).order_by(
-        models.CmsCategory.name
-    )
+        return query.all()
 
-    return query.all()
+    return querycache.get(querycache.CATEGORIES, ['all-categories', post_type], load, session=session)
 
 
-@db_pre_ping
+@db_retry
 def get_all_tags(post_type, session=None):
-    if session is None:
-        session = models.session
+    """
+    The tags are cached (see querycache.py)
+    """
+    def load(load_session):
+        query = load_session.query(
+            models.CmsTag
+        ).filter(
+            models.CmsTag.post_type == post_type
+        ).order_by(
+            models.CmsTag.name
+        )
 
-    query = session.query(
-        models.CmsTag
-    ).filter(
-        models.CmsTag.post_type == post_type
-    ).order_by(
-        models.CmsTag.name
-    )
+        return query.all()
 
-    return query.all()
+    return querycache.get(querycache.TAGS, ['all-tags', post_type], load, session=session)
 
 
-@db_pre_ping
+@db_retry
 def get_special_tags(post_type=None, tag_type=None, external_code=None, session=None):
     if session is None:
         session = models.session
@@ -390,7 +716,7 @@ def get_special_tags(post_type=None, tag_type=None, external_code=None, session=
     return query.all()
 
 
-@db_pre_ping
+@db_retry
 def get_comment_query(approved_only=True, show_deleted=False, session=None):
     if session is None:
         session = models.session
@@ -410,7 +736,54 @@ def get_comment_query(approved_only=True, show_deleted=False, session=None):
     return query
 
 
-@db_pre_ping
+@db_retry
+def get_comment_tree(post, session=None):
+    """
+    Load all of the comments on a post that the current user can see in a single query, already
+    assembled into a tree
+
+    :return: List of CommentNode objects for the top level comments, oldest first.  Each node has
+             comment, depth and replies attributes
+    """
+    if session is None:
+        session = models.session
+
+    return commenttree.load_comment_tree(post, session)
+
+
+def get_comment_threads_keyset_pager(post, cursor=None, num_per_page=20, session=None):
+    """
+    Page through the top level comments on a post that the current user can see, oldest first, using
+    keyset pagination.  Each item in pager.items is a CommentNode with all of the visible replies to
+    that comment loaded, as returned by get_comment_tree.  Loading a page runs two queries no matter how
+    many comments the post has.  Unlike get_comment_tree, replies to a top level comment that the user
+    can't see are not shown
+    """
+    if session is None:
+        session = models.session
+
+    CmsComment = models.CmsComment
+
+    query = session.query(
+        CmsComment
+    ).filter(
+        CmsComment.post_id == post.id,
+        CmsComment.reply_to_id == None,
+        commenttree.get_visible_filter(CmsComment)
+    )
+
+    def get_key(node):
+        return node.comment.timestamp, node.comment.id
+
+    pager = KeysetPager(num_per_page, cursor, query, CmsComment.timestamp, CmsComment.id, get_key,
+                        ascending=True)
+
+    pager.items = commenttree.load_comment_tree(post, session, root_ids=[c.id for c in pager.items])
+
+    return pager
+
+
+@db_retry
 def get_comment_by_id(comment_id, session=None):
     if session is None:
         session = models.session
@@ -422,7 +795,7 @@ def get_comment_by_id(comment_id, session=None):
     ).one_or_none()
 
 
-@db_pre_ping
+@db_retry
 def get_all_authors_query(session=None):
     if session is None:
         session = models.session
@@ -434,14 +807,28 @@ def get_all_authors_query(session=None):
     )
 
 
+@db_retry
 def get_all_authors(session=None):
-    return get_all_authors_query(session).all()
+    """
+    The authors are cached (see querycache.py)
+    """
+    def load(load_session):
+        return get_all_authors_query(load_session).all()
+
+    return querycache.get(querycache.AUTHORS, ['all-authors'], load, session=session)
 
 
+@db_retry
 def get_author_by_code(author_code, session=None):
-    query = get_all_authors_query(session)
+    """
+    The author is cached (see querycache.py)
+    """
+    def load(load_session):
+        query = get_all_authors_query(load_session)
 
-    return query.filter(
-        models.CmsAuthor.code == author_code
-    ).one_or_none()
+        return query.filter(
+            models.CmsAuthor.code == author_code
+        ).one_or_none()
+
+    return querycache.get(querycache.AUTHORS, ['author', author_code], load, session=session)
 
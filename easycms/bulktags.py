@@ -0,0 +1,267 @@
+"""
+Bulk tag operations: adding and removing tags on many posts, merging duplicate tags and renaming tags.
+Each operation is a few set based statements against the post tag association table, however many
+posts and tags are involved, and the related posts and caches are updated afterwards.
+
+None of these functions commit, so several operations can be made in one transaction.  Posts and tags
+that are already loaded in the session aren't updated until the session is committed (or they are
+expired)
+"""
+
+import logging
+
+from sqlalchemy import BigInteger, literal, exists
+from sqlalchemy.sql import select, and_
+
+from . import models, invalidation, relatedposts
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+
+def _get_post_tag_table():
+    return models.CmsPost.tags.property.secondary
+
+
+def _check_tags_can_be_merged(session, tag_ids):
+    """
+    :raises ValueError: If any of the tags don't exist, they aren't all for the same post type or any of them
+                        are special tags
+    """
+    tags = models.CmsTag.__table__
+
+    rows = session.execute(
+        select([tags.c.id, tags.c.name, tags.c.post_type, tags.c.tag_type]).where(tags.c.id.in_(tag_ids))
+    ).fetchall()
+
+    missing = set(tag_ids) - {row.id for row in rows}
+    if missing:
+        raise ValueError('Tags not found: {}'.format(', '.join(str(tag_id) for tag_id in sorted(missing))))
+
+    if len({row.post_type for row in rows}) > 1:
+        raise ValueError('Tags for different post types can\'t be merged')
+
+    # Special tags are used by the code, so they can't be merged away or have posts merged into them
+    special = sorted(row.name for row in rows if row.tag_type)
+    if special:
+        raise ValueError('Special tags can\'t be merged: {}'.format(', '.join(special)))
+
+
+def add_tags_to_posts(post_ids, tag_ids, session=None):
+    """
+    Add tags to posts, skipping any posts that already have the tag.  Tags are only added to posts of
+    the same post type
+
+    :param post_ids: Ids of the posts
+    :param tag_ids: Ids of the tags to add to all of the posts
+    :return: The number of tags that were added
+    """
+    if session is None:
+        session = models.session
+
+    post_ids = list(post_ids)
+    tag_ids = list(tag_ids)
+    if not post_ids or not tag_ids:
+        return 0
+
+    session.flush()
+
+    post_tag = _get_post_tag_table()
+    existing = post_tag.alias('existing')
+    posts = models.CmsPost.__table__
+    tags = models.CmsTag.__table__
+
+    result = session.execute(post_tag.insert().from_select(
+        ['post_id', 'tag_id'],
+        select([
+            posts.c.id, tags.c.id
+        ]).select_from(
+            posts.join(tags, tags.c.post_type == posts.c.post_type)
+        ).where(and_(
+            posts.c.id.in_(post_ids),
+            tags.c.id.in_(tag_ids),
+            ~exists().where(and_(
+                existing.c.post_id == posts.c.id,
+                existing.c.tag_id == tags.c.id
+            ))
+        ))
+    ))
+
+    log.info('Added {} tags to {} posts'.format(result.rowcount, len(post_ids)))
+
+    invalidation.notify(session, invalidation.TAG)
+    relatedposts.update_related_posts(post_ids, session=session)
+
+    return result.rowcount
+
+
+def remove_tags_from_posts(post_ids, tag_ids, session=None):
+    """
+    Remove tags from posts.  The tags themselves are not deleted, even if they are no longer used (see
+    delete_unused_tags)
+
+    :param post_ids: Ids of the posts
+    :param tag_ids: Ids of the tags to remove from all of the posts
+    :return: The number of tags that were removed
+    """
+    if session is None:
+        session = models.session
+
+    post_ids = list(post_ids)
+    tag_ids = list(tag_ids)
+    if not post_ids or not tag_ids:
+        return 0
+
+    session.flush()
+
+    post_tag = _get_post_tag_table()
+
+    result = session.execute(post_tag.delete().where(and_(
+        post_tag.c.post_id.in_(post_ids),
+        post_tag.c.tag_id.in_(tag_ids)
+    )))
+
+    log.info('Removed {} tags from {} posts'.format(result.rowcount, len(post_ids)))
+
+    invalidation.notify(session, invalidation.TAG)
+    relatedposts.update_related_posts(post_ids, tag_ids=tag_ids, session=session)
+
+    return result.rowcount
+
+
+def merge_tags(tag_ids, into_tag_id, session=None):
+    """
+    Merge tags into another tag.  Every post with any of the tags is given the other tag instead, and
+    the tags are deleted
+
+    :param tag_ids: Ids of the tags to merge and delete
+    :param into_tag_id: Id of the tag to keep
+    :return: The number of posts that were given the tag
+    :raises ValueError: If any of the tags don't exist, they aren't all for the same post type or any of them
+                        are special tags (with a tag_type)
+    """
+    if session is None:
+        session = models.session
+
+    tag_ids = [tag_id for tag_id in tag_ids if tag_id != into_tag_id]
+    if not tag_ids:
+        return 0
+
+    _check_tags_can_be_merged(session, tag_ids + [into_tag_id])
+
+    session.flush()
+
+    post_tag = _get_post_tag_table()
+    merged = post_tag.alias('merged')
+    existing = post_tag.alias('existing')
+    tags = models.CmsTag.__table__
+
+    result = session.execute(post_tag.insert().from_select(
+        ['post_id', 'tag_id'],
+        select([
+            merged.c.post_id, literal(into_tag_id, BigInteger)
+        ]).distinct().where(and_(
+            merged.c.tag_id.in_(tag_ids),
+            ~exists().where(and_(
+                existing.c.post_id == merged.c.post_id,
+                existing.c.tag_id == into_tag_id
+            ))
+        ))
+    ))
+    num_posts = result.rowcount
+
+    session.execute(post_tag.delete().where(post_tag.c.tag_id.in_(tag_ids)))
+    session.execute(tags.delete().where(tags.c.id.in_(tag_ids)))
+
+    log.info('Merged {} tags into tag {}, adding it to {} posts'.format(len(tag_ids), into_tag_id, num_posts))
+
+    invalidation.notify(session, invalidation.TAG)
+    # Every post that had one of the merged tags now has this tag
+    relatedposts.update_related_posts([], tag_ids=[into_tag_id], session=session)
+
+    return num_posts
+
+
+def rename_tag(tag_id, name, session=None):
+    """
+    Rename a tag.  If there is already a tag with the new name (or one that has the same code), the tag is
+    merged into it
+
+    :return: The tag that now has the name
+    :raises ValueError: If the tag doesn't exist, it is a special tag (with a tag_type) or it would be merged
+                        into a special tag
+    """
+    if session is None:
+        session = models.session
+
+    tag = session.query(models.CmsTag).filter(models.CmsTag.id == tag_id).one_or_none()
+    if not tag:
+        raise ValueError('Tag not found: {}'.format(tag_id))
+
+    if tag.tag_type:
+        raise ValueError('Special tags can\'t be renamed: {}'.format(tag.name))
+
+    code = models.CmsTag.name_to_code(name)
+
+    existing = session.query(
+        models.CmsTag
+    ).filter(
+        models.CmsTag.post_type == tag.post_type,
+        models.CmsTag.code == code,
+        models.CmsTag.id != tag.id
+    ).one_or_none()
+
+    if existing:
+        log.info('Tag {} already exists - merging {} into it'.format(existing.name, tag.name))
+        merge_tags([tag.id], existing.id, session=session)
+        session.expunge(tag)
+        return existing
+
+    log.info('Renaming tag {} to {}'.format(tag.name, name))
+    tag.name = name
+    tag.code = code
+    session.flush()
+
+    return tag
+
+
+def delete_unused_tags(tag_ids=None, post_type=None, session=None):
+    """
+    Delete tags that aren't on any posts.  Special tags (with a tag_type) are never deleted
+
+    :param tag_ids: Only consider these tags.  If None, all tags are considered
+    :param post_type: Only consider tags for this post type
+    :return: The number of tags that were deleted
+    """
+    if session is None:
+        session = models.session
+
+    if tag_ids is not None:
+        tag_ids = list(tag_ids)
+        if not tag_ids:
+            return 0
+
+    session.flush()
+
+    post_tag = _get_post_tag_table()
+    tags = models.CmsTag.__table__
+
+    condition = and_(
+        tags.c.tag_type.is_(None),
+        ~exists().where(post_tag.c.tag_id == tags.c.id)
+    )
+
+    if tag_ids is not None:
+        condition = and_(condition, tags.c.id.in_(tag_ids))
+
+    if post_type is not None:
+        condition = and_(condition, tags.c.post_type == post_type)
+
+    result = session.execute(tags.delete().where(condition))
+
+    if result.rowcount:
+        log.info('Deleted {} unused tags'.format(result.rowcount))
+        invalidation.notify(session, invalidation.TAG)
+
+    return result.rowcount
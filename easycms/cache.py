@@ -0,0 +1,502 @@
+"""
+Caches used to avoid database round trips for content that rarely changes.  They all have the same
+interface as the caches in cachelib (get, get_many, set, add, inc, delete, clear), so a cachelib cache
+such as RedisCache can be used anywhere these can:
+
+  * MemoryCache keeps the entries in this process
+  * FileSystemCache keeps the entries in files, which can be shared by the processes on a host
+  * MemcachedCache is a small client for the memcached text protocol, so the entries can be shared by
+    every process on every host
+"""
+
+import logging
+import threading
+import time
+import os
+import hashlib
+import pickle
+import socket
+import uuid
+import zlib
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+
+class MemoryCache(object):
+    """
+    Thread safe cache held in this process, with a timeout on every entry and a limit on the number
+    of entries.  When the cache is full the least recently used entries are dropped.  The interface
+    matches the caches in cachelib
+    """
+
+    def __init__(self, max_size=100, default_timeout=300):
+        """
+        :param max_size: Maximum number of entries to keep
+        :param default_timeout: Number of seconds to keep entries for, if no timeout is passed into set().
+                                0 means entries never expire
+        """
+        self.max_size = max_size
+        self.default_timeout = default_timeout
+        # Maps key to a tuple of (expiry time or None, value), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_expiry(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        return time.monotonic() + timeout if timeout else None
+
+    def _get(self, key):
+        # Must be called with the lock held
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires, value = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value, timeout):
+        # Must be called with the lock held
+        self._entries[key] = (self._get_expiry(timeout), value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """
+        :return: The value, or None if it isn't in the cache or has expired
+        """
+        with self._lock:
+            return self._get(key)
+
+    def get_many(self, *keys):
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._set(key, value, timeout)
+
+        return True
+
+    def add(self, key, value, timeout=None):
+        """
+        Set the value only if the key isn't already in the cache
+
+        :return: True if the value was set
+        """
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+
+            self._set(key, value, timeout)
+
+        return True
+
+    def inc(self, key, delta=1):
+        """
+        Add delta to a number in the cache.  If the key isn't in the cache it is set to delta.  An existing
+        entry keeps its timeout
+
+        :return: The new value
+        """
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self._set(key, delta, None)
+                return delta
+
+            expires, value = self._entries[key]
+            self._entries[key] = (expires, value + delta)
+            return value + delta
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def delete_many(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+        return True
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileSystemCache(object):
+    """
+    Cache that stores each entry in a pickle file in a directory.  When there are more than max_size
+    entries the oldest are deleted
+    """
+
+    FILE_EXTENSION = '.cache'
+
+    def __init__(self, cache_dir, max_size=1000, default_timeout=300):
+        """
+        :param cache_dir: Directory to store the entries in.  It is created if it doesn't exist
+        :param max_size: Maximum number of entries to keep
+        :param default_timeout: Number of seconds to keep entries for, if no timeout is passed into set().
+                                0 means entries never expire
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.default_timeout = default_timeout
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _get_path(self, key):
+        filename = hashlib.sha1(key.encode('utf-8')).hexdigest() + self.FILE_EXTENSION
+        return os.path.join(self.cache_dir, filename)
+
+    def _get_cache_files(self):
+        return [
+            os.path.join(self.cache_dir, filename)
+            for filename in os.listdir(self.cache_dir)
+            if filename.endswith(self.FILE_EXTENSION)
+        ]
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _prune(self):
+        paths = self._get_cache_files()
+        if len(paths) <= self.max_size:
+            return
+
+        def get_mtime(path):
+            try:
+                return os.path.getmtime(path)
+            except FileNotFoundError:
+                return 0
+
+        paths.sort(key=get_mtime)
+        for path in paths[:len(paths) - self.max_size]:
+            self._remove(path)
+
+    def _read(self, path):
+        """
+        :return: Tuple of (expiry time or 0, value), or None if the entry doesn't exist or has expired
+        """
+        try:
+            with open(path, 'rb') as f:
+                expires = pickle.load(f)
+                if not expires or expires > time.time():
+                    return expires, pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            log.warning('Failed to read cache file {}'.format(path), exc_info=True)
+            return None
+
+        # It has expired
+        self._remove(path)
+        return None
+
+    def _write(self, path, expires, value):
+        # Write to a temporary file and then rename it, so that readers never see a partly written file
+        temp_path = os.path.join(self.cache_dir, 'tmp-{}'.format(uuid.uuid4().hex))
+
+        try:
+            with open(temp_path, 'wb') as f:
+                pickle.dump(expires, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except Exception:
+            log.warning('Failed to write cache file {}'.format(path), exc_info=True)
+            self._remove(temp_path)
+            return False
+
+        self._prune()
+        return True
+
+    def get(self, key):
+        entry = self._read(self._get_path(key))
+        return None if entry is None else entry[1]
+
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        return self._write(self._get_path(key), time.time() + timeout if timeout else 0, value)
+
+    def add(self, key, value, timeout=None):
+        """
+        Set the value only if the key isn't already in the cache.  This is not atomic
+
+        :return: True if the value was set
+        """
+        if self.has(key):
+            return False
+
+        return self.set(key, value, timeout)
+
+    def inc(self, key, delta=1):
+        """
+        Add delta to a number in the cache.  If the key isn't in the cache it is set to delta.  An existing
+        entry keeps its timeout.  This is not atomic
+
+        :return: The new value, or None if it couldn't be saved
+        """
+        path = self._get_path(key)
+        entry = self._read(path)
+
+        if entry is None:
+            return delta if self.set(key, delta) else None
+
+        expires, value = entry
+        return value + delta if self._write(path, expires, value + delta) else None
+
+    def delete(self, key):
+        return self._remove(self._get_path(key))
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self.delete(key)
+
+        return True
+
+    def clear(self):
+        for path in self._get_cache_files():
+            self._remove(path)
+
+        return True
+
+
+class MemcachedCache(object):
+    """
+    Client for the memcached text protocol, with no dependencies.  Values are pickled, and keys are
+    spread across the servers by hashing them.  If a server can't be reached the cache behaves as if
+    it is empty, so the site keeps working without it.  Each thread has its own connections
+    """
+
+    # Timeouts longer than this are sent to memcached as a unix timestamp
+    MAX_RELATIVE_TIMEOUT = 60 * 60 * 24 * 30
+
+    # Flags of values that are stored as numbers rather than pickled, so that they can be incremented
+    INTEGER_FLAGS = 1
+
+    def __init__(self, servers=('127.0.0.1:11211',), default_timeout=300, socket_timeout=1):
+        """
+        :param servers: List of 'host:port' strings
+        :param default_timeout: Number of seconds to keep entries for, if no timeout is passed into set().
+                                0 means entries never expire
+        :param socket_timeout: Timeout in seconds when connecting to and talking to the servers
+        """
+        self.servers = [self._parse_server(server) for server in servers]
+        self.default_timeout = default_timeout
+        self.socket_timeout = socket_timeout
+        self._local = threading.local()
+
+    @staticmethod
+    def _parse_server(server):
+        host, _, port = server.rpartition(':')
+        return host, int(port)
+
+    @staticmethod
+    def _make_key(key):
+        # Memcached keys can't contain spaces or control characters and can't be longer than 250 bytes
+        encoded_key = key.encode('utf-8')
+        if len(encoded_key) > 200 or any(c <= 32 or c == 127 for c in encoded_key):
+            return b'sha1:' + hashlib.sha1(encoded_key).hexdigest().encode('ascii')
+
+        return encoded_key
+
+    def _get_server(self, key):
+        return self.servers[zlib.crc32(key) % len(self.servers)]
+
+    def _get_connection(self, server):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+
+        connection = connections.get(server)
+        if connection is None:
+            sock = socket.create_connection(server, timeout=self.socket_timeout)
+            connection = connections[server] = (sock, sock.makefile('rb'))
+
+        return connection
+
+    def _close_connection(self, server):
+        connection = getattr(self._local, 'connections', {}).pop(server, None)
+        if connection is not None:
+            sock, reader = connection
+            reader.close()
+            sock.close()
+
+    def _request(self, server, request, read_response):
+        """
+        Send a request to a server
+
+        :param read_response: Function that takes the socket reader and returns the result
+        :return: The result, or None if the server couldn't be reached
+        """
+        try:
+            sock, reader = self._get_connection(server)
+            sock.sendall(request)
+            return read_response(reader)
+        except (OSError, ValueError):
+            log.warning('Memcached request to {}:{} failed'.format(*server), exc_info=True)
+            self._close_connection(server)
+            return None
+
+    @staticmethod
+    def _read_line(reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ValueError('Connection closed by memcached')
+
+        return line[:-2]
+
+    def _read_values(self, reader):
+        values = {}
+        while True:
+            line = self._read_line(reader)
+            if line == b'END':
+                return values
+
+            parts = line.split()
+            if parts[0] != b'VALUE':
+                raise ValueError('Unexpected response from memcached: {}'.format(line))
+
+            data = reader.read(int(parts[3]) + 2)[:-2]
+            try:
+                if int(parts[2]) == self.INTEGER_FLAGS:
+                    values[parts[1]] = int(data)
+                else:
+                    values[parts[1]] = pickle.loads(data)
+            except Exception:
+                log.warning('Failed to unpickle cached value for {}'.format(parts[1]), exc_info=True)
+
+    def _get_expiry(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        if timeout > self.MAX_RELATIVE_TIMEOUT:
+            return int(time.time() + timeout)
+
+        return int(timeout)
+
+    def _store(self, command, key, value, timeout):
+        key = self._make_key(key)
+
+        # memcached can only increment unsigned numbers
+        if type(value) is int and value >= 0:
+            flags = self.INTEGER_FLAGS
+            data = b'%d' % value
+        else:
+            flags = 0
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        request = b'%s %s %d %d %d\r\n%s\r\n' % (command, key, flags, self._get_expiry(timeout), len(data), data)
+
+        return self._request(self._get_server(key), request, self._read_line) == b'STORED'
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        memcached_keys = [self._make_key(key) for key in keys]
+
+        keys_by_server = OrderedDict()
+        for memcached_key in memcached_keys:
+            keys_by_server.setdefault(self._get_server(memcached_key), []).append(memcached_key)
+
+        values = {}
+        for server, server_keys in keys_by_server.items():
+            request = b'get %s\r\n' % b' '.join(server_keys)
+            values.update(self._request(server, request, self._read_values) or {})
+
+        return [values.get(memcached_key) for memcached_key in memcached_keys]
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def set(self, key, value, timeout=None):
+        return self._store(b'set', key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        return self._store(b'add', key, value, timeout)
+
+    def inc(self, key, delta=1):
+        """
+        Add delta to a number in the cache.  Unlike the other caches, the key must already be in the cache
+        (i.e. add it with a value of 0 first)
+
+        :return: The new value, or None if the key isn't in the cache or the server couldn't be reached
+        """
+        key = self._make_key(key)
+        if delta < 0:
+            request = b'decr %s %d\r\n' % (key, -delta)
+        else:
+            request = b'incr %s %d\r\n' % (key, delta)
+
+        response = self._request(self._get_server(key), request, self._read_line)
+        if response is None or not response.isdigit():
+            return None
+
+        return int(response)
+
+    def delete(self, key):
+        key = self._make_key(key)
+        return self._request(self._get_server(key), b'delete %s\r\n' % key, self._read_line) == b'DELETED'
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self.delete(key)
+
+        return True
+
+    def clear(self):
+        """
+        Remove everything from the servers, including entries that weren't set by this cache
+        """
+        results = [self._request(server, b'flush_all\r\n', self._read_line) for server in self.servers]
+        return all(result == b'OK' for result in results)
+
+
+def merge_cached_instance(instance, session):
+    """
+    Put a cached (detached) instance into a session without loading it from the database.  The
+    attributes and relationships that were loaded when it was cached are copied into the session
+
+    :return: The instance in the session
+    """
+    existing = session.identity_map.get(inspect(instance).key)
+    if existing is not None and session.is_modified(existing):
+        # Don't overwrite changes that haven't been saved yet
+        return existing
+
+    return session.merge(instance, load=False)
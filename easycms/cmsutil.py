@@ -7,11 +7,17 @@ import urllib
 import io
 import os
 import re
+import hashlib
+import uuid
+import mimetypes
 
 from flask import request, url_for
 import requests
 import PIL.Image
-from littlefish import imageutil, timetool
+import PIL.features
+from bs4 import BeautifulSoup
+from unidecode import unidecode
+from littlefish import imageutil
 from flaskfilemanager import filemanager
 
 from .settings import get_settings
@@ -34,18 +40,89 @@ def make_code(s, strip_hyphens=True):
     return code
 
 
-def process_and_save_snippet_image(image_url, always_local=False):
+def escape_like(s):
     """
-    :param image_url: The url of the image to process
+    Escape the wildcards in a str so that it can be used in a LIKE pattern with escape='\\'
+    """
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def parse_html(html):
+    """
+    :return: BeautifulSoup object for the html, which can be passed into the functions below
+    """
+    return BeautifulSoup(unidecode(html), 'html.parser')
+
+
+def get_description(soup):
+    """
+    :return: The text from the first paragraph in the (parsed) html, or an empty string
+    """
+    ps = soup.find_all('p')
+    for p in ps:
+        desc = ''
+        found = False
+        for c in p.contents:
+            # c.name is the tag name.  We are looking for text which has no tag name
+            if not c.name:
+                found = True
+                desc += c + ' '
+            else:
+                # it was a tag - look one level deep for more text
+                for c2 in c.contents:
+                    if not c2.name:
+                        desc += c2 + ' '
+
+        if found:
+            # There was a paragraph!
+            return desc.strip()
+
+    return ''
+
+
+def get_word_count(soup):
+    """
+    :return: The approximate number of words in the paragraphs and divs of the (parsed) html
+    """
+    all_text = ''
+
+    # We get the words within paragrphs
+    paragraphs = soup.findAll('p')
+    for s in paragraphs:
+        all_text += ' '.join(s.findAll(text=True))
+    
+    # Now divs
+    divs = soup.findAll('div')
+    for s in divs:
+        all_text += ' '.join(s.findAll(text=True))
+
+    # Mung the text
+    processed_text = re.sub(r'[^a-zA-Z\']+', ' ', all_text)
+    return len(processed_text.split(' '))
+
+
+def get_text(soup):
+    """
+    :return: All of the text in the (parsed) html, with the whitespace collapsed
+    """
+    return ' '.join(soup.get_text(' ').split())
+
+
+def get_image_urls(soup):
+    """
+    :return: List of the src of every img tag in the (parsed) html.  Tags without a src are skipped
+    """
+    return [img.get('src') for img in soup.find_all('img') if img.get('src')]
+
+
+def get_full_image_url(image_url, always_local=False):
+    """
+    :param image_url: The url of an image, which may be relative to the current request
     :param always_local: If True, skip the usual checks and assume this is a local image (used in create script)
-    :return: The image url
+    :return: The full url of the image
     """
-    settings = get_settings()
     url_parts = urllib.parse.urlparse(image_url)
-    extension = url_parts.path.split('.')[-1]
 
-    assert extension
-    
     # TODO: always_local is a legacy feature that I don't understand!  I think it was used to load images
     # from the filesystem instead of via http but I don't remember exactly what it was used for!
     if always_local or url_parts.netloc.encode('UTF-8') == request.host \
@@ -55,35 +132,245 @@ def process_and_save_snippet_image(image_url, always_local=False):
         path = url_parts.path if url_parts.path else request.path
         query = url_parts.query
         fragment = url_parts.query
-        full_image_url = urllib.parse.urlunsplit((scheme, host, path, query, fragment))
-    else:
-        # This is the full url
-        full_image_url = image_url
+        return urllib.parse.urlunsplit((scheme, host, path, query, fragment))
 
-    log.debug('Loading image via %s: %s' % (url_parts.scheme, full_image_url))
-    r = requests.get(full_image_url, verify=False)
-    stream = io.BytesIO(r.content)
-    image = PIL.Image.open(stream)
+    # This is the full url
+    return image_url
 
-    assert image
 
-    # We now have an image!  Woohooooo!
-    # Now we need to resize it
-    cropped_image = imageutil.resize_crop_image(image, settings.snippet_image_width,
-                                                settings.snippet_image_height, pad_when_tall=False)
-
-    # Generate a filename
-    filename = 'sn-%s.%s' % (timetool.unix_time(), extension)
-    full_path = os.path.join(settings.snippet_image_file_path, filename)
-
-    log.info('Saving snippet image to %s' % full_path)
-    cropped_image.save(
-        full_path, quality=settings.pil_saved_image_quality,
-        subsampling=settings.pil_saved_image_subsampling,
-        compress_level=settings.pil_saved_image_compression_level
+def get_image_extension(image_url):
+    extension = urllib.parse.urlparse(image_url).path.split('.')[-1]
+
+    assert extension
+
+    return extension
+
+
+def download_image_data(full_image_url, timeout=None):
+    """
+    :param full_image_url: The full url of the image
+    :param timeout: Timeout for the http request in seconds.  Defaults to settings.snippet_image_download_timeout
+    :return: The raw image file data (bytes)
+    """
+    if timeout is None:
+        timeout = get_settings().snippet_image_download_timeout
+
+    log.debug('Loading image: %s' % full_image_url)
+    r = requests.get(full_image_url, verify=False, timeout=timeout)
+    r.raise_for_status()
+
+    return r.content
+
+
+def get_snippet_image_filename(image_data, extension, pad_when_tall=False, width=None, height=None):
+    """
+    Snippet image filenames are generated from a hash of the source image and the snippet image size, so
+    that the same image is only ever processed and stored once
+
+    :param image_data: The raw source image file data (bytes)
+    :param width: Width of the snippet image.  Defaults to settings.snippet_image_width
+    :param height: Height of the snippet image.  Defaults to settings.snippet_image_height
+    """
+    settings = get_settings()
+
+    return 'sn-%s-%sx%s%s.%s' % (
+        hashlib.sha1(image_data).hexdigest(),
+        width or settings.snippet_image_width,
+        height or settings.snippet_image_height,
+        '-p' if pad_when_tall else '',
+        extension.lower()
     )
 
+
+class _ImageLoader(object):
+    """
+    Decodes the source image the first time it is needed, so that generating several sizes of an image
+    only decodes it once, and reusing existing files doesn't decode it at all
+    """
+
+    def __init__(self, image_data):
+        self.image_data = image_data
+        self._image = None
+
+    def get_image(self):
+        if self._image is None:
+            self._image = PIL.Image.open(io.BytesIO(self.image_data))
+            self._image.load()
+
+        return self._image
+
+
+def _save_generated_image(folder, filename, image_loader, resize):
+    """
+    Resize an image and save it, unless a file with the same name already exists
+
+    :param folder: The full path of the folder to save the image in
+    :param image_loader: _ImageLoader for the source image
+    :param resize: Function that takes the source PIL image and returns the resized image
+    :return: The path of the saved image, relative to the filemanager root
+    """
+    settings = get_settings()
+
+    full_path = os.path.join(folder, filename)
     fm_path = full_path.replace(filemanager.get_root_path() + '/', '')
+
+    if os.path.exists(full_path):
+        log.info('Reusing existing image %s' % full_path)
+        return fm_path
+
+    image = image_loader.get_image()
+
+    assert image
+
+    resized_image = resize(image)
+
+    extension = filename.split('.')[-1]
+    if extension in ('jpg', 'jpeg') and resized_image.mode not in ('RGB', 'L'):
+        resized_image = resized_image.convert('RGB')
+
+    # Save to a temporary file and then rename it, so that a concurrent save of the same image never
+    # sees a partly written file
+    temp_path = os.path.join(folder, 'tmp-%s.%s' % (uuid.uuid4().hex, extension))
+
+    log.info('Saving image to %s' % full_path)
+    try:
+        resized_image.save(
+            temp_path, quality=settings.pil_saved_image_quality,
+            subsampling=settings.pil_saved_image_subsampling,
+            compress_level=settings.pil_saved_image_compression_level
+        )
+        os.replace(temp_path, full_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return fm_path
+
+
+def save_snippet_image(image_data, extension, pad_when_tall=False, width=None, height=None, image_loader=None):
+    """
+    Resize and crop an image to the snippet image size and save it in the snippet image folder.  If the
+    same image has already been saved at this size, the existing file is reused
+
+    :param image_data: The raw source image file data (bytes)
+    :param width: Width of the snippet image.  Defaults to settings.snippet_image_width
+    :param height: Height of the snippet image.  Defaults to settings.snippet_image_height
+    :return: The path of the saved image, relative to the filemanager root
+    """
+    settings = get_settings()
+
+    if width is None or height is None:
+        width = settings.snippet_image_width
+        height = settings.snippet_image_height
+
+    if image_loader is None:
+        image_loader = _ImageLoader(image_data)
+
+    def resize(image):
+        return imageutil.resize_crop_image(image, width, height, pad_when_tall=pad_when_tall)
+
+    filename = get_snippet_image_filename(image_data, extension, pad_when_tall, width, height)
+
+    return _save_generated_image(settings.snippet_image_file_path, filename, image_loader, resize)
+
+
+def is_webp_supported():
+    return PIL.features.check('webp')
+
+
+def get_variant_extensions(extension):
+    """
+    :return: List of the file extensions to save image variants as: the original format, and WebP if
+             it is enabled and supported by Pillow
+    """
+    extensions = [extension.lower()]
+
+    if get_settings().image_webp_enabled and 'webp' not in extensions and is_webp_supported():
+        extensions.append('webp')
+
+    return extensions
+
+
+def get_image_mime_type(extension):
+    return mimetypes.types_map.get('.' + extension.lower(), 'image/' + extension.lower())
+
+
+def save_snippet_image_variants(image_data, extension, pad_when_tall=False, always_local=False):
+    """
+    Save the snippet image at each of the sizes in settings.snippet_image_widths, keeping the snippet
+    image aspect ratio, in the original format and WebP
+
+    :return: List of dicts with the url, width, height and (mime) type of each variant
+    """
+    settings = get_settings()
+    widths = sorted(set(settings.snippet_image_widths or []) | {settings.snippet_image_width})
+    image_loader = _ImageLoader(image_data)
+
+    variants = []
+    for width in widths:
+        height = int(round(width * settings.snippet_image_height / settings.snippet_image_width))
+
+        for variant_extension in get_variant_extensions(extension):
+            fm_path = save_snippet_image(image_data, variant_extension, pad_when_tall, width, height,
+                                         image_loader=image_loader)
+            variants.append({
+                'url': get_userfile_url(fm_path, always_local),
+                'width': width,
+                'height': height,
+                'type': get_image_mime_type(variant_extension)
+            })
+
+    return variants
+
+
+def get_image_size(image_data):
+    """
+    :return: (width, height) of an image.  This only reads the image header
+    """
+    return PIL.Image.open(io.BytesIO(image_data)).size
+
+
+def save_main_image_variants(image_data, extension, always_local=False):
+    """
+    Save scaled down copies of a post's main image at each of the sizes in settings.main_image_widths that
+    are smaller than the original image, in the original format and WebP
+
+    :return: List of dicts with the url, width, height and (mime) type of each variant
+    """
+    settings = get_settings()
+    image_loader = _ImageLoader(image_data)
+    image_hash = hashlib.sha1(image_data).hexdigest()
+
+    original_width, original_height = get_image_size(image_data)
+
+    variants = []
+    for width in sorted(set(settings.main_image_widths or [])):
+        if width >= original_width:
+            continue
+
+        height = int(round(width * original_height / original_width))
+
+        def resize(image, size=(width, height)):
+            return image.resize(size, PIL.Image.LANCZOS)
+
+        for variant_extension in get_variant_extensions(extension):
+            filename = 'mi-%s-%sw.%s' % (image_hash, width, variant_extension)
+            fm_path = _save_generated_image(settings.main_image_variant_file_path, filename, image_loader, resize)
+            variants.append({
+                'url': get_userfile_url(fm_path, always_local),
+                'width': width,
+                'height': height,
+                'type': get_image_mime_type(variant_extension)
+            })
+
+    return variants
+
+
+def get_userfile_url(fm_path, always_local=False):
+    """
+    :param fm_path: Path of a file, relative to the filemanager root
+    :return: The full url of the file
+    """
     try:
         return url_for('flaskfilemanager.userfile', filename=fm_path, _external=True, _scheme=request.scheme)
     except RuntimeError:
@@ -94,8 +381,40 @@ def process_and_save_snippet_image(image_url, always_local=False):
             raise
 
 
+def process_and_save_snippet_image(image_url, always_local=False, post=None):
+    """
+    :param image_url: The url of the image to process
+    :param always_local: If True, skip the usual checks and assume this is a local image (used in create script)
+    :param post: If set, the responsive variants of the snippet image will be saved and stored on this post
+    :return: The image url
+    """
+    extension = get_image_extension(image_url)
+    image_data = download_image_data(get_full_image_url(image_url, always_local))
+
+    # We now have an image!  Woohooooo!
+    # Now we need to resize it
+    fm_path = save_snippet_image(image_data, extension)
+    snippet_image_url = get_userfile_url(fm_path, always_local)
+
+    if post is not None:
+        variants = save_snippet_image_variants(image_data, extension, always_local=always_local)
+        post.snippet_image_variants = post.make_image_variants(snippet_image_url, variants)
+
+    return snippet_image_url
+
+
+def process_and_save_main_image_variants(post, always_local=False):
+    """
+    Save the responsive variants of a post's main image and store them on the post
+    """
+    image_url = post.main_image_url
+    image_data = download_image_data(get_full_image_url(image_url, always_local))
+    variants = save_main_image_variants(image_data, get_image_extension(image_url), always_local)
+    post.main_image_variants = post.make_image_variants(image_url, variants, get_image_size(image_data))
+
+
 def add_default_snippet(post, always_local=False):
     imgs = post.get_images()
     if imgs:
         log.info('Automatically adding snippet image: %s' % imgs[0])
-        post.snippet_image = process_and_save_snippet_image(imgs[0], always_local)
+        post.snippet_image = process_and_save_snippet_image(imgs[0], always_local, post=post)
@@ -4,7 +4,6 @@ Functions to deal with comments
 
 import logging
 import re
-import datetime
 
 import easyforms
 import easyforms.exceptions
@@ -16,6 +15,7 @@ from .models import db
 from . import models
 from . import customfields
 from . import constants
+from . import ratelimit
 from .settings import get_settings
 import easycms
 
@@ -57,6 +57,22 @@ def get_comment_reply_html_field(name, value=None, required=False):
     return easyforms.CkeditorField(name, value=value, required=required, config=get_ckeditor_config())
 
 
+def is_duplicate_comment(session, post, content, author_email):
+    """
+    :return: True if the same person has already posted exactly the same comment on the post
+    """
+    return session.query(
+        session.query(
+            models.CmsComment.id
+        ).filter(
+            models.CmsComment.post_id == post.id,
+            models.CmsComment.author_email == author_email,
+            models.CmsComment.content == content,
+            models.CmsComment.deleted == False
+        ).exists()
+    ).scalar()
+
+
 def create_and_process_comment_form(post, session=None, action='', form_type=easyforms.VERTICAL,
                                     submit_css_class='btn-primary btn-lg',
                                     form_style=easyforms.styles.BOOTSTRAP_4):
@@ -149,28 +165,28 @@ def create_and_process_comment_form(post, session=None, action='', form_type=eas
                 response.set_cookie(constants.COMMENT_EMAIL_COOKIE_NAME, cookie_email)
                 return response
 
-            # See if they are allowed to comment
-            cut_off = datetime.datetime.utcnow() - datetime.timedelta(minutes=2)
-            made_comment = False
-
-            for comment in post.comments:
-                if comment.author_ip == request.remote_addr and comment.timestamp > cut_off:
-                    made_comment = True
-                    break
-
-            if made_comment:
-                error = 'You can\'t comment as you have recently commented on this post.  Wait a while and try again.'
-            elif form['nickname']:
+            if form['nickname']:
                 error = 'Comment failed'
                 log.info('Not posting comment due to spam check')
                 log.info('ANTISPAM! User Agent: %s | ip: %s | Post Data: %s' % (request.user_agent, request.remote_addr, request.form))
+            elif is_duplicate_comment(session, post, content, form['email']):
+                error = 'You have already posted this comment.'
             else:
-                # Make the comment
-                comment = models.CmsComment(
-                    post, content, author_name=form['name'], author_email=form['email'],
-                    author_ip=request.remote_addr, user_agent=str(request.user_agent),
-                    reply_to=reply_comment
-                )
+                # The rate limits are checked last, so that spam and duplicate comments that are rejected
+                # anyway don't use up the commenter's allowance
+                exceeded_limit = ratelimit.check_comment_rate_limit(request.remote_addr, post, session)
+
+                if exceeded_limit and exceeded_limit.per_post:
+                    error = 'You can\'t comment as you have recently commented on this post.  Wait a while and try again.'
+                elif exceeded_limit:
+                    error = 'You can\'t comment as you have made too many comments recently.  Wait a while and try again.'
+                else:
+                    # Make the comment
+                    comment = models.CmsComment(
+                        post, content, author_name=form['name'], author_email=form['email'],
+                        author_ip=request.remote_addr, user_agent=str(request.user_agent),
+                        reply_to=reply_comment
+                    )
 
         if error:
             flash(error, 'danger')
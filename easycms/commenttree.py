@@ -0,0 +1,148 @@
+"""
+Loads the threaded comments for a post in a single query.  Walking CmsComment.replies in a template
+lazy loads every level of the tree separately, which costs a query for every comment
+"""
+
+import logging
+
+from sqlalchemy import BigInteger, Integer, String, and_, or_, cast, case, literal, true, func
+from sqlalchemy.dialects.postgresql import ARRAY, array
+from sqlalchemy.orm import aliased, joinedload
+from flask import request
+
+from . import models, accesscontrol, constants
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+
+class CommentNode(object):
+    def __init__(self, comment, depth, parent=None):
+        """
+        :param comment: The CmsComment
+        :param depth: Number of visible comments above this one in the tree (0 for a top level comment)
+        :param parent: The CommentNode above this one, or None for a top level comment
+        """
+        self.comment = comment
+        self.depth = depth
+        self.parent = parent
+        # Visible replies to this comment, oldest first
+        self.replies = []
+
+    def __iter__(self):
+        """
+        Iterate over this node and all of the nodes below it, in the order they should be displayed
+        """
+        yield self
+        for reply in self.replies:
+            yield from reply
+
+    def __repr__(self):
+        return '<CommentNode {} depth={} replies={}>'.format(self.comment.id, self.depth, len(self.replies))
+
+
+def get_visible_filter(comment_class):
+    """
+    The SQL equivalent of CmsComment.visible() for the current user
+
+    :param comment_class: CmsComment, or an alias of it
+    """
+    if accesscontrol.get_access_control().can_moderate_comments():
+        return true()
+
+    email = None
+    if request and request.cookies:
+        email = request.cookies.get(constants.COMMENT_EMAIL_COOKIE_NAME)
+
+    if not email:
+        return and_(comment_class.deleted == False, comment_class.approved == True)
+
+    return and_(
+        comment_class.deleted == False,
+        or_(comment_class.approved == True, comment_class.author_email == email)
+    )
+
+
+def _get_sort_key(comment_class):
+    """
+    A string that sorts comments by timestamp and then id
+    """
+    return func.to_char(comment_class.timestamp, 'YYYYMMDDHH24MISSUS', type_=String) + \
+        func.lpad(cast(comment_class.id, String), 20, '0')
+
+
+def load_comment_tree(post, session, root_ids=None):
+    """
+    Load all of the comments on a post that the current user can see, using a recursive query.  Replies
+    to a comment that the user can't see are attached to the nearest visible comment above them, which
+    is how they were displayed when walking the tree in a template
+
+    :param root_ids: If set, only load these top level comments and the replies to them
+    :return: List of CommentNode for the top level comments, in display order
+    """
+    if root_ids is not None and not root_ids:
+        return []
+
+    CmsComment = models.CmsComment
+    reply = aliased(CmsComment)
+
+    # Each row in the tree stores whether the comment is visible, the id of the nearest visible comment
+    # above it, its depth counting only visible comments and the sort keys of all of the comments above
+    # it.  Sorting by the path puts the comments in the order they should be displayed
+    roots_query = session.query(
+        CmsComment.id.label('id'),
+        get_visible_filter(CmsComment).label('visible'),
+        cast(None, BigInteger).label('parent_id'),
+        cast(literal(0), Integer).label('depth'),
+        cast(array([_get_sort_key(CmsComment)]), ARRAY(String)).label('path')
+    ).filter(
+        CmsComment.post_id == post.id,
+        CmsComment.reply_to_id == None
+    )
+
+    if root_ids is not None:
+        roots_query = roots_query.filter(CmsComment.id.in_(root_ids))
+
+    tree = roots_query.cte('comment_tree', recursive=True)
+
+    tree = tree.union_all(
+        session.query(
+            reply.id,
+            get_visible_filter(reply),
+            case([(tree.c.visible, tree.c.id)], else_=tree.c.parent_id),
+            tree.c.depth + case([(tree.c.visible, 1)], else_=0),
+            tree.c.path.op('||')(_get_sort_key(reply))
+        ).join(
+            tree, reply.reply_to_id == tree.c.id
+        )
+    )
+
+    rows = session.query(
+        CmsComment, tree.c.parent_id, tree.c.depth
+    ).join(
+        tree, CmsComment.id == tree.c.id
+    ).filter(
+        tree.c.visible
+    ).options(
+        joinedload(CmsComment.author),
+        joinedload(CmsComment.editor)
+    ).order_by(
+        tree.c.path
+    ).all()
+
+    nodes = {}
+    for comment, parent_id, depth in rows:
+        nodes[comment.id] = CommentNode(comment, depth)
+
+    roots = []
+    for comment, parent_id, depth in rows:
+        node = nodes[comment.id]
+        node.parent = nodes.get(parent_id)
+
+        if node.parent is None:
+            roots.append(node)
+        else:
+            node.parent.replies.append(node)
+
+    return roots
@@ -3,9 +3,14 @@ Contains functions for interacting with the database, mainly for loading and sav
 """
 
 import logging
+import os
+import time
+import urllib.parse
 
-from .settings import get_page_defs
-from . import models
+from sqlalchemy import or_
+
+from .settings import get_page_defs, get_settings
+from . import models, pagecache, invalidation
 from .models import db
 
 __author__ = 'Stephen Brown (Little Fish Solutions LTD)'
@@ -63,5 +68,73 @@ def update_all_pages():
         all_codes = [pd.code for pd in page_defs]
         query = query.filter(CmsPage.code.notin_(all_codes))
     query.update({'disabled': True}, synchronize_session=False)
+    invalidation.notify(db.session, invalidation.PAGE)
 
     db.session.commit()
+
+    # Titles and disabled flags may have changed
+    pagecache.invalidate()
+
+
+def find_orphaned_snippet_images(min_age=3600, session=None):
+    """
+    Find generated snippet image (and main image variant) files that are not used by any post
+
+    :param min_age: Ignore files modified less than this many seconds ago, as they may belong to a post
+                    that hasn't been saved yet
+    :return: List of full paths to the orphaned files
+    """
+    if session is None:
+        session = db.session
+
+    settings = get_settings()
+    CmsPost = models.CmsPost
+
+    rows = session.query(
+        CmsPost.snippet_image, CmsPost.snippet_image_variants, CmsPost.main_image_variants
+    ).filter(
+        or_(CmsPost.snippet_image != None, CmsPost.snippet_image_variants != None,
+            CmsPost.main_image_variants != None)
+    ).all()
+
+    used = set()
+    for snippet_image, snippet_image_variants, main_image_variants in rows:
+        urls = [snippet_image]
+        for image_variants in (snippet_image_variants, main_image_variants):
+            if image_variants:
+                urls += [variant['url'] for variant in image_variants.get('variants') or []]
+
+        used.update(os.path.basename(urllib.parse.urlparse(url).path) for url in urls if url)
+
+    cut_off = time.time() - min_age
+    orphans = []
+
+    for folder in (settings.snippet_image_file_path, settings.main_image_variant_file_path):
+        if not os.path.isdir(folder):
+            continue
+
+        for entry in os.scandir(folder):
+            if entry.is_file() and entry.name.startswith(('sn-', 'mi-', 'tmp-')) and entry.name not in used \
+                    and entry.stat().st_mtime < cut_off:
+                orphans.append(entry.path)
+
+    return sorted(orphans)
+
+
+def delete_orphaned_snippet_images(min_age=3600, dry_run=False, session=None):
+    """
+    Delete generated snippet image files that are not used by any post
+
+    :param dry_run: If True, only log the files that would be deleted
+    :return: List of full paths to the deleted (or orphaned, for a dry run) files
+    """
+    orphans = find_orphaned_snippet_images(min_age, session)
+
+    for path in orphans:
+        if dry_run:
+            log.info('Orphaned snippet image: {}'.format(path))
+        else:
+            log.info('Deleting orphaned snippet image: {}'.format(path))
+            os.remove(path)
+
+    return orphans
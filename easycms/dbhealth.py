@@ -0,0 +1,89 @@
+"""
+Connection health checking.  Connections are tested for liveness when they are checked out of the
+connection pool, rather than with an extra query at the start of every request
+"""
+
+import logging
+import time
+
+import sqlalchemy.exc
+from sqlalchemy import event
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+# Key used to store the last time a connection was used in the pool's connection record
+LAST_USED_KEY = 'easycms_last_used'
+
+# Connections that have been used within this many seconds will not be pinged on checkout
+DEFAULT_PING_INTERVAL = 10
+
+_ping_interval = DEFAULT_PING_INTERVAL
+
+
+def init(engine, ping_interval=DEFAULT_PING_INTERVAL):
+    """
+    Register the pool listeners that check connection liveness
+
+    :param engine: The engine (or connection) passed into easycms.init(...)
+    :param ping_interval: Connections that have been used within this many seconds are assumed to
+                          be alive and will not be pinged.  Set to 0 to always ping
+    """
+    global _ping_interval
+
+    _ping_interval = ping_interval
+
+    # Works with both engines and connections
+    engine = engine.engine
+
+    if event.contains(engine, 'checkout', _on_checkout):
+        log.debug('Connection health checking already enabled')
+        return
+
+    log.info('Enabling connection health checking (ping interval: {}s)'.format(ping_interval))
+
+    event.listen(engine, 'connect', _on_connect)
+    event.listen(engine, 'checkout', _on_checkout)
+    event.listen(engine, 'checkin', _on_checkin)
+
+
+def _mark_used(connection_record):
+    connection_record.info[LAST_USED_KEY] = time.monotonic()
+
+
+def _on_connect(dbapi_connection, connection_record):
+    # A brand new connection doesn't need to be pinged
+    _mark_used(connection_record)
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    if connection_record is not None:
+        _mark_used(connection_record)
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    last_used = connection_record.info.get(LAST_USED_KEY)
+    if last_used is not None and time.monotonic() - last_used < _ping_interval:
+        return
+
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception as e:
+        log.warning('Database connection is dead - reconnecting. {}'.format(e))
+        # This tells the pool to discard this connection and retry the checkout with a new one
+        raise sqlalchemy.exc.DisconnectionError(str(e))
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+
+def is_disconnect(e):
+    """
+    :param e: An exception raised by SQLAlchemy
+    :return: True if the exception was caused by the database connection being lost
+    """
+    return isinstance(e, sqlalchemy.exc.DBAPIError) and e.connection_invalidated
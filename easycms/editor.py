@@ -5,7 +5,6 @@ Backend editor for CMS - implemented with a Flask blueprint
 import logging
 import traceback
 import datetime
-import os
 from functools import wraps
 
 from flask import Blueprint, render_template, request, abort, redirect, jsonify, url_for,\
@@ -14,19 +13,20 @@ import easyforms
 from easyforms import CkeditorConfig  # noqa
 from easyforms import validate
 from easyforms.bs4 import Form
-from littlefish import timetool, imageutil
-from littlefish.pager import Pager
+from littlefish import timetool
+from littlefish.pager import Pager, SimplePager
 from titlecase import titlecase
 import sqlalchemy.exc
-import flaskfilemanager
-from sqlalchemy import or_
+from sqlalchemy import or_, func
+import click
 
-from . import accesscontrol, models, cmsutil
+from . import accesscontrol, models, cmsutil, snippetworker, pagecache, relatedposts, search, bulktags
 from .settings import get_settings, get_page_defs
 from .models import db
 import easycms
 from . import comments
 from . import forms
+from . import datautil
 from .customfields import customfields
 
 __author__ = 'Stephen Brown (Little Fish Solutions LTD)'
@@ -35,6 +35,11 @@ log = logging.getLogger(__name__)
 
 editor = Blueprint('easycms_editor', __name__, static_folder='static', template_folder='templates')
 
+# Maximum number of suggestions returned by the autocomplete views
+AUTOCOMPLETE_LIMIT = 10
+# Shorter search terms only match the start of the name, as they would match too much otherwise
+AUTOCOMPLETE_MIN_CONTAINS_LENGTH = 3
+
 # Set up jinja2 filters
 editor.add_app_template_filter(timetool.format_date, 'easycms_format_date')
 editor.add_app_template_filter(timetool.format_datetime, 'easycms_format_datetime')
@@ -69,6 +74,76 @@ def error_page(message, title='Error', preformat=False, http_status_code=500):
     return render_template('easycms/error_page.html', title=title, message=message, preformat=preformat), http_status_code
 
 
+def is_duplicate_title(post_type, title, post=None):
+    """
+    :param post: The post being edited, which is ignored, or None if this is a new post
+    :return: True if there is another post of this type with the title, ignoring case
+    """
+    query = db.session.query(
+        models.CmsPost.id
+    ).filter(
+        models.CmsPost.post_type == post_type,
+        func.lower(models.CmsPost.title) == func.lower(title)
+    )
+
+    if post is not None:
+        query = query.filter(models.CmsPost.id != post.id)
+
+    return query.first() is not None
+
+
+def split_tag_names(tag_names):
+    """
+    :param tag_names: Comma separated tag names
+    :return: List of the tag names
+    """
+    return [tag_name.strip() for tag_name in tag_names.split(',') if tag_name.strip()]
+
+
+def get_tags_by_code(post_type, tag_names):
+    """
+    Look up tags by name, with a single query
+
+    :return: Dict of tag code to CmsTag for each of the names that is an existing tag
+    """
+    codes = {models.CmsTag.name_to_code(tag_name) for tag_name in tag_names}
+    if not codes:
+        return {}
+
+    tags = db.session.query(
+        models.CmsTag
+    ).filter(
+        models.CmsTag.post_type == post_type,
+        models.CmsTag.code.in_(codes)
+    ).all()
+
+    return {tag.code: tag for tag in tags}
+
+
+def get_autocomplete_filter(column, term):
+    """
+    :return: Filter that matches the term anywhere in the column (or at the start, if the term is short),
+             ignoring case.  Both can use a pg_trgm index on the column
+    """
+    escaped = cmsutil.escape_like(term)
+
+    if len(term) < AUTOCOMPLETE_MIN_CONTAINS_LENGTH:
+        return column.ilike(escaped + '%', escape='\\')
+
+    return column.ilike('%' + escaped + '%', escape='\\')
+
+
+def get_autocomplete_order(column, term):
+    """
+    :return: Ordering that puts the names that start with the term first, then the most similar
+    """
+    return (
+        column.ilike(cmsutil.escape_like(term) + '%', escape='\\').desc(),
+        func.similarity(column, term).desc(),
+        column
+    )
+
+
 @editor.context_processor
 def add_editor_context():
     return {
@@ -176,6 +251,8 @@ def edit_page(page_id=None):
                 return jsonify({'status': 'error', 'error': 'Background save failed!'})
             raise
 
+        pagecache.invalidate(page.code)
+
         if ajax:
             # We need to send the edit url for this page, otherwise, we will repeatedly create new pages each time
             # we background save
@@ -232,6 +309,7 @@ def view_page_history(page_id, history_id=None):
         new_history = models.CmsPageRevision(page, user, revision_notes=notes)
         db.session.add(new_history)
         db.session.commit()
+        pagecache.invalidate(page.code)
         flash('Revision restored successfully', 'success')
         return redirect(url_for('.view_page', page_id=page.id))
 
@@ -283,6 +361,7 @@ def publish_page(page_id):
         db.session.add(published_page_revision)
 
         db.session.commit()
+        pagecache.invalidate(page.code)
         flash('Page successfully published', 'success')
         return redirect(url_for('.view_pages'))
 
@@ -335,6 +414,7 @@ def view_published_page_history(page_id, history_id=None):
         page.published = False
 
         db.session.commit()
+        pagecache.invalidate(page.code)
         flash('Revision restored successfully', 'success')
         return redirect(url_for('.view_page', page_id=page.id, published='True'))
 
@@ -350,7 +430,7 @@ def view_posts(post_type=None):
         abort(404)
 
     pager = easycms.get_all_posts_pager(request.args.get('page', 1), num_per_page=30,
-                                        post_type=post_type, allow_unpublished=True)
+                                        post_type=post_type, allow_unpublished=True, defer_content=True)
 
     return render_template('easycms/view_posts.html', pager=pager, post_type=post_type)
 
@@ -389,14 +469,7 @@ def create_post(post_type):
     user = accesscontrol.get_access_control().get_logged_in_cms_user()
 
     if form.ready:
-        duplicate = db.session.query(
-            models.CmsPost
-        ).filter(
-            models.CmsPost.post_type == post_type,
-            models.CmsPost.title.ilike(form['title'])
-        ).first()
-
-        if duplicate:
+        if is_duplicate_title(post_type, form['title']):
             form.set_error('title', 'A post with this title already exists')
 
     if form.ready:
@@ -418,6 +491,10 @@ def create_post(post_type):
 
         db.session.commit()
 
+        if settings.main_image_widths and post.main_image_url:
+            snippetworker.add_main_image_variants(post)
+            db.session.commit()
+
         return redirect(url_for('.edit_post', post_id=post.id))
 
     return render_template('easycms/create_post.html', form=form, post_type=post_type)
@@ -480,23 +557,7 @@ def edit_post(post_id):
     user = accesscontrol.get_access_control().get_logged_in_cms_user()
     
     if form.ready:
-        if post:
-            duplicate = db.session.query(
-                models.CmsPost
-            ).filter(
-                models.CmsPost.post_type == post_type,
-                models.CmsPost.title.ilike(form['title']),
-                models.CmsPost.id != post.id
-            ).first()
-        else:
-            duplicate = db.session.query(
-                models.CmsPost
-            ).filter(
-                models.CmsPost.post_type == post_type,
-                models.CmsPost.title.ilike(form['title'])
-            ).first()
-
-        if duplicate:
+        if is_duplicate_title(post_type, form['title'], post):
             form.set_error('title', 'A post with this title already exists')
 
     if form.ready:
@@ -518,14 +579,12 @@ def edit_post(post_id):
             post.published = form['published']
             post.author = form['author']
 
+        relatedposts.update_related_posts_if_changed(post, session=db.session)
+
         # Always save a history record
         revision = models.CmsPostRevision(post, user)
         db.session.add(revision)
 
-        # If we don't have a snippet image, try to create one
-        if not post.snippet_image and settings.snippets_enabled:
-            cmsutil.add_default_snippet(post)
-
         try:
             db.session.commit()
         except:  # noqa
@@ -533,6 +592,19 @@ def edit_post(post_id):
                 return jsonify({'status': 'error', 'error': 'Background save failed!'})
             raise
 
+        # The image jobs are only queued once the post has been saved.  The worker only updates the post if
+        # its images are still the same, so it mustn't run before the changes are committed
+        snippet_job = None
+        if not post.snippet_image and settings.snippets_enabled:
+            snippet_job = snippetworker.add_default_snippet(post)
+
+        # Create the responsive versions of the main image, if it has changed
+        if settings.main_image_widths and post.main_image_url and not post.has_current_main_image_variants():
+            snippetworker.add_main_image_variants(post)
+
+        # If snippet_image_workers is 0 the images were made in this request, so they need saving
+        db.session.commit()
+
         # Refresh the cache when you edit a post
         # from blogcache import refresh_cache
         # refresh_cache()
@@ -542,6 +614,8 @@ def edit_post(post_id):
             # we background save
             return jsonify({'status': 'ok',
                             'submitUrl': url_for('.edit_post', post_id=post.id),
+                            'snippetStatusUrl': url_for('.snippet_image_status', post_id=post.id,
+                                                        job_id=snippet_job.id) if snippet_job else None,
                             'message': 'Post save successfully (background)'})
         
         flash('Post "{}" saved'.format(post.title), 'success')
@@ -590,38 +664,35 @@ def edit_post_tags(post_id):
     ], submit_text=None, form_type=easyforms.HORIZONTAL)
 
     if form.ready:
-        tags = form['tags']
-        tags = tags.split(',')
-        
-        for tag_name in tags:
-            tag_name = tag_name.strip()
-            if tag_name:
-                log.debug('Adding tag to post: %s' % tag_name)
-                # See if the tag already exists
-                tag_code = models.CmsTag.name_to_code(tag_name)
-
-                tag = db.session.query(
-                    models.CmsTag
-                ).filter(
-                    models.CmsTag.post_type == post.post_type,
-                    models.CmsTag.code == tag_code
-                ).first()
-
-                if tag:
-                    log.debug('Adding existing tag to post')
-                elif can_manage_tags:
-                    tag = models.CmsTag(post.post_type, tag_name)
-                    log.debug('Creating new tag')
-                else:
-                    log.debug('Not creating new tag - user doesn\'t have permission')
-                    flash('Not adding tag "{}" - you do not have permission to create new tags'.format(
-                        tag_name
-                    ), 'danger')
-                
-                if tag:
-                    flash('Tag {} added'.format(tag_name), 'success')
-                    post.tags.append(tag)
-
+        tag_names = split_tag_names(form['tags'])
+        # Look up all of the tags at once
+        tags_by_code = get_tags_by_code(post.post_type, tag_names)
+        tags_to_add = []
+
+        for tag_name in tag_names:
+            log.debug('Adding tag to post: %s' % tag_name)
+            tag = tags_by_code.get(models.CmsTag.name_to_code(tag_name))
+
+            if tag:
+                log.debug('Adding existing tag to post')
+            elif can_manage_tags:
+                tag = models.CmsTag(post.post_type, tag_name)
+                db.session.add(tag)
+                tags_by_code[tag.code] = tag
+                log.debug('Creating new tag')
+            else:
+                log.debug('Not creating new tag - user doesn\'t have permission')
+                flash('Not adding tag "{}" - you do not have permission to create new tags'.format(
+                    tag_name
+                ), 'danger')
+
+            if tag:
+                flash('Tag {} added'.format(tag_name), 'success')
+                tags_to_add.append(tag)
+
+        # The new tags need ids
+        db.session.flush()
+        bulktags.add_tags_to_posts([post.id], [tag.id for tag in tags_to_add], session=db.session)
         db.session.commit()
         form.clear()
 
@@ -636,29 +707,221 @@ def edit_post_tags(post_id):
         if not tag:
             flash('Tag doesn\'t exist', 'danger')
         else:
-            post.tags.remove(tag)
-    
+            bulktags.remove_tags_from_posts([post.id], [tag.id], session=db.session)
+            if can_manage_tags:
+                # Delete the tag if this was the last post with it
+                bulktags.delete_unused_tags([tag.id], session=db.session)
+
             db.session.commit()
-            # Check if there are any posts left with this tag
-            db.session.expire(tag)
-            if not tag.posts and can_manage_tags:
-                # TODO: this could leave orphaned tags!
-                db.session.delete(tag)
-                db.session.commit()
-            
-            db.session.refresh(post)
 
         flash('Tag deleted', 'success')
 
-    all_tags = db.session.query(
-        models.CmsTag
+    return render_template('easycms/edit_post_tags.html', form=form, post=post)
+
+
+@editor.route('/posts/<string:post_type>/autocomplete/tags')
+@accesscontrol.can_tag_post
+def autocomplete_tags(post_type):
+    """
+    Suggest tags for the tag editor.  Pass the partial tag name in the q parameter
+    """
+    term = request.args.get('q', '').strip()
+    if not term:
+        return jsonify({'results': []})
+
+    tags = db.session.query(
+        models.CmsTag.name, models.CmsTag.code
+    ).filter(
+        models.CmsTag.post_type == post_type,
+        # Special tags can't be assigned in the tag editor
+        models.CmsTag.tag_type.is_(None),
+        get_autocomplete_filter(models.CmsTag.name, term)
+    ).order_by(
+        *get_autocomplete_order(models.CmsTag.name, term)
+    ).limit(AUTOCOMPLETE_LIMIT).all()
+
+    return jsonify({'results': [{'name': name, 'code': code} for name, code in tags]})
+
+
+@editor.route('/posts/<string:post_type>/autocomplete/titles')
+@accesscontrol.can_edit_post
+def autocomplete_titles(post_type):
+    """
+    Suggest posts by title.  Pass the partial title in the q parameter
+    """
+    term = request.args.get('q', '').strip()
+    if not term:
+        return jsonify({'results': []})
+
+    posts = db.session.query(
+        models.CmsPost.id, models.CmsPost.title, models.CmsPost.code
+    ).filter(
+        models.CmsPost.post_type == post_type,
+        get_autocomplete_filter(models.CmsPost.title, term)
+    ).order_by(
+        *get_autocomplete_order(models.CmsPost.title, term)
+    ).limit(AUTOCOMPLETE_LIMIT).all()
+
+    return jsonify({'results': [
+        {
+            'id': post_id,
+            'title': title,
+            'code': code,
+            'editUrl': url_for('.edit_post', post_id=post_id)
+        }
+        for post_id, title, code in posts
+    ]})
+
+
+@editor.route('/tags', methods=['GET', 'POST'])
+@editor.route('/tags/<string:post_type>', methods=['GET', 'POST'])
+@accesscontrol.can_manage_tags
+def manage_tags(post_type=None):
+    """
+    Bulk tag operations: merge tags, rename a tag and add or remove tags on a selection of posts
+    """
+    if post_type is None:
+        post_type = easycms.post_types[0]
+    elif post_type not in easycms.post_types:
+        abort(404)
+
+    categories = db.session.query(
+        models.CmsCategory
     ).filter(
-        models.CmsTag.post_type == post.post_type
+        models.CmsCategory.post_type == post_type
     ).order_by(
-        models.CmsTag.name
+        models.CmsCategory.name
     ).all()
 
-    return render_template('easycms/edit_post_tags.html', form=form, post=post, all_tags=all_tags)
+    merge_form = Form([
+        easyforms.TextField('tags', required=True, help_text='Comma separated names of the tags to merge'),
+        easyforms.TextField('into', required=True, help_text='The tag to merge them into')
+    ], form_name='merge-tags', submit_text='Merge Tags', form_type=easyforms.VERTICAL)
+
+    rename_form = Form([
+        easyforms.TextField('tag', required=True),
+        easyforms.TextField('new-name', required=True,
+                            help_text='If there is already a tag with this name, the tags will be merged')
+    ], form_name='rename-tag', submit_text='Rename Tag', form_type=easyforms.VERTICAL)
+
+    retag_form = Form([
+        easyforms.ObjectListSelectField('category', categories, empty_option=True,
+                                        help_text='Select the posts in this category'),
+        easyforms.TextField('with-tag', help_text='And / or the posts with this tag'),
+        easyforms.ListSelectField('action', values=['Add', 'Remove'], required=True),
+        easyforms.TextField('tags', required=True, help_text='Comma separated names of the tags to add or remove')
+    ], form_name='retag-posts', submit_text='Update Posts', form_type=easyforms.VERTICAL)
+
+    if merge_form.ready:
+        tag_names = split_tag_names(merge_form['tags'])
+        tags_by_code = get_tags_by_code(post_type, tag_names + [merge_form['into']])
+        into_tag = tags_by_code.get(models.CmsTag.name_to_code(merge_form['into']))
+        tags = [tags_by_code.get(models.CmsTag.name_to_code(tag_name)) for tag_name in tag_names]
+
+        if not into_tag:
+            merge_form.set_error('into', 'Tag doesn\'t exist')
+        elif not all(tags):
+            merge_form.set_error('tags', 'Tags don\'t exist: {}'.format(', '.join(
+                tag_name for tag_name, tag in zip(tag_names, tags) if not tag
+            )))
+        else:
+            try:
+                num_posts = bulktags.merge_tags([tag.id for tag in tags], into_tag.id, session=db.session)
+            except ValueError as e:
+                merge_form.set_error('tags', str(e))
+            else:
+                db.session.commit()
+
+                flash('Merged {} tags into {} ({} posts updated)'.format(
+                    len(tags), into_tag.name, num_posts
+                ), 'success')
+                return redirect(url_for('.manage_tags', post_type=post_type))
+
+    if rename_form.ready:
+        tag = get_tags_by_code(post_type, [rename_form['tag']]).get(models.CmsTag.name_to_code(rename_form['tag']))
+
+        if not tag:
+            rename_form.set_error('tag', 'Tag doesn\'t exist')
+        else:
+            old_name = tag.name
+            try:
+                tag = bulktags.rename_tag(tag.id, rename_form['new-name'], session=db.session)
+            except ValueError as e:
+                rename_form.set_error('tag', str(e))
+            else:
+                db.session.commit()
+
+                flash('Tag {} renamed to {}'.format(old_name, tag.name), 'success')
+                return redirect(url_for('.manage_tags', post_type=post_type))
+
+    if retag_form.ready:
+        tag_names = split_tag_names(retag_form['tags'])
+        with_tag_names = [retag_form['with-tag']] if retag_form['with-tag'] else []
+        tags_by_code = get_tags_by_code(post_type, tag_names + with_tag_names)
+        with_tag = None
+        if with_tag_names:
+            with_tag = tags_by_code.get(models.CmsTag.name_to_code(retag_form['with-tag']))
+
+        tags = [tags_by_code.get(models.CmsTag.name_to_code(tag_name)) for tag_name in tag_names]
+
+        if not retag_form['category'] and not retag_form['with-tag']:
+            retag_form.set_error('category', 'Select a category and / or a tag')
+        elif retag_form['with-tag'] and not with_tag:
+            retag_form.set_error('with-tag', 'Tag doesn\'t exist')
+        elif not all(tags):
+            retag_form.set_error('tags', 'Tags don\'t exist: {}'.format(', '.join(
+                tag_name for tag_name, tag in zip(tag_names, tags) if not tag
+            )))
+        else:
+            query = db.session.query(
+                models.CmsPost.id
+            ).filter(
+                models.CmsPost.post_type == post_type
+            )
+
+            if retag_form['category']:
+                query = query.filter(models.CmsPost.category_id == retag_form['category'].id)
+
+            if with_tag:
+                query = query.filter(models.CmsPost.tags.any(models.CmsTag.id == with_tag.id))
+
+            post_ids = [post_id for post_id, in query]
+            tag_ids = [tag.id for tag in tags]
+
+            if retag_form['action'] == 'Add':
+                num_changed = bulktags.add_tags_to_posts(post_ids, tag_ids, session=db.session)
+                message = 'Added {} tags to {} posts'
+            else:
+                num_changed = bulktags.remove_tags_from_posts(post_ids, tag_ids, session=db.session)
+                message = 'Removed {} tags from {} posts'
+
+            db.session.commit()
+
+            flash(message.format(num_changed, len(post_ids)), 'success')
+            return redirect(url_for('.manage_tags', post_type=post_type))
+
+    tag_search = request.args.get('q', '').strip()
+    post_tag = models.CmsPost.tags.property.secondary
+    num_posts = sqlalchemy.select([
+        func.count()
+    ]).where(
+        post_tag.c.tag_id == models.CmsTag.id
+    ).as_scalar()
+
+    query = db.session.query(
+        models.CmsTag, num_posts.label('num_posts')
+    ).filter(
+        models.CmsTag.post_type == post_type
+    )
+
+    if tag_search:
+        query = query.filter(get_autocomplete_filter(models.CmsTag.name, tag_search))
+
+    query = query.order_by(models.CmsTag.name)
+    pager = SimplePager(50, request.args.get('page', 1), query)
+
+    return render_template('easycms/manage_tags.html', post_type=post_type, pager=pager, tag_search=tag_search,
+                           merge_form=merge_form, rename_form=rename_form, retag_form=retag_form)
 
 
 @editor.route('/posts/<int:post_id>/seo', methods=['GET', 'POST'])
@@ -717,6 +980,7 @@ def edit_post_publish_date(post_id):
 
     if form.ready:
         post.published = timetool.to_utc_time(datetime.datetime.combine(form['date'], form['time']))
+        relatedposts.update_related_posts_if_changed(post, session=db.session)
         db.session.commit()
         flash('Published date updated', 'success')
         return redirect(url_for('.edit_post', post_id=post.id))
@@ -801,7 +1065,7 @@ def edit_post_snippet(post_id):
     # Always update the image if it's in the request
     if 'image' in request.form and request.form['image']:
         image_url = request.form['image']
-        post.snippet_image = cmsutil.process_and_save_snippet_image(image_url)
+        post.snippet_image = cmsutil.process_and_save_snippet_image(image_url, post=post)
 
         updated = True
 
@@ -824,6 +1088,29 @@ def edit_post_snippet(post_id):
     return render_template('easycms/edit_post_snippet.html', post=post, form=form)
 
 
+@editor.route('/posts/<int:post_id>/snippet/status')
+@accesscontrol.can_edit_post
+@snippet_view
+def snippet_image_status(post_id):
+    """
+    Poll the status of a background snippet image job.  If no job id is given, the latest job for the
+    post is used.  Jobs are only known by the process that queued them, so if this request is handled by
+    another process the status is DONE if the post has a snippet image, otherwise None
+    """
+    job_id = request.args.get('job_id')
+    job = snippetworker.get_job(job_id) if job_id else snippetworker.get_latest_job_for_post(post_id)
+
+    if job is None or job.post_id != post_id:
+        post = db.session.query(models.CmsPost).filter(models.CmsPost.id == post_id).one_or_none()
+        if not post:
+            abort(404)
+
+        return jsonify({'status': snippetworker.DONE if post.snippet_image else None,
+                        'snippetImage': post.snippet_image})
+
+    return jsonify(job.to_json())
+
+
 @editor.route('/posts/<int:post_id>/snippet/add-snippet-image', methods=['GET', 'POST'])
 @accesscontrol.can_edit_post
 @snippet_view
@@ -837,31 +1124,16 @@ def add_snippet_image(post_id):
     ], label_width=2, form_type=easyforms.HORIZONTAL)
 
     if form.ready:
-        image = form['snippet-image']
         # Get the form field and extract the original filename
         image_field = form.get_field('snippet-image')
         original_filename = image_field.filename
         extension = original_filename.split('.')[-1]
-        settings = get_settings()
 
-        filename = 'sn-%s.%s' % (timetool.unix_time(), extension)
-        full_path = os.path.join(settings.snippet_image_file_path, filename)
-        fm_path = full_path.replace(flaskfilemanager.filemanager.get_root_path() + '/', '')
+        fm_path = cmsutil.save_snippet_image(image_field.raw_image_data, extension, pad_when_tall=True)
+        variants = cmsutil.save_snippet_image_variants(image_field.raw_image_data, extension, pad_when_tall=True)
 
-        cropped_image = imageutil.resize_crop_image(image, settings.snippet_image_width,
-                                                    settings.snippet_image_height,
-                                                    pad_when_tall=True)
-
-        log.info('Saving snippet image to %s' % full_path)
-        cropped_image.save(
-            full_path, quality=settings.pil_saved_image_quality,
-            subsampling=settings.pil_saved_image_subsampling,
-            compress_level=settings.pil_saved_image_compression_level
-        )
-
-        url = url_for('flaskfilemanager.userfile', filename=fm_path, _external=True, _scheme=request.scheme)
-
-        post.snippet_image = url
+        post.snippet_image = cmsutil.get_userfile_url(fm_path)
+        post.snippet_image_variants = post.make_image_variants(post.snippet_image, variants)
         db.session.commit()
 
         flash('Snippet image updated', 'success')
@@ -961,10 +1233,13 @@ def delete_post(post_id):
         abort(404)
 
     if request.method == 'POST':
+        tag_ids = [tag.id for tag in post.tags]
         post.tags = []
         for revision in post.revisions:
             db.session.delete(revision)
         db.session.delete(post)
+        # Remove it from the related posts of the posts that shared its tags
+        relatedposts.update_related_posts([], tag_ids=tag_ids, session=db.session)
         db.session.commit()
 
         flash('Post deleted', 'success')
@@ -1158,3 +1433,39 @@ def edit_author(author_code=None):
                 raise e
 
     return render_template('easycms/edit_author.html', author=author, form=form)
+
+
+@editor.cli.command('cleanup-snippet-images')
+@click.option('--dry-run', is_flag=True, help='List the orphaned files without deleting them')
+@click.option('--min-age', default=3600, help='Ignore files modified less than this many seconds ago')
+def cleanup_snippet_images(dry_run, min_age):
+    """
+    Delete generated snippet images and main image variants that are not used by any post
+    """
+    orphans = datautil.delete_orphaned_snippet_images(min_age=min_age, dry_run=dry_run)
+
+    for path in orphans:
+        click.echo(path)
+
+    click.echo('{} {} orphaned snippet images'.format('Found' if dry_run else 'Deleted', len(orphans)))
+
+
+@editor.cli.command('rebuild-related-posts')
+def rebuild_related_posts():
+    """
+    Recalculate the related posts of every post
+    """
+    num_posts = relatedposts.rebuild_all_related_posts(session=db.session)
+    db.session.commit()
+
+    click.echo('Recalculated the related posts of {} posts'.format(num_posts))
+
+
+@editor.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """
+    Rebuild the full text search vectors of every post
+    """
+    num_posts = search.rebuild_search_vectors(session=db.session)
+
+    click.echo('Rebuilt the search vectors of {} posts'.format(num_posts))
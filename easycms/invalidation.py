@@ -0,0 +1,284 @@
+"""
+Cross-process cache invalidation using PostgreSQL LISTEN / NOTIFY.
+
+Whenever posts, pages, tags, categories, authors or comments are saved, a notification is sent on
+settings.cache_invalidation_channel in the same transaction, so it is only delivered if the transaction
+commits.  Each process that uses a cache runs a listener thread with its own database connection, which
+passes the notifications on to the handlers registered by the caches so that they can evict the stale
+entries.  This keeps the in-process caches of every worker, on every host, up to date.  The handlers are
+also called in the process that made the change as soon as the session commits, so it never sees its
+own stale content.
+
+The listener thread is started the first time a cache is used in each process, so it works with servers
+that fork worker processes after the application has been initialised.  If the listener connection is
+lost the caches are cleared once it reconnects, as notifications may have been missed.  Notifications
+are only sent, and the listener only started, if cache_invalidation_channel is set
+"""
+
+import logging
+import os
+import select
+import threading
+import time
+
+from sqlalchemy import event, text, bindparam, String
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from . import models
+from .settings import get_settings
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+# Kinds of object.  The notification payload is '<kind>:<key>', or just '<kind>' for all objects of that kind
+POST = 'post'
+PAGE = 'page'
+TAG = 'tag'
+CATEGORY = 'category'
+AUTHOR = 'author'
+COMMENT = 'comment'
+
+# Seconds to wait for notifications before checking that the listener connection is still alive
+POLL_TIMEOUT = 30
+# Seconds to wait before reconnecting after the listener connection fails
+RECONNECT_DELAY = 5
+# Seconds to wait for the listener to connect when it is started
+CONNECT_TIMEOUT = 5
+
+# Key in session.info of the payloads that have been sent in the current transaction
+PENDING_PAYLOADS_KEY = 'easycms_cache_invalidation_payloads'
+
+# Maps kind to a list of functions that take the key (or None for all objects of that kind)
+_handlers = {}
+
+_engine = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def register_handler(kind, handler):
+    """
+    Register a function that is called whenever objects of a kind change in any process
+
+    :param kind: POST, PAGE, TAG, CATEGORY, AUTHOR or COMMENT
+    :param handler: Function that takes the key of the object that has changed (a str), or None if any
+                    of the objects may have changed.  Called from the listener thread, and from the thread
+                    that made the change when its session commits
+    """
+    handlers = _handlers.setdefault(kind, [])
+    if handler not in handlers:
+        handlers.append(handler)
+
+
+def _get_changes(obj):
+    """
+    :return: (kind, key) for the object, or None if changes to this object don't need to be notified
+    """
+    if isinstance(obj, models.CmsPost):
+        return POST, obj.id
+    elif isinstance(obj, models.CmsPage):
+        return PAGE, obj.code
+    elif isinstance(obj, models.CmsPublishedPage):
+        return PAGE, obj.page.code
+    elif isinstance(obj, models.CmsTag):
+        return TAG, obj.id
+    elif isinstance(obj, models.CmsCategory):
+        return CATEGORY, obj.id
+    elif isinstance(obj, models.CmsAuthor):
+        return AUTHOR, obj.id
+    elif isinstance(obj, models.CmsComment):
+        return COMMENT, obj.post_id
+
+    return None
+
+
+def _make_payload(kind, key=None):
+    return kind if key is None else '{}:{}'.format(kind, key)
+
+
+def _send(session, payloads):
+    if not payloads:
+        return
+
+    # These are passed to the handlers in this process when the session commits
+    session.info.setdefault(PENDING_PAYLOADS_KEY, set()).update(payloads)
+
+    channel = get_settings().cache_invalidation_channel
+    if not channel:
+        return
+
+    log.debug('Sending cache invalidation notifications: {}'.format(', '.join(payloads)))
+
+    session.connection().execute(
+        text(
+            'SELECT pg_notify(:channel, payload) FROM unnest(:payloads) AS payload'
+        ).bindparams(
+            bindparam('payloads', type_=ARRAY(String))
+        ),
+        channel=channel, payloads=sorted(payloads)
+    )
+
+
+def notify(session, kind, key=None):
+    """
+    Send a notification that objects have changed.  Changes made through the ORM are notified
+    automatically, so this is only needed after bulk updates.  The notification is delivered when the
+    session commits
+
+    :param kind: POST, PAGE, TAG, CATEGORY, AUTHOR or COMMENT
+    :param key: The key of the object that has changed, or None if any objects of this kind may have changed
+    """
+    _send(session, {_make_payload(kind, key)})
+
+
+def _after_flush(session, flush_context):
+    payloads = set()
+
+    for obj in session.deleted:
+        changes = _get_changes(obj)
+        if changes:
+            payloads.add(_make_payload(*changes))
+
+    for obj in list(session.new) + list(session.dirty):
+        if obj not in session.new and not session.is_modified(obj):
+            continue
+
+        changes = _get_changes(obj)
+        if changes:
+            payloads.add(_make_payload(*changes))
+
+    _send(session, payloads)
+
+
+def _after_commit(session):
+    for payload in sorted(session.info.pop(PENDING_PAYLOADS_KEY, ())):
+        _handle_payload(payload)
+
+
+def _after_rollback(session):
+    session.info.pop(PENDING_PAYLOADS_KEY, None)
+
+
+def _dispatch(kind, key):
+    for handler in _handlers.get(kind, []):
+        try:
+            handler(key)
+        except Exception:
+            log.exception('Cache invalidation handler failed for {} {}'.format(kind, key))
+
+
+def _dispatch_all():
+    for kind in list(_handlers.keys()):
+        _dispatch(kind, None)
+
+
+def _handle_payload(payload):
+    kind, _, key = payload.partition(':')
+    log.debug('Received cache invalidation notification: {}'.format(payload))
+    _dispatch(kind, key or None)
+
+
+def _connect(channel):
+    # This connection is only used for listening, so it is detached from the pool
+    connection = _engine.raw_connection()
+    connection.detach()
+
+    dbapi_connection = connection.connection
+    dbapi_connection.autocommit = True
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute('LISTEN "{}"'.format(channel.replace('"', '""')))
+    cursor.close()
+
+    return connection, dbapi_connection
+
+
+def _listen(channel, listening):
+    """
+    :param listening: threading.Event that is set once the listener has connected
+    """
+    log.info('Listening for cache invalidation notifications on {}'.format(channel))
+
+    first_attempt = True
+
+    while True:
+        connection = None
+
+        try:
+            connection, dbapi_connection = _connect(channel)
+
+            if not first_attempt:
+                # Notifications may have been missed while we weren't connected
+                _dispatch_all()
+
+            listening.set()
+
+            while True:
+                readable, _, _ = select.select([dbapi_connection], [], [], POLL_TIMEOUT)
+
+                if not readable:
+                    # Make sure the connection is still alive
+                    dbapi_connection.cursor().execute('SELECT 1')
+                    continue
+
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    _handle_payload(dbapi_connection.notifies.pop(0).payload)
+
+        except Exception:
+            log.exception('Cache invalidation listener failed.  Reconnecting in {}s'.format(RECONNECT_DELAY))
+        finally:
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+        first_attempt = False
+        time.sleep(RECONNECT_DELAY)
+
+
+def ensure_listener():
+    """
+    Start the listener thread for this process, if it isn't already running.  Called by the caches
+    whenever they are used
+    """
+    global _listener_pid
+
+    pid = os.getpid()
+    if _listener_pid == pid:
+        return
+
+    channel = get_settings().cache_invalidation_channel
+    if not channel or _engine is None:
+        return
+
+    with _listener_lock:
+        if _listener_pid == pid:
+            return
+
+        # Threads aren't copied when a process forks, so each process needs to start its own
+        listening = threading.Event()
+        thread = threading.Thread(target=_listen, args=(channel, listening), name='easycms-cache-invalidation',
+                                  daemon=True)
+        thread.start()
+        _listener_pid = pid
+
+        # Wait until it is listening, so that no changes are missed
+        if not listening.wait(CONNECT_TIMEOUT):
+            log.warning('Cache invalidation listener has not connected after {}s'.format(CONNECT_TIMEOUT))
+
+
+def init(bind):
+    """
+    :param bind: The engine or connection passed into easycms.init(...)
+    """
+    global _engine
+
+    _engine = bind.engine
+
+    if not event.contains(models.Session, 'after_flush', _after_flush):
+        event.listen(models.Session, 'after_flush', _after_flush)
+        event.listen(models.Session, 'after_commit', _after_commit)
+        event.listen(models.Session, 'after_rollback', _after_rollback)
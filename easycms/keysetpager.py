@@ -0,0 +1,168 @@
+"""
+Keyset (seek) pagination.  Instead of using OFFSET, each page carries on from the sort key of the last
+item on the previous page, so the thousandth page costs the same to load as the first
+"""
+
+import logging
+import datetime
+import json
+import base64
+import binascii
+
+import sqlalchemy
+from flask import request, url_for, Markup
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+NEXT = 'n'
+PREV = 'p'
+
+
+def encode_cursor(direction, sort_value, item_id):
+    """
+    :param direction: NEXT to load the items after this key, or PREV to load the items before it
+    :param sort_value: The value of the sort column (a datetime or a number)
+    :param item_id: The id of the item, used to break ties
+    :return: An opaque, url safe cursor string
+    """
+    if isinstance(sort_value, datetime.datetime):
+        sort_value = sort_value.isoformat()
+
+    data = json.dumps([direction, sort_value, item_id])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    :return: Tuple of (direction, sort_value, item_id) or None if the cursor is invalid
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, sort_value, item_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if direction not in (NEXT, PREV):
+            return None
+
+        if isinstance(sort_value, str):
+            sort_value = datetime.datetime.fromisoformat(sort_value)
+        else:
+            sort_value = float(sort_value)
+
+        return direction, sort_value, int(item_id)
+    except (ValueError, TypeError, binascii.Error, UnicodeError):
+        return None
+
+
+class KeysetPager(object):
+    """
+    Pages through a query which is sorted by a datetime (or numeric) column and then by id (newest first,
+    unless ascending is set).  Pages are identified by cursors rather than page numbers, so there are only ever
+    next and previous links
+    """
+
+    def __init__(self, page_size, cursor, query, sort_column, id_column, get_key, ascending=False):
+        """
+        :param page_size: Number of items per page
+        :param cursor: Cursor from a previous page (next_cursor or prev_cursor) or None for the first page.
+                       An invalid cursor will load the first page
+        :param query: The SQLAlchemy query.  Any existing ordering will be replaced
+        :param sort_column: Column (or expression) that the results are sorted on
+        :param id_column: The primary key column, used to break ties
+        :param get_key: Function that takes an item and returns a tuple of (sort value, id) for that item
+        :param ascending: Set to True to sort oldest first
+        """
+        self.page_size = page_size
+        self.cursor = cursor
+        self.query = query
+        self.get_key = get_key
+
+        decoded = decode_cursor(cursor) if cursor else None
+        if cursor and not decoded:
+            log.warning('Invalid pager cursor: {}'.format(cursor))
+
+        query = query.order_by(None)
+
+        if ascending:
+            forward_order = (sort_column, id_column)
+            reverse_order = (sort_column.desc(), id_column.desc())
+        else:
+            forward_order = (sort_column.desc(), id_column.desc())
+            reverse_order = (sort_column, id_column)
+
+        if decoded is None:
+            direction = NEXT
+            items = query.order_by(*forward_order).limit(page_size + 1).all()
+        else:
+            direction, sort_value, item_id = decoded
+            key = sqlalchemy.tuple_(sort_column, id_column)
+            cursor_key = sqlalchemy.tuple_(sort_value, item_id)
+            # Load the items after the cursor (in the direction we're going), in the order we're going
+            if (direction == NEXT) == ascending:
+                condition = key > cursor_key
+            else:
+                condition = key < cursor_key
+
+            items = query.filter(
+                condition
+            ).order_by(
+                *(forward_order if direction == NEXT else reverse_order)
+            ).limit(page_size + 1).all()
+
+        more = len(items) > page_size
+        items = items[:page_size]
+
+        if direction == NEXT:
+            self.has_prev = decoded is not None
+            self.has_next = more
+        else:
+            items.reverse()
+            self.has_prev = more
+            self.has_next = True
+
+        self.items = items
+
+    @property
+    def empty(self):
+        return not self.items
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+
+        return encode_cursor(NEXT, *self.get_key(self.items[-1]))
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or not self.items:
+            return None
+
+        return encode_cursor(PREV, *self.get_key(self.items[0]))
+
+    def get_full_page_url(self, cursor, scheme=None):
+        """Get the full, external URL for the page with the given cursor (None for the first page)"""
+        args = dict(
+            request.view_args,
+            _external=True,
+        )
+
+        if scheme is not None:
+            args['_scheme'] = scheme
+
+        if cursor is not None:
+            args['cursor'] = cursor
+
+        return url_for(request.endpoint, **args)
+
+    def render_prev_next_links(self, scheme=None):
+        """Render the rel=prev and rel=next links to a Markup object for injection into a template"""
+        output = ''
+
+        if self.prev_cursor:
+            output += '<link rel="prev" href="{}" />\n'.format(self.get_full_page_url(self.prev_cursor, scheme=scheme))
+
+        if self.next_cursor:
+            output += '<link rel="next" href="{}" />\n'.format(self.get_full_page_url(self.next_cursor, scheme=scheme))
+
+        return Markup(output)
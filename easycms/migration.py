@@ -5,10 +5,14 @@ Tools for migrating between database versions
 import logging
 
 import sqlalchemy.exc
+from sqlalchemy.schema import CreateIndex
 
 import easycms
 from .models import db
 from . import models
+from . import cmsutil
+from . import relatedposts
+from . import search
 
 __author__ = 'Stephen Brown (Little Fish Solutions LTD)'
 
@@ -158,6 +162,66 @@ WHERE table_name='{table_name}'
     return bool(rows)
 
 
+def get_autocommit_connection():
+    """
+    :return: A new connection in autocommit mode, for statements that can't run inside a transaction
+    """
+    return easycms.bind.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+
+def create_index_concurrently(index):
+    """
+    Create an index using CREATE INDEX CONCURRENTLY so that writes to the table aren't blocked while the
+    index is built.  Does nothing if the index already exists.  If a previous attempt failed and left an
+    invalid index behind, it will be dropped and rebuilt
+
+    :param index: The sqlalchemy Index object to create
+    """
+    # Any open transaction on the table would block the index build forever
+    db.session.commit()
+
+    sql = str(CreateIndex(index).compile(dialect=easycms.bind.dialect))
+    sql = sql.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS', 1)
+
+    connection = get_autocommit_connection()
+    try:
+        invalid = connection.execute(sqlalchemy.text(
+            'SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE c.relname = :name AND NOT i.indisvalid'
+        ), name=index.name).fetchall()
+
+        if invalid:
+            log.info('Dropping invalid index {} left by a previous failed build'.format(index.name))
+            connection.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(index.name))
+
+        connection.execute(sql)
+    finally:
+        connection.close()
+
+
+def get_index(table, name):
+    """
+    Look up one of the indexes declared on a table.  Migrations name the indexes they create explicitly,
+    as later versions may declare more indexes on the same table
+
+    :param table: The sqlalchemy Table
+    :param name: The name of the index without the table name, i.e. 'published_idx'
+    """
+    full_name = '{}_{}'.format(table.name, name)
+
+    for index in table.indexes:
+        if index.name == full_name:
+            return index
+
+    raise ValueError('Table {} has no index {}'.format(table.name, full_name))
+
+
+def create_indexes_concurrently(indexes):
+    for index in indexes:
+        log.info('> Creating index {} (this may take a while on large tables)'.format(index.name))
+        create_index_concurrently(index)
+
+
 def update_database(current_db_version):
     """
     Update the schema and add any missing data
@@ -165,15 +229,51 @@ def update_database(current_db_version):
     if current_db_version.major_version != 0:
         raise Exception('Major version > 0 not implemented!')
 
-    if current_db_version.minor_version == 0:
+    minor_version = current_db_version.minor_version
+
+    # Each step updates the version in the database, so run every step after the current version
+    if minor_version <= 0:
         migrate_0_0_to_0_1()
 
-    if current_db_version.minor_version == 1:
+    if minor_version <= 1:
         migrate_0_1_to_0_2()
 
-    if current_db_version.minor_version == 2:
+    if minor_version <= 2:
         migrate_0_2_to_0_3()
 
+    if minor_version <= 3:
+        migrate_0_3_to_0_4()
+
+    if minor_version <= 4:
+        migrate_0_4_to_0_5()
+
+    if minor_version <= 5:
+        migrate_0_5_to_0_6()
+
+    if minor_version <= 6:
+        migrate_0_6_to_0_7()
+
+    if minor_version <= 7:
+        migrate_0_7_to_0_8()
+
+    if minor_version <= 8:
+        migrate_0_8_to_0_9()
+
+    if minor_version <= 9:
+        migrate_0_9_to_0_10()
+
+    if minor_version <= 10:
+        migrate_0_10_to_0_11()
+
+    if minor_version <= 11:
+        migrate_0_11_to_0_12()
+
+    if minor_version <= 12:
+        migrate_0_12_to_0_13()
+
+    if minor_version <= 13:
+        migrate_0_13_to_0_14()
+
     log.info('Update Complete!')
 
 
@@ -376,3 +476,261 @@ def migrate_0_2_to_0_3():
     db.session.commit()
 
 
+def migrate_0_3_to_0_4():
+    log.info('Updating from v0.3.X to v0.4.X')
+
+    # Add columns to store values derived from the post content
+    log.info('> Adding derived content columns to post table')
+
+    for column_name, column_type in [
+        ('content_description', 'CHARACTER VARYING'),
+        ('content_word_count', 'INTEGER'),
+        ('content_images', 'CHARACTER VARYING[]')
+    ]:
+        try:
+            add_column('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                models.CmsPost.__tablename__, column_name, column_type
+            ))
+        except ColumnAlreadyExists:
+            log.info('Column {} already exists - skipping'.format(column_name))
+
+    db.session.commit()
+
+    # Calculate the values for all existing posts.  This is done in batches to avoid loading the
+    # content of every post into memory at once
+    log.info('> Calculating derived content for existing posts')
+    batch_size = 100
+    num_updated = 0
+
+    # Only the columns that exist at this version are loaded, as later versions add more columns to CmsPost
+    post_table = models.CmsPost.__table__
+
+    while True:
+        posts = db.session.query(
+            post_table.c.id, post_table.c.content
+        ).filter(
+            post_table.c.content_word_count == None
+        ).order_by(
+            post_table.c.id
+        ).limit(batch_size).all()
+
+        if not posts:
+            break
+
+        for post_id, content in posts:
+            soup = cmsutil.parse_html(content)
+            db.session.execute(post_table.update().where(post_table.c.id == post_id).values(
+                content_description=cmsutil.get_description(soup),
+                content_word_count=cmsutil.get_word_count(soup),
+                content_images=cmsutil.get_image_urls(soup)
+            ))
+
+        db.session.commit()
+        num_updated += len(posts)
+        log.info('> > Updated {} posts'.format(num_updated))
+
+    # Update the version
+    log.info('Updating DB Version to 0.4.X')
+    current_db_version = models.CmsVersionHistory(0, 4)
+    db.session.add(current_db_version)
+    db.session.commit()
+
+
+def migrate_0_4_to_0_5():
+    log.info('Updating from v0.4.X to v0.5.X')
+
+    # Indexes for the front end post and tag queries
+    post_tag_table = models.CmsPost.tags.property.secondary
+
+    create_indexes_concurrently([
+        get_index(models.CmsPost.__table__, 'published_idx'),
+        get_index(models.CmsPost.__table__, 'category_published_idx'),
+        get_index(models.CmsTag.__table__, 'tag_type_idx'),
+        get_index(post_tag_table, 'post_id_idx'),
+        get_index(post_tag_table, 'tag_id_idx')
+    ])
+
+    # Update the version
+    log.info('Updating DB Version to 0.5.X')
+    current_db_version = models.CmsVersionHistory(0, 5)
+    db.session.add(current_db_version)
+    db.session.commit()
+
+
+def migrate_0_5_to_0_6():
+    log.info('Updating from v0.5.X to v0.6.X')
+
+    log.info('> Adding comment count columns to post table')
+
+    for column_name in ['num_approved_comments', 'num_pending_comments']:
+        try:
+            add_column('ALTER TABLE {} ADD COLUMN {} INTEGER DEFAULT 0 NOT NULL'.format(
+                models.CmsPost.__tablename__, column_name
+            ))
+        except ColumnAlreadyExists:
+            log.info('Column {} already exists - skipping'.format(column_name))
+
+    log.info('> Counting comments on existing posts')
+    db.session.execute('''
+UPDATE {post} SET
+    num_approved_comments = (
+        SELECT count(*) FROM {comment} c
+        WHERE c.post_id = {post}.id AND c.approved AND NOT c.deleted
+    ),
+    num_pending_comments = (
+        SELECT count(*) FROM {comment} c
+        WHERE c.post_id = {post}.id AND NOT c.approved AND NOT c.deleted
+    )
+'''.format(post=models.CmsPost.__tablename__, comment=models.CmsComment.__tablename__))
+
+    # Update the version
+    log.info('Updating DB Version to 0.6.X')
+    current_db_version = models.CmsVersionHistory(0, 6)
+    db.session.add(current_db_version)
+    db.session.commit()
+
+
+def migrate_0_6_to_0_7():
+    log.info('Updating from v0.6.X to v0.7.X')
+
+    # Indexes for paging through comments and loading replies
+    create_indexes_concurrently([
+        get_index(models.CmsComment.__table__, 'post_id_timestamp_idx'),
+        get_index(models.CmsComment.__table__, 'reply_to_id_idx')
+    ])
+
+    # Update the version
+    log.info('Updating DB Version to 0.7.X')
+    current_db_version = models.CmsVersionHistory(0, 7)
+    db.session.add(current_db_version)
+    db.session.commit()
+
+
+def migrate_0_7_to_0_8():
+    log.info('Updating from v0.7.X to v0.8.X')
+
+    # Index for the site wide comment rate limit
+    create_indexes_concurrently([
+        get_index(models.CmsComment.__table__, 'author_ip_timestamp_idx')
+    ])
+
+    # Update the version
+    log.info('Updating DB Version to 0.8.X')
+    current_db_version = models.CmsVersionHistory(0, 8)
+    db.session.add(current_db_version)
+    db.session.commit()
+
+
+def migrate_0_8_to_0_9():
+    log.info('Updating from v0.8.X to v0.9.X')
+
+    log.info('> Adding image variant columns to post table')
+
+    for column_name in ['snippet_image_variants', 'main_image_variants']:
+        try:
+            add_column('ALTER TABLE {} ADD COLUMN {} JSONB'.format(models.CmsPost.__tablename__, column_name))
+        except ColumnAlreadyExists:
+            log.info('Column {} already exists - skipping'.format(column_name))
+
+    # Update the version
+    log.info('Updating DB Version to 0.9.X')
+    current_db_version = models.CmsVersionHistory(0, 9)
+    db.session.add(current_db_version)
+    db.session.commit()
+
+
+def migrate_0_9_to_0_10():
+    log.info('Updating from v0.9.X to v0.10.X')
+
+    # Index for sorting posts by published date, or created date for unpublished posts
+    create_indexes_concurrently([
+        get_index(models.CmsPost.__table__, 'published_or_created_idx')
+    ])
+
+    # Update the version
+    log.info('Updating DB Version to 0.10.X')
+    current_db_version = models.CmsVersionHistory(0, 10)
+    db.session.add(current_db_version)
+    db.session.commit()
+
+
+def migrate_0_10_to_0_11():
+    log.info('Updating from v0.10.X to v0.11.X')
+
+    log.info('> Creating related post table')
+    models.CmsRelatedPost.__table__.create(checkfirst=True)
+
+    log.info('> Calculating related posts')
+    relatedposts.rebuild_all_related_posts(session=db.session)
+
+    # Update the version
+    log.info('Updating DB Version to 0.11.X')
+    current_db_version = models.CmsVersionHistory(0, 11)
+    db.session.add(current_db_version)
+    db.session.commit()
+
+
+def migrate_0_11_to_0_12():
+    log.info('Updating from v0.11.X to v0.12.X')
+
+    log.info('> Adding search vector column to post table')
+    try:
+        add_column('ALTER TABLE {} ADD COLUMN search_vector TSVECTOR'.format(models.CmsPost.__tablename__))
+    except ColumnAlreadyExists:
+        log.info('Column search_vector already exists - skipping')
+
+    db.session.commit()
+
+    # Only posts without a search vector are updated, so this can carry on from where it stopped if it
+    # is interrupted
+    log.info('> Building search vectors for existing posts')
+    search.rebuild_search_vectors(only_missing=True, session=db.session)
+
+    # Index for full text search
+    create_indexes_concurrently([
+        get_index(models.CmsPost.__table__, 'search_vector_idx')
+    ])
+
+    # Update the version
+    log.info('Updating DB Version to 0.12.X')
+    current_db_version = models.CmsVersionHistory(0, 12)
+    db.session.add(current_db_version)
+    db.session.commit()
+
+
+def migrate_0_12_to_0_13():
+    log.info('Updating from v0.12.X to v0.13.X')
+
+    log.info('> Installing pg_trgm extension')
+    models.create_extensions()
+
+    # Indexes for the autocomplete and for checking for duplicate titles
+    create_indexes_concurrently([
+        get_index(models.CmsTag.__table__, 'name_trgm_idx'),
+        get_index(models.CmsPost.__table__, 'title_trgm_idx'),
+        get_index(models.CmsPost.__table__, 'lower_title_idx')
+    ])
+
+    # Update the version
+    log.info('Updating DB Version to 0.13.X')
+    current_db_version = models.CmsVersionHistory(0, 13)
+    db.session.add(current_db_version)
+    db.session.commit()
+
+
+def migrate_0_13_to_0_14():
+    log.info('Updating from v0.13.X to v0.14.X')
+
+    # The titles and taglines are now unidecoded in the search vectors, like the content
+    log.info('> Rebuilding search vectors')
+    search.rebuild_search_vectors(session=db.session)
+
+    # Unpublished posts are no longer related posts
+    log.info('> Rebuilding related posts')
+    relatedposts.rebuild_all_related_posts(session=db.session)
+
+    # Update the version
+    log.info('Updating DB Version to 0.14.X')
+    current_db_version = models.CmsVersionHistory(0, 14)
+    db.session.add(current_db_version)
+    db.session.commit()
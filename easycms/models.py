@@ -4,18 +4,20 @@ Contains SQLAlchemy models for the CMS
 
 import logging
 import datetime
-import re
+from collections import OrderedDict
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, BigInteger, String, DateTime, ForeignKey, Table, UniqueConstraint,\
-    Boolean, Integer
-from sqlalchemy.orm import relationship, backref, sessionmaker
-from sqlalchemy.sql import func
+    Boolean, Integer, Index, Float
+from sqlalchemy.orm import relationship, backref, sessionmaker, scoped_session, validates, object_session,\
+    deferred
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TSVECTOR
+from sqlalchemy.sql import func, select, and_, literal
+from sqlalchemy import event, inspect
 from titlecase import titlecase
-from bs4 import BeautifulSoup
-from unidecode import unidecode
 from flask import url_for, request
 from littlefish import timetool
+from unidecode import unidecode
 
 from .settings import get_settings, get_page_defs
 import easycms
@@ -38,20 +40,24 @@ class Db(object):
 Model = None
 # Sessionmaker
 Session = None
-# Session
+# Session.  If scoped sessions are enabled this will be a scoped_session, which proxies all calls to a
+# separate session for each thread
 session = None
 # DB object (to make the code look like flask-sqlalchemy code!)
 db = Db()
 
 
-def init(table_prefix, metadata, bind):
+def init(table_prefix, metadata, bind, scoped=False):
     global Model, CmsUser, CmsCategory, CmsTag, CmsPost, CmsPostRevision, CmsComment,\
         CmsPage, CmsPageRevision, CmsVersionHistory, CmsAuthor, Session, session, db,\
-        CmsPublishedPage, CmsPublishedPageRevision
+        CmsPublishedPage, CmsPublishedPageRevision, CmsRelatedPost
 
     Model = declarative_base(bind=bind, metadata=metadata)
     Session = sessionmaker(bind=bind)
-    session = Session()
+    if scoped:
+        session = scoped_session(Session)
+    else:
+        session = Session()
 
     prefix = '{}_'.format(table_prefix)
 
@@ -59,7 +65,9 @@ def init(table_prefix, metadata, bind):
     cms_post_cms_tag = Table(prefix + 'post_' + prefix + 'tag',
                              Model.metadata,
                              Column('post_id', BigInteger, ForeignKey(prefix + 'post.id')),
-                             Column('tag_id', BigInteger, ForeignKey(prefix + 'tag.id')))
+                             Column('tag_id', BigInteger, ForeignKey(prefix + 'tag.id')),
+                             Index(prefix + 'post_' + prefix + 'tag_post_id_idx', 'post_id'),
+                             Index(prefix + 'post_' + prefix + 'tag_tag_id_idx', 'tag_id', 'post_id'))
 
     class CmsAuthor(Model):
         __tablename__ = prefix + 'author'
@@ -145,7 +153,11 @@ def init(table_prefix, metadata, bind):
         
         __table_args__ = (
             UniqueConstraint(post_type, name),
-            UniqueConstraint(post_type, code)
+            UniqueConstraint(post_type, code),
+            # For get_special_tags
+            Index(prefix + 'tag_tag_type_idx', tag_type, external_code, postgresql_where=tag_type.isnot(None)),
+            # Trigram index for autocompleting tag names (needs the pg_trgm extension)
+            Index(prefix + 'tag_name_trgm_idx', name, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
         )
 
         def __init__(self, post_type, name, tag_type=None, external_code=None):
@@ -322,6 +334,22 @@ def init(table_prefix, metadata, bind):
         snippet_description = Column(String, nullable=True)
         snippet_image = Column(String, nullable=True)
         main_image_url = Column(String, nullable=True)
+        # Values derived from content.  These are updated whenever the content is set so that we don't
+        # have to parse the html every time the post is displayed
+        content_description = Column(String, nullable=True)
+        content_word_count = Column(Integer, nullable=True)
+        content_images = Column(ARRAY(String), nullable=True)
+        # Number of approved and pending (not approved) comments, ignoring deleted comments.  These are kept
+        # up to date automatically whenever a comment is added or moderated
+        num_approved_comments = Column(Integer, nullable=False, default=0, server_default='0')
+        num_pending_comments = Column(Integer, nullable=False, default=0, server_default='0')
+        # Responsive versions of the snippet and main images.  Each is a dict with the source image url
+        # and a list of variants, each with a url, width, height and (mime) type
+        snippet_image_variants = Column(JSONB, nullable=True)
+        main_image_variants = Column(JSONB, nullable=True)
+        # Full text search document built from the title, tagline and content.  This is updated automatically
+        # whenever any of those are changed.  It is never needed in python, so it isn't loaded
+        search_vector = deferred(Column(TSVECTOR, nullable=True))
 
         category = relationship('CmsCategory', uselist=False, backref=backref('posts'))
         tags = relationship('CmsTag', secondary=cms_post_cms_tag, backref=backref('posts'))
@@ -329,7 +357,21 @@ def init(table_prefix, metadata, bind):
 
         __table_args__ = (
             UniqueConstraint(post_type, title),
-            UniqueConstraint(post_type, code)
+            UniqueConstraint(post_type, code),
+            # Partial indexes for listing published posts, newest first
+            Index(prefix + 'post_published_idx', post_type, published.desc(), id.desc(),
+                  postgresql_where=published.isnot(None)),
+            Index(prefix + 'post_category_published_idx', category_id, published.desc(), id.desc(),
+                  postgresql_where=published.isnot(None)),
+            # For listing all posts, including unpublished posts, and finding the previous and next posts
+            Index(prefix + 'post_published_or_created_idx', post_type, func.coalesce(published, created).desc(),
+                  id.desc()),
+            # For full text search
+            Index(prefix + 'post_search_vector_idx', 'search_vector', postgresql_using='gin'),
+            # For checking for duplicate titles, ignoring case
+            Index(prefix + 'post_lower_title_idx', post_type, func.lower(title)),
+            # Trigram index for autocompleting titles (needs the pg_trgm extension)
+            Index(prefix + 'post_title_trgm_idx', title, postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
         )
         
         def __init__(self, post_type, category, title, content, author, tagline,
@@ -344,53 +386,70 @@ def init(table_prefix, metadata, bind):
             self.content = content
             self.author = author
             self.main_image_url = main_image_url
+            self.num_approved_comments = 0
+            self.num_pending_comments = 0
             if code:
                 self.code = code
             else:
                 self.code = cmsutil.make_code(title)
 
+        @validates('content')
+        def _update_content(self, key, content):
+            self.update_derived_content(content)
+            return content
+
+        def update_derived_content(self, content=None):
+            """
+            Parse the content and store the values derived from it.  This is called automatically
+            whenever the content is changed
+
+            :param content: The new content.  If None, the current content will be used
+            """
+            if content is None:
+                content = self.content
+
+            soup = cmsutil.parse_html(content)
+            self.content_description = cmsutil.get_description(soup)
+            self.content_word_count = cmsutil.get_word_count(soup)
+            self.content_images = cmsutil.get_image_urls(soup)
+
+        @staticmethod
+        def make_search_vector(title, tagline, content):
+            """
+            :return: SQL expression for the search_vector of a post.  Matches in the title rank highest,
+                     followed by the tagline and then the content
+            """
+            config = get_settings().search_config
+            # Everything goes through unidecode (parse_html does it for the content) so that the search terms,
+            # which are also unidecoded, match accented words
+            text = cmsutil.get_text(cmsutil.parse_html(content or ''))
+
+            return func.setweight(func.to_tsvector(config, unidecode(title or '')), 'A').op('||')(
+                func.setweight(func.to_tsvector(config, unidecode(tagline or '')), 'B')
+            ).op('||')(
+                func.setweight(func.to_tsvector(config, text), 'D')
+            )
+
+        def update_search_vector(self):
+            """
+            Rebuild the search_vector.  This is called automatically when the post is saved, if the title,
+            tagline or content have changed
+            """
+            self.search_vector = CmsPost.make_search_vector(self.title, self.tagline, self.content)
+
         @property
         def description(self):
-            soup = BeautifulSoup(unidecode(self.content), 'html.parser')
-            ps = soup.find_all('p')
-            for p in ps:
-                desc = ''
-                found = False
-                for c in p.contents:
-                    # c.name is the tag name.  We are looking for text which has no tag name
-                    if not c.name:
-                        found = True
-                        desc += c + ' '
-                    else:
-                        # it was a tag - look one level deep for more text
-                        for c2 in c.contents:
-                            if not c2.name:
-                                desc += c2 + ' '
-
-                if found:
-                    # There was a paragraph!
-                    return desc.strip()
-
-            return ''
-
-        def get_word_count(self):
-            soup = BeautifulSoup(unidecode(self.content), 'html.parser')
+            if self.content_description is None:
+                # Derived values haven't been calculated for this post yet
+                return cmsutil.get_description(cmsutil.parse_html(self.content))
 
-            all_text = ''
+            return self.content_description
 
-            # We get the words within paragrphs
-            paragraphs = soup.findAll('p')
-            for s in paragraphs:
-                all_text += ' '.join(s.findAll(text=True))
-            
-            # Now divs
-            divs = soup.findAll('div')
-            for s in divs:
-                all_text += ' '.join(s.findAll(text=True))
+        def get_word_count(self):
+            if self.content_word_count is None:
+                return cmsutil.get_word_count(cmsutil.parse_html(self.content))
 
-            # Mung the text
-            processed_text = re.sub(r'[^a-zA-Z\']+', ' ', all_text)
-            return len(processed_text.split(' '))
+            return self.content_word_count
 
         def get_reading_time(self):
             word_count = self.get_word_count()
@@ -449,6 +508,53 @@ def init(table_prefix, metadata, bind):
                 ).order_by(
                     CmsPost.published.desc()
                 ).first()
+
+        def get_prev_and_next_posts(self, include_non_published=False):
+            """
+            Get the results of get_prev_post and get_next_post with a single query
+
+            :return: Tuple of (previous post, next post).  Either may be None
+            """
+            if include_non_published:
+                sort_column = func.coalesce(CmsPost.published, CmsPost.created)
+                date = self.published or self.created
+            else:
+                sort_column = CmsPost.published
+                date = self.published
+
+            if date is None:
+                return None, None
+
+            query = session.query(
+                CmsPost
+            ).filter(
+                CmsPost.post_type == self.post_type
+            )
+
+            prev_query = query.add_columns(
+                literal(False).label('is_next')
+            ).filter(
+                sort_column < date
+            ).order_by(
+                sort_column.desc()
+            ).limit(1)
+
+            next_query = query.add_columns(
+                literal(True).label('is_next')
+            ).filter(
+                sort_column > date
+            ).order_by(
+                sort_column
+            ).limit(1)
+
+            prev_post = next_post = None
+            for post, is_next in prev_query.union_all(next_query):
+                if is_next:
+                    next_post = post
+                else:
+                    prev_post = post
+
+            return prev_post, next_post
         
         def get_html_title(self):
             if self.html_title:
@@ -470,6 +576,120 @@ def init(table_prefix, metadata, bind):
                 return self.snippet_description
             return self.tagline
         
+        @staticmethod
+        def make_image_variants(source_url, variants, source_size=None):
+            """
+            :param source_url: The url of the image the variants were made from
+            :param variants: List of dicts with the url, width, height and type of each variant
+            :param source_size: (width, height) of the image the variants were made from, so that it can be
+                                included in the srcsets
+            :return: Value to store in snippet_image_variants or main_image_variants
+            """
+            image_variants = {'source': source_url, 'variants': variants}
+            if source_size:
+                image_variants['width'], image_variants['height'] = source_size
+
+            return image_variants
+
+        @staticmethod
+        def _get_image_variants(image_variants, source_url):
+            # The variants are ignored if the image has been changed since they were created
+            if not image_variants or not source_url or image_variants.get('source') != source_url:
+                return []
+
+            return image_variants.get('variants') or []
+
+        @staticmethod
+        def _get_image_sources(variants, original=None, sizes=None):
+            sources = OrderedDict()
+            for variant in sorted(variants, key=lambda v: v['width']):
+                sources.setdefault(variant['type'], []).append('{} {}w'.format(variant['url'], variant['width']))
+
+            if original:
+                # The original is the largest image, so it goes at the end of every srcset
+                for srcset in sources.values():
+                    srcset.append(original)
+
+            # WebP first, as browsers use the first <source> that they support
+            return [{'type': image_type, 'srcset': ', '.join(srcset), 'sizes': sizes}
+                    for image_type, srcset in sorted(sources.items(), key=lambda s: s[0] != 'image/webp')]
+
+        def _get_main_image_original(self):
+            """
+            :return: srcset entry for the original main image, or None if its width isn't known
+            """
+            if not self._get_image_variants(self.main_image_variants, self.main_image_url):
+                return None
+
+            width = self.main_image_variants.get('width')
+            if not width:
+                return None
+
+            return '{} {}w'.format(self.main_image_url, width)
+
+        def has_current_main_image_variants(self):
+            """
+            :return: True if the main image variants have been created for the current main image
+            """
+            # Variants created before the width of the original was stored are out of date
+            return bool(self.main_image_variants) and bool(self.main_image_url) and \
+                self.main_image_variants.get('source') == self.main_image_url and \
+                bool(self.main_image_variants.get('width'))
+
+        def get_snippet_image_sources(self):
+            """
+            :return: List of dicts with the (mime) type and srcset of each format the snippet image has been
+                     saved in, WebP first.  Use these to make the <source> tags in a <picture>.  Empty if there
+                     are no variants of the current snippet image
+            """
+            return self._get_image_sources(self._get_image_variants(self.snippet_image_variants,
+                                                                    self.snippet_image))
+
+        def get_main_image_sources(self, sizes='100vw'):
+            """
+            :param sizes: The sizes attribute for the <source> tags, i.e. how wide the main image is displayed
+            :return: List of dicts with the (mime) type, srcset and sizes of each format the main image has
+                     been scaled down in, WebP first.  Each srcset ends with the original main image.  Empty if
+                     there are no variants of the current main image
+            """
+            original = self._get_main_image_original()
+            if not original:
+                # Without the width of the original the browser would never choose it, so just use the <img>
+                return []
+
+            return self._get_image_sources(self._get_image_variants(self.main_image_variants,
+                                                                    self.main_image_url),
+                                           original, sizes)
+
+        def _get_srcset(self, variants, source_url, original=None):
+            extension = source_url.split('?')[0].split('.')[-1] if source_url else ''
+            image_type = cmsutil.get_image_mime_type(extension)
+            srcset = ['{} {}w'.format(v['url'], v['width'])
+                      for v in sorted(self._get_image_variants(variants, source_url), key=lambda v: v['width'])
+                      if v['type'] == image_type]
+
+            if srcset and original:
+                srcset.append(original)
+
+            return ', '.join(srcset) or None
+
+        def get_snippet_image_srcset(self):
+            """
+            :return: srcset for the snippet <img> tag, in the original image format, or None
+            """
+            return self._get_srcset(self.snippet_image_variants, self.snippet_image)
+
+        def get_main_image_srcset(self):
+            """
+            :return: srcset for the main image <img> tag, in the original image format and ending with the
+                     original main image, or None
+            """
+            original = self._get_main_image_original()
+            if not original:
+                return None
+
+            return self._get_srcset(self.main_image_variants, self.main_image_url, original)
+
         def get_snippet_image(self):
             if self.snippet_image:
                 return self.snippet_image
@@ -484,31 +704,68 @@ def init(table_prefix, metadata, bind):
                                 'snippet_missing_image_url in your EasyCmsSettings. {}'.format(error))
         
         def get_images(self):
-            soup = BeautifulSoup(unidecode(self.content), 'html.parser')
-            imgs = soup.find_all('img')
             out = []
             if self.main_image_url:
                 out.append(self.main_image_url)
-            for img in imgs:
-                out.append(img['src'])
+
+            if self.content_images is None:
+                out += cmsutil.get_image_urls(cmsutil.parse_html(self.content))
+            else:
+                out += self.content_images
+
             return out
         
+        def _get_session(self):
+            return object_session(self) or session
+
+        def _num_own_pending_comments(self):
+            """
+            :return: The number of pending comments on this post made by the current visitor, who is
+                     identified by the email address saved in their comment cookie
+            """
+            if not self.num_pending_comments:
+                return 0
+
+            if not request or not request.cookies:
+                return 0
+
+            email = request.cookies.get(constants.COMMENT_EMAIL_COOKIE_NAME)
+            if not email:
+                return 0
+
+            return self._get_session().query(
+                func.count(CmsComment.id)
+            ).filter(
+                CmsComment.post_id == self.id,
+                CmsComment.approved == False,
+                CmsComment.deleted == False,
+                CmsComment.author_email == email
+            ).scalar()
+
         def has_visible_comments(self):
             """
             :return: True if the current logged in user can see any of the comments on this post
             """
-            for comment in self.comments:
-                if comment.visible():
-                    return True
-            return False
+            return self.num_visible_comments() > 0
         
         def num_visible_comments(self):
-            num_comments = 0
-            for comment in self.comments:
-                if comment.visible():
-                    num_comments += 1
+            """
+            :return: The number of comments the current logged in user can see.  For normal visitors
+                     this doesn't need to load any comments
+            """
+            from . import accesscontrol
+            if accesscontrol.get_access_control().can_moderate_comments():
+                # Moderators can see everything, including deleted comments
+                if self.id is None:
+                    return 0
 
-            return num_comments
+                return self._get_session().query(
+                    func.count(CmsComment.id)
+                ).filter(
+                    CmsComment.post_id == self.id
+                ).scalar()
+
+            return (self.num_approved_comments or 0) + self._num_own_pending_comments()
         
         @property
         def editor_url(self):
@@ -545,6 +802,35 @@ def init(table_prefix, metadata, bind):
             else:
                 return 'Not published'
 
+    @event.listens_for(CmsPost, 'before_insert')
+    @event.listens_for(CmsPost, 'before_update')
+    def post_saved(mapper, connection, post):
+        state = inspect(post)
+        if state.key is None or any(
+            state.attrs[name].history.has_changes() for name in ('title', 'tagline', 'content')
+        ):
+            post.update_search_vector()
+
+    class CmsRelatedPost(Model):
+        """
+        The most related posts for each post, scored by the number of tags they share and whether they
+        are in the same category.  This is precomputed by relatedposts.py whenever tags change
+        """
+        __tablename__ = prefix + 'related_post'
+
+        post_id = Column(BigInteger, ForeignKey(prefix + 'post.id', ondelete='CASCADE'), primary_key=True)
+        related_post_id = Column(BigInteger, ForeignKey(prefix + 'post.id', ondelete='CASCADE'), primary_key=True)
+        score = Column(Float, nullable=False)
+
+        related_post = relationship('CmsPost', foreign_keys=[related_post_id], uselist=False)
+
+        __table_args__ = (
+            # For loading the related posts in order
+            Index(prefix + 'related_post_post_id_score_idx', post_id, score.desc(), related_post_id.desc()),
+            # For finding the posts that a post is related to, and for deleting posts
+            Index(prefix + 'related_post_related_post_id_idx', related_post_id)
+        )
+
     class CmsPostRevision(Model):
         __tablename__ = prefix + 'post_revision'
 
@@ -588,13 +874,24 @@ def init(table_prefix, metadata, bind):
         deleted = Column(Boolean, nullable=False)
         reply_to_id = Column(BigInteger, ForeignKey(prefix + 'comment.id'), nullable=True)
 
-        post = relationship('CmsPost', uselist=False, backref=backref('comments', order_by=timestamp))
+        # The old post is loaded when a comment is moved, so that both posts' comment counts are updated
+        post = relationship('CmsPost', uselist=False, backref=backref('comments', order_by=timestamp),
+                            active_history=True)
         author = relationship('CmsAuthor', foreign_keys=[author_id], uselist=False)
         author_user = relationship('CmsUser', foreign_keys=[author_user_id], uselist=False)
         editor = relationship('CmsAuthor', foreign_keys=[edited_by_id], uselist=False)
         editor_user = relationship('CmsUser', foreign_keys=[edited_by_user_id], uselist=False)
         reply_to = relationship('CmsComment', uselist=False, remote_side=[id], backref=backref('replies', order_by=timestamp))
 
+        __table_args__ = (
+            # For paging through comments and the per post rate limit check
+            Index(prefix + 'comment_post_id_timestamp_idx', post_id, timestamp, id),
+            # For the site wide rate limit check
+            Index(prefix + 'comment_author_ip_timestamp_idx', author_ip, timestamp),
+            # For loading replies
+            Index(prefix + 'comment_reply_to_id_idx', reply_to_id, postgresql_where=reply_to_id.isnot(None))
+        )
+
         def __init__(self, post, content, user=None, author=None, author_name=None, author_email=None,
                      author_ip=None, user_agent=None, reply_to=None):
             self.post = post
@@ -644,6 +941,49 @@ def init(table_prefix, metadata, bind):
         def edit_url(self):
             return url_for('easycms_editor.edit_comment', comment_id=self.id)
         
+    def update_comment_counts(connection, post_id):
+        """
+        Recalculate the comment counts for a post, using a single UPDATE statement
+        """
+        comments = CmsComment.__table__
+
+        def count_comments(approved):
+            return select([func.count(comments.c.id)]).where(and_(
+                comments.c.post_id == post_id,
+                comments.c.approved == approved,
+                comments.c.deleted == False
+            )).as_scalar()
+
+        connection.execute(
+            CmsPost.__table__.update().where(
+                CmsPost.__table__.c.id == post_id
+            ).values(
+                num_approved_comments=count_comments(True),
+                num_pending_comments=count_comments(False)
+            )
+        )
+
+    @event.listens_for(CmsComment, 'after_insert')
+    @event.listens_for(CmsComment, 'after_delete')
+    def comment_added_or_deleted(mapper, connection, comment):
+        update_comment_counts(connection, comment.post_id)
+
+    @event.listens_for(CmsComment, 'after_update')
+    def comment_updated(mapper, connection, comment):
+        state = inspect(comment)
+        post_id_history = state.attrs.post_id.history
+
+        if post_id_history.has_changes():
+            # The comment has been moved to a different post.  The old post id is only known if the comment
+            # was moved by setting comment.post, which loads the old post (see CmsComment.post)
+            for post_id in post_id_history.deleted:
+                if post_id is not None:
+                    update_comment_counts(connection, post_id)
+        elif not state.attrs.approved.history.has_changes() and not state.attrs.deleted.history.has_changes():
+            return
+
+        update_comment_counts(connection, comment.post_id)
+
     class CmsVersionHistory(Model):
         """
         Used to store the version in the database so that we can automatically update the tables
@@ -669,9 +1009,28 @@ def init(table_prefix, metadata, bind):
             return self.major_version == easycms.MAJOR_VERSION and self.minor_version == easycms.MINOR_VERSION
 
 
+def remove_session():
+    """
+    If scoped sessions are enabled, close and discard the session for the current thread.  A new
+    session will be created the next time it is used.  Does nothing if scoped sessions are disabled
+    """
+    if isinstance(session, scoped_session):
+        session.remove()
+
+
+def create_extensions():
+    """
+    Install the PostgreSQL extensions that the indexes need, if they aren't already installed.  pg_trgm is a
+    trusted extension, so the owner of the database can install it
+    """
+    from . import bind
+    bind.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+
 def create_all():
     from . import bind
     log.info('Creating all missing EasyCMS tables')
+    create_extensions()
     Model.metadata.create_all(bind=bind)
 
 
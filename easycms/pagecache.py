@@ -0,0 +1,128 @@
+"""
+Read-through cache for pages and published pages, so that the homepage and other static pages can be
+displayed without a database round trip.  Pages are loaded in a separate session and cached detached
+from any session, then merged into the caller's session without loading them again.
+
+Entries expire after settings.page_cache_timeout seconds and are invalidated when a page is edited or
+published, in this process straight away and in other processes when they receive the notification
+(see invalidation.py).  The cache is disabled unless page_cache_timeout is set
+"""
+
+import logging
+import threading
+
+from . import models, invalidation
+from .cache import MemoryCache, merge_cached_instance
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+PAGE = 'page'
+PUBLISHED_PAGE = 'published-page'
+
+# Stored in the cache when there is no page with the code
+_NOT_FOUND = 'not-found'
+
+_cache = None
+# Incremented every time the cache is invalidated, so that a page that was loaded before the
+# invalidation doesn't get stored in the cache afterwards
+_generation = 0
+_lock = threading.Lock()
+
+
+def init(settings):
+    global _cache
+
+    if settings.page_cache_timeout:
+        log.info('Page cache enabled (timeout: {}s, max size: {})'.format(
+            settings.page_cache_timeout, settings.page_cache_max_size
+        ))
+        _cache = MemoryCache(max_size=settings.page_cache_max_size, default_timeout=settings.page_cache_timeout)
+    else:
+        _cache = None
+
+
+def _get_key(kind, code, allow_disabled):
+    return '{}:{}:{}'.format(kind, 'all' if allow_disabled else 'enabled', code)
+
+
+def get_page(kind, code, allow_disabled, load, session=None):
+    """
+    Get a page from the cache, or load it and store it in the cache
+
+    :param kind: PAGE or PUBLISHED_PAGE
+    :param code: The page code
+    :param allow_disabled: Passed into the query.  Part of the cache key
+    :param load: Function that takes a session and returns the page (with all of the relationships that
+                 will be used already loaded) or None
+    :param session: The session to return the page in.  Defaults to models.session
+    :return: The CmsPage or CmsPublishedPage, or None
+    """
+    if session is None:
+        session = models.session
+
+    cache = _cache
+    if cache is None:
+        return load(session)
+
+    invalidation.ensure_listener()
+
+    key = _get_key(kind, code, allow_disabled)
+    page = cache.get(key)
+
+    if page is None:
+        with _lock:
+            generation = _generation
+
+        load_session = models.Session()
+        try:
+            page = load(load_session)
+        finally:
+            # Closing the session detaches the page, leaving the loaded attributes in place
+            load_session.close()
+
+        with _lock:
+            if generation == _generation:
+                cache.set(key, _NOT_FOUND if page is None else page)
+
+    if page is None or page == _NOT_FOUND:
+        return None
+
+    return merge_cached_instance(page, session)
+
+
+def invalidate(code=None):
+    """
+    Remove a page from the cache
+
+    :param code: The page code, or None to remove all pages
+    """
+    global _generation
+
+    cache = _cache
+    if cache is None:
+        return
+
+    with _lock:
+        _generation += 1
+
+        if code is None:
+            log.debug('Clearing page cache')
+            cache.clear()
+        else:
+            log.debug('Removing page {} from cache'.format(code))
+            cache.delete_many(*[
+                _get_key(kind, code, allow_disabled)
+                for kind in (PAGE, PUBLISHED_PAGE)
+                for allow_disabled in (True, False)
+            ])
+
+
+def _author_changed(author_id):
+    # Pages include their author's name
+    invalidate()
+
+
+invalidation.register_handler(invalidation.PAGE, invalidate)
+invalidation.register_handler(invalidation.AUTHOR, _author_changed)
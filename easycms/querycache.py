@@ -0,0 +1,163 @@
+"""
+Cache for the results of the public query functions in easycms/__init__.py, such as get_post_by_code,
+get_recent_posts, get_all_categories, get_all_tags and get_author_by_code.  The sidebar lists and post
+lookups that are needed to render every page can then be served without touching the database.
+
+The backend is set with settings.query_cache_backend and can be any cache with the cachelib interface,
+i.e. one of the caches in cache.py or a cachelib cache.  It defaults to a MemoryCache in each process.
+Results are loaded in a separate session with the relationships that are normally displayed, stored
+detached from any session and merged into the caller's session without loading them again.
+
+Every cached result belongs to a generation (posts, categories, tags or authors).  The current value of
+each generation is stored in the backend and is part of the cache keys, so starting a new generation
+invalidates every result that depends on it in one step, for every process sharing the backend.  New
+generations are started when invalidation.py reports that objects have changed.
+
+Publishing a post at a scheduled time doesn't change anything in the database, so cached lists of posts
+only include it once their entries expire.  The cache is disabled unless query_cache_timeout is set
+"""
+
+import logging
+import uuid
+
+from . import models, invalidation
+from .cache import MemoryCache, merge_cached_instance
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+# Generations
+POSTS = 'posts'
+CATEGORIES = 'categories'
+TAGS = 'tags'
+AUTHORS = 'authors'
+
+# Maps the kinds of object in invalidation.py to the generations that they are cached in.  Posts are
+# cached with their category, tags, author and comment counts
+_GENERATIONS_BY_KIND = {
+    invalidation.POST: [POSTS],
+    invalidation.COMMENT: [POSTS],
+    invalidation.CATEGORY: [CATEGORIES, POSTS],
+    invalidation.TAG: [TAGS, POSTS],
+    invalidation.AUTHOR: [AUTHORS, POSTS]
+}
+
+# Stored in the cache when a query found nothing
+_NOT_FOUND = 'not-found'
+
+_backend = None
+_timeout = None
+_key_prefix = ''
+
+
+def init(settings):
+    global _backend, _timeout, _key_prefix
+
+    if not settings.query_cache_timeout:
+        _backend = None
+        return
+
+    _timeout = settings.query_cache_timeout
+    _key_prefix = settings.query_cache_key_prefix
+    _backend = settings.query_cache_backend
+
+    if _backend is None:
+        _backend = MemoryCache(max_size=settings.query_cache_max_size, default_timeout=_timeout)
+
+    log.info('Query cache enabled (backend: {}, timeout: {}s)'.format(type(_backend).__name__, _timeout))
+
+
+def _get_generation_key(generation):
+    return '{}generation:{}'.format(_key_prefix, generation)
+
+
+def _get_current_generation(backend, generation):
+    """
+    :return: The current value of the generation, or None if the backend isn't working
+    """
+    key = _get_generation_key(generation)
+    value = backend.get(key)
+
+    if value is None:
+        # Random, so that it can't match a generation that was used before the key was lost.  Another
+        # process may be doing the same thing, so use whichever value was added first
+        backend.add(key, uuid.uuid4().hex, timeout=0)
+        value = backend.get(key)
+
+    return value
+
+
+def new_generation(generation):
+    """
+    Invalidate all of the cached results in a generation
+    """
+    backend = _backend
+    if backend is None:
+        return
+
+    log.debug('Starting new {} query cache generation'.format(generation))
+    backend.set(_get_generation_key(generation), uuid.uuid4().hex, timeout=0)
+
+
+def clear():
+    for generation in (POSTS, CATEGORIES, TAGS, AUTHORS):
+        new_generation(generation)
+
+
+def get(generation, key_parts, load, session=None):
+    """
+    Get a query result from the cache, or load it and store it in the cache
+
+    :param generation: POSTS, CATEGORIES, TAGS or AUTHORS
+    :param key_parts: List of the name of the query and all of the arguments that affect the result
+    :param load: Function that takes a session and returns an instance, a list of instances or None.
+                 Relationships that will be used must already be loaded
+    :param session: The session to return the result in.  Defaults to models.session
+    :return: The instance or list of instances in the session, or None
+    """
+    if session is None:
+        session = models.session
+
+    backend = _backend
+    if backend is None:
+        return load(session)
+
+    invalidation.ensure_listener()
+
+    current_generation = _get_current_generation(backend, generation)
+    if current_generation is None:
+        return load(session)
+
+    key = '{}{}:{}:{}'.format(_key_prefix, generation, current_generation, ':'.join(str(p) for p in key_parts))
+    result = backend.get(key)
+
+    if result is None:
+        load_session = models.Session()
+        try:
+            result = load(load_session)
+        finally:
+            # Closing the session detaches the result, leaving the loaded attributes in place
+            load_session.close()
+
+        backend.set(key, _NOT_FOUND if result is None else result, timeout=_timeout)
+
+    if result is None or result == _NOT_FOUND:
+        return None
+
+    if isinstance(result, list):
+        return [merge_cached_instance(instance, session) for instance in result]
+
+    return merge_cached_instance(result, session)
+
+
+def _make_handler(kind):
+    def objects_changed(key):
+        for generation in _GENERATIONS_BY_KIND[kind]:
+            new_generation(generation)
+
+    return objects_changed
+
+
+for _kind in _GENERATIONS_BY_KIND:
+    invalidation.register_handler(_kind, _make_handler(_kind))
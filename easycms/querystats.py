@@ -0,0 +1,170 @@
+"""
+Optional SQL instrumentation.  Counts the number of queries run during each Flask request, the total time
+spent in the database and the slowest statements.  Enable it by passing instrument_queries=True into
+easycms.init(...)
+
+The stats for the current request are available from get_request_stats().  To measure a block of code
+(i.e. in a test) use track_queries():
+
+    with querystats.track_queries() as stats:
+        post.num_visible_comments()
+
+    assert stats.num_queries == 1
+"""
+
+import logging
+import threading
+import time
+import contextlib
+
+from sqlalchemy import event
+from flask import g, request
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HEADER_NAME = 'X-EasyCMS-Queries'
+
+# Key used to store query start times in connection.info
+START_TIMES_KEY = 'easycms_query_start_times'
+
+# Holds the list of QueryStats objects that are currently recording for each thread
+_local = threading.local()
+
+
+class QueryStats(object):
+    def __init__(self, num_slowest=5):
+        """
+        :param num_slowest: The number of slowest statements to keep
+        """
+        self.num_slowest = num_slowest
+        self.num_queries = 0
+        self.total_time = 0.0
+        # List of (duration in seconds, statement), slowest first
+        self.slowest = []
+
+    def record(self, statement, duration):
+        self.num_queries += 1
+        self.total_time += duration
+
+        if self.num_slowest and (len(self.slowest) < self.num_slowest or duration > self.slowest[-1][0]):
+            self.slowest.append((duration, statement))
+            self.slowest.sort(key=lambda s: s[0], reverse=True)
+            del self.slowest[self.num_slowest:]
+
+    @property
+    def total_time_ms(self):
+        return self.total_time * 1000
+
+    def __str__(self):
+        return '{} queries in {:.1f}ms'.format(self.num_queries, self.total_time_ms)
+
+
+def _get_active_stats():
+    if not hasattr(_local, 'active'):
+        _local.active = []
+
+    return _local.active
+
+
+def start_tracking(num_slowest=5):
+    """
+    Start recording queries run in this thread
+
+    :return: A QueryStats object which will be updated until stop_tracking is called
+    """
+    stats = QueryStats(num_slowest)
+    _get_active_stats().append(stats)
+    return stats
+
+
+def stop_tracking(stats):
+    active = _get_active_stats()
+    if stats in active:
+        active.remove(stats)
+
+
+@contextlib.contextmanager
+def track_queries(num_slowest=5):
+    """
+    Context manager which records all of the queries run in this thread inside the with block
+    """
+    stats = start_tracking(num_slowest)
+    try:
+        yield stats
+    finally:
+        stop_tracking(stats)
+
+
+def get_request_stats():
+    """
+    :return: QueryStats for the current request, or None if instrumentation isn't enabled
+    """
+    return g.get('easycms_query_stats')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault(START_TIMES_KEY, []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get(START_TIMES_KEY)
+    if not start_times:
+        return
+
+    duration = time.perf_counter() - start_times.pop()
+
+    for stats in _get_active_stats():
+        stats.record(statement, duration)
+
+
+def _handle_error(exception_context):
+    # The after_cursor_execute event won't fire for a failed statement
+    conn = exception_context.connection
+    if conn is not None and conn.info.get(START_TIMES_KEY):
+        conn.info[START_TIMES_KEY].pop()
+
+
+def init(app, engine, header_name=DEFAULT_HEADER_NAME, num_slowest=5):
+    """
+    Enable query instrumentation
+
+    :param app: The Flask app
+    :param engine: The engine (or connection) passed into easycms.init(...)
+    :param header_name: Name of the response header to add the stats to.  Set to None to disable
+    :param num_slowest: Number of slowest statements to record (and log at debug level) for each request
+    """
+    log.info('Enabling query instrumentation')
+
+    engine = engine.engine
+
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+
+    @app.before_request
+    def start_request_tracking():
+        g.easycms_query_stats = start_tracking(num_slowest)
+
+    @app.after_request
+    def report_request_stats(response):
+        stats = get_request_stats()
+        if stats is None:
+            return response
+
+        if header_name:
+            response.headers[header_name] = '{}; time={:.1f}ms'.format(stats.num_queries, stats.total_time_ms)
+
+        log.info('{} {}: {}'.format(request.method, request.path, stats))
+        for duration, statement in stats.slowest:
+            log.debug('{:.1f}ms: {}'.format(duration * 1000, statement))
+
+        return response
+
+    @app.teardown_request
+    def stop_request_tracking(exception=None):
+        stats = g.pop('easycms_query_stats', None)
+        if stats is not None:
+            stop_tracking(stats)
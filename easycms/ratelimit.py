@@ -0,0 +1,214 @@
+"""
+Rate limiting for comments.  The limits are set with the comment_rate_limits setting and are checked by
+the backend set in comment_rate_limit_backend:
+
+  * DatabaseRateLimitBackend (the default) counts the comments that have been saved in the database
+  * MemoryRateLimitBackend keeps a token bucket for each IP address in this process
+  * CacheRateLimitBackend keeps counters in a cache that can be shared between processes, such as a
+    cachelib UWSGICache (uWSGI shared memory), MemcachedCache or RedisCache
+
+The memory and cache backends count the attempts to post a comment, rather than the comments that were
+saved, so a flood of spam is rejected without touching the database.  An attempt is only counted if
+every limit allows it, so one that is rejected doesn't use up the other limits.  The rate limits are
+checked after the cheaper spam and duplicate checks (see comments.py), so those attempts aren't counted
+either
+"""
+
+import logging
+import threading
+import time
+import datetime
+from collections import OrderedDict
+
+from sqlalchemy.sql import func
+
+from . import models
+from .settings import get_settings
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+
+class RateLimit(object):
+    def __init__(self, max_comments, seconds, per_post=False):
+        """
+        :param max_comments: Maximum number of comments that can be made from an IP address...
+        :param seconds: ...in this many seconds
+        :param per_post: If True, the limit applies to each post separately.  Otherwise it applies to
+                         all comments across the whole site
+        """
+        self.max_comments = max_comments
+        self.seconds = seconds
+        self.per_post = per_post
+
+    def get_key(self, ip_address, post_id):
+        key = '{}/{}:{}'.format(self.max_comments, self.seconds, ip_address)
+        if self.per_post:
+            key += ':{}'.format(post_id)
+
+        return key
+
+    def __repr__(self):
+        return '<RateLimit {} in {}s{}>'.format(self.max_comments, self.seconds, ' per post' if self.per_post else '')
+
+
+# One comment per post every 2 minutes from each IP address
+DEFAULT_RATE_LIMITS = [RateLimit(1, 120, per_post=True)]
+
+
+class RateLimitBackend(object):
+    def check(self, limits, ip_address, post, session):
+        """
+        Check whether a comment can be made, and count the attempt if the backend counts attempts
+
+        :param limits: List of RateLimit objects
+        :param ip_address: IP address of the commenter
+        :param post: The CmsPost being commented on
+        :param session: The database session
+        :return: The first RateLimit that has been exceeded, or None if the comment is allowed
+        """
+        raise NotImplementedError()
+
+
+class DatabaseRateLimitBackend(RateLimitBackend):
+    """
+    Counts the comments in the database, using a single query for all of the limits
+    """
+
+    def check(self, limits, ip_address, post, session):
+        if not limits:
+            return None
+
+        now = datetime.datetime.utcnow()
+        CmsComment = models.CmsComment
+
+        counts = []
+        for limit in limits:
+            query = session.query(
+                CmsComment.id
+            ).filter(
+                CmsComment.author_ip == ip_address,
+                CmsComment.timestamp > now - datetime.timedelta(seconds=limit.seconds)
+            )
+
+            if limit.per_post:
+                query = query.filter(CmsComment.post_id == post.id)
+
+            # There's no need to count any further than the limit
+            query = query.limit(limit.max_comments).subquery()
+            counts.append(session.query(func.count()).select_from(query).as_scalar())
+
+        for limit, count in zip(limits, session.query(*counts).one()):
+            if count >= limit.max_comments:
+                return limit
+
+        return None
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """
+    Token buckets held in this process.  Each process has its own buckets, so with several worker
+    processes the effective limit is multiplied by the number of workers
+    """
+
+    def __init__(self, max_keys=10000):
+        """
+        :param max_keys: Maximum number of buckets to keep.  The least recently used buckets are dropped
+        """
+        self.max_keys = max_keys
+        # Maps key to a tuple of (tokens, last updated time)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_tokens(self, limit, key, now):
+        tokens, last_updated = self._buckets.get(key, (limit.max_comments, now))
+
+        # Refill the bucket at a steady rate, up to max_comments
+        return min(limit.max_comments, tokens + (now - last_updated) * limit.max_comments / limit.seconds)
+
+    def check(self, limits, ip_address, post, session):
+        now = time.monotonic()
+
+        with self._lock:
+            buckets = [(limit, limit.get_key(ip_address, post.id)) for limit in limits]
+            tokens = [self._get_tokens(limit, key, now) for limit, key in buckets]
+
+            # Tokens are only taken if every limit allows the comment, so a rejected attempt doesn't use
+            # up the other limits
+            exceeded = next((limit for (limit, key), num_tokens in zip(buckets, tokens) if num_tokens < 1), None)
+
+            for (limit, key), num_tokens in zip(buckets, tokens):
+                self._buckets[key] = (num_tokens if exceeded else num_tokens - 1, now)
+                self._buckets.move_to_end(key)
+
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        return exceeded
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class CacheRateLimitBackend(RateLimitBackend):
+    """
+    Fixed window counters stored in a cache.  The cache must provide get_many(*keys), add(key, value, timeout)
+    and inc(key), like the caches in easycms.cache and cachelib.  Two attempts made at the same moment can
+    both be allowed, as the counters are checked before they are incremented
+    """
+
+    def __init__(self, cache, key_prefix='easycms-rate-limit:'):
+        for method in ('get_many', 'add', 'inc'):
+            if not callable(getattr(cache, method, None)):
+                raise TypeError('CacheRateLimitBackend needs a cache with a {}() method, such as the caches in '
+                                'easycms.cache or cachelib'.format(method))
+
+        self.cache = cache
+        self.key_prefix = key_prefix
+
+    def check(self, limits, ip_address, post, session):
+        if not limits:
+            return None
+
+        now = time.time()
+        keys = []
+        for limit in limits:
+            window = int(now // limit.seconds)
+            keys.append('{}{}:{}'.format(self.key_prefix, limit.get_key(ip_address, post.id), window))
+
+        # The attempt is only counted if every limit allows it
+        for limit, count in zip(limits, self.cache.get_many(*keys)):
+            if count is not None and count >= limit.max_comments:
+                return limit
+
+        for limit, key in zip(limits, keys):
+            self.cache.add(key, 0, timeout=limit.seconds)
+            self.cache.inc(key)
+
+        return None
+
+
+_default_backend = DatabaseRateLimitBackend()
+
+
+def get_backend():
+    return get_settings().comment_rate_limit_backend or _default_backend
+
+
+def get_limits():
+    limits = get_settings().comment_rate_limits
+    return DEFAULT_RATE_LIMITS if limits is None else limits
+
+
+def check_comment_rate_limit(ip_address, post, session):
+    """
+    :return: The first RateLimit that has been exceeded, or None if the comment is allowed
+    """
+    exceeded = get_backend().check(get_limits(), ip_address, post, session)
+
+    if exceeded is not None:
+        log.info('Comment rate limit {} exceeded by {}'.format(exceeded, ip_address))
+
+    return exceeded
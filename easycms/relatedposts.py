@@ -0,0 +1,220 @@
+"""
+Related posts.  Posts are related if they share at least one tag.  The score is the number of shared tags
+multiplied by settings.related_posts_tag_weight, plus settings.related_posts_category_weight if the posts
+are in the same category.  If settings.related_posts_decay_days is set, the score is halved for every
+that many days between the posts' dates, so posts from around the same time are preferred.
+
+The best settings.related_posts_max related posts for each post are stored in the related post table.
+Only posts with a published date can be related posts, so drafts don't take up the slots (posts that are
+scheduled for the future are stored, and filtered out when the related posts are displayed).  When a
+post's tags change, or it is published or unpublished, the lists of that post and every post that shares
+a tag with it (before or after the change) are recalculated with set based SQL, so displaying the related
+posts only needs one indexed lookup
+"""
+
+import logging
+
+from sqlalchemy import Float, cast, case, distinct, extract, inspect
+from sqlalchemy.sql import select, func, and_, or_
+
+from . import models, invalidation
+from .settings import get_settings
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+# Maximum number of posts to recalculate in each statement
+BATCH_SIZE = 500
+
+
+def _get_post_tag_table():
+    return models.CmsPost.tags.property.secondary
+
+
+def _get_score(post, related_post, shared_tags):
+    settings = get_settings()
+
+    score = shared_tags * settings.related_posts_tag_weight + case(
+        [(post.c.category_id == related_post.c.category_id, settings.related_posts_category_weight)],
+        else_=0
+    )
+
+    if settings.related_posts_decay_days:
+        days_apart = func.abs(extract(
+            'epoch',
+            func.coalesce(post.c.published, post.c.created) -
+            func.coalesce(related_post.c.published, related_post.c.created)
+        )) / 86400
+        score = score * func.power(0.5, days_apart / settings.related_posts_decay_days)
+
+    return cast(score, Float)
+
+
+def _recalculate(session, post_ids):
+    """
+    Replace the related posts of the posts with a single DELETE and INSERT ... SELECT
+    """
+    post_tag = _get_post_tag_table()
+    posts = models.CmsPost.__table__
+    related_posts = models.CmsRelatedPost.__table__
+
+    tags = post_tag.alias('tags')
+    related_tags = post_tag.alias('related_tags')
+
+    pairs = select([
+        tags.c.post_id,
+        related_tags.c.post_id.label('related_post_id'),
+        func.count(distinct(tags.c.tag_id)).label('shared_tags')
+    ]).select_from(
+        tags.join(related_tags, and_(
+            related_tags.c.tag_id == tags.c.tag_id,
+            related_tags.c.post_id != tags.c.post_id
+        ))
+    ).where(
+        tags.c.post_id.in_(post_ids)
+    ).group_by(
+        tags.c.post_id, related_tags.c.post_id
+    ).alias('pairs')
+
+    post = posts.alias('post')
+    related_post = posts.alias('related_post')
+    score = _get_score(post, related_post, pairs.c.shared_tags)
+
+    scored = select([
+        pairs.c.post_id,
+        pairs.c.related_post_id,
+        score.label('score'),
+        func.row_number().over(
+            partition_by=pairs.c.post_id,
+            order_by=(score.desc(), pairs.c.related_post_id.desc())
+        ).label('rank')
+    ]).select_from(
+        pairs.join(
+            post, post.c.id == pairs.c.post_id
+        ).join(
+            related_post, related_post.c.id == pairs.c.related_post_id
+        )
+    ).where(and_(
+        post.c.post_type == related_post.c.post_type,
+        related_post.c.published.isnot(None)
+    )).alias('scored')
+
+    session.execute(related_posts.delete().where(related_posts.c.post_id.in_(post_ids)))
+
+    session.execute(related_posts.insert().from_select(
+        ['post_id', 'related_post_id', 'score'],
+        select([
+            scored.c.post_id, scored.c.related_post_id, scored.c.score
+        ]).where(
+            scored.c.rank <= get_settings().related_posts_max
+        )
+    ))
+
+
+def _recalculate_in_batches(session, post_ids):
+    post_ids = sorted(post_ids)
+
+    for i in range(0, len(post_ids), BATCH_SIZE):
+        _recalculate(session, post_ids[i:i + BATCH_SIZE])
+
+
+def update_related_posts(post_ids, tag_ids=None, session=None):
+    """
+    Recalculate the related posts after tags have been added to or removed from posts.  Call this before
+    committing, so that the changes are saved in the same transaction
+
+    :param post_ids: Ids of the posts whose tags (or category or date) have changed
+    :param tag_ids: Ids of tags that have been removed from the posts
+    :return: The number of posts that were recalculated
+    """
+    if session is None:
+        session = models.session
+
+    # The tag changes need to be in the database
+    session.flush()
+
+    post_tag = _get_post_tag_table()
+    post_ids = list(post_ids)
+
+    # Every post that shares a tag with the posts is affected
+    condition = post_tag.c.tag_id.in_(
+        select([post_tag.c.tag_id]).where(post_tag.c.post_id.in_(post_ids))
+    )
+    if tag_ids:
+        condition = or_(condition, post_tag.c.tag_id.in_(list(tag_ids)))
+
+    affected_post_ids = set(post_ids)
+    affected_post_ids.update(
+        row[0] for row in session.execute(select([post_tag.c.post_id]).distinct().where(condition))
+    )
+
+    log.debug('Recalculating related posts for {} posts'.format(len(affected_post_ids)))
+    _recalculate_in_batches(session, affected_post_ids)
+    invalidation.notify(session, invalidation.POST)
+
+    return len(affected_post_ids)
+
+
+def _get_saved_published(post, session):
+    if session is None:
+        session = models.session
+
+    posts = models.CmsPost.__table__
+    with session.no_autoflush:
+        return session.execute(select([posts.c.published]).where(posts.c.id == post.id)).scalar()
+
+
+def update_related_posts_if_changed(post, session=None):
+    """
+    Recalculate the related posts if the post's category has been changed, it has been published or
+    unpublished, or its date has been changed and the scores decay.  Must be called before the changes are
+    flushed
+    """
+    state = inspect(post)
+    if state.key is None:
+        # It's a new post, so it has no tags yet
+        return 0
+
+    changed = state.attrs.category.history.has_changes()
+
+    history = state.attrs.published.load_history()
+    if history.has_changes() and not changed:
+        if get_settings().related_posts_decay_days:
+            changed = True
+        else:
+            # Unpublished posts can't be related posts, so if the post has been published or unpublished the
+            # posts that share its tags need recalculating
+            previous = list(history.deleted) + list(history.unchanged)
+            if previous:
+                was_published = previous[0] is not None
+            else:
+                # The date was changed without being loaded first, so look it up
+                was_published = _get_saved_published(post, session) is not None
+
+            changed = was_published != (post.published is not None)
+
+    if not changed:
+        return 0
+
+    return update_related_posts([post.id], session=session)
+
+
+def rebuild_all_related_posts(session=None):
+    """
+    Recalculate the related posts of every post.  Use this after changing the related posts settings
+
+    :return: The number of posts
+    """
+    if session is None:
+        session = models.session
+
+    post_ids = [row[0] for row in session.execute(select([models.CmsPost.__table__.c.id]))]
+
+    log.info('Recalculating related posts for all {} posts'.format(len(post_ids)))
+    _recalculate_in_batches(session, post_ids)
+
+    # Cached related posts need to be reloaded
+    invalidation.notify(session, invalidation.POST)
+
+    return len(post_ids)
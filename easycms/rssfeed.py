@@ -4,21 +4,153 @@ Code for generating an RSS feed for the CMS
 
 import logging
 import datetime
+import threading
+import time
+import hashlib
+import io
+import urllib.parse
+from collections import OrderedDict
 
-from lxml.builder import ElementMaker
 from lxml import etree
 from lxml.etree import CDATA
-from flask import request, make_response
+from flask import request, make_response, Response, stream_with_context
+from sqlalchemy.sql import func
+from sqlalchemy.orm import joinedload
 
 from . import get_all_posts_query
+from . import models
 from .settings import get_settings
 
 __author__ = 'Stephen Brown (Little Fish Solutions LTD)'
 
 log = logging.getLogger(__name__)
 
+# Maximum number of different feeds (i.e. different urls) to keep in the cache
+MAX_CACHED_FEEDS = 20
 
-def generate_rss_xml(website_name=None, website_description=None):
+# Maps (website_name, website_description, url) to a CachedFeed
+_feed_cache = OrderedDict()
+_feed_cache_lock = threading.Lock()
+
+
+class CachedFeed(object):
+    def __init__(self, state, xml):
+        """
+        :param state: The feed state (from get_feed_state) when the feed was generated
+        :param xml: The generated xml
+        """
+        self.state = state
+        self.xml = xml
+        self.etag = hashlib.sha1(xml.encode('utf-8')).hexdigest()
+        self.created = time.monotonic()
+
+    @property
+    def last_modified(self):
+        return self.state[-1]
+
+    def is_valid(self, state, timeout):
+        return self.state == state and time.monotonic() - self.created < timeout
+
+
+def get_feed_state(session=None):
+    """
+    Run a single cheap query to find out if anything in the feed has changed.  If the returned value is
+    the same as last time, the feed doesn't need to be regenerated
+
+    :return: Tuple of (number of posts, latest publish date, latest revision timestamp, last modified)
+    """
+    if session is None:
+        session = models.session
+
+    CmsPost = models.CmsPost
+    CmsPostRevision = models.CmsPostRevision
+
+    now = datetime.datetime.utcnow()
+
+    num_posts = session.query(
+        func.count(CmsPost.id)
+    ).filter(
+        CmsPost.published < now
+    ).as_scalar()
+
+    last_published = session.query(
+        func.max(CmsPost.published)
+    ).filter(
+        CmsPost.published < now
+    ).as_scalar()
+
+    last_revision = session.query(
+        func.max(CmsPostRevision.timestamp)
+    ).join(
+        CmsPost, CmsPostRevision.post_id == CmsPost.id
+    ).filter(
+        CmsPost.published < now
+    ).as_scalar()
+
+    num_posts, last_published, last_revision = session.query(num_posts, last_published, last_revision).one()
+
+    dates = [d for d in (last_published, last_revision) if d is not None]
+    last_modified = max(dates) if dates else None
+
+    return num_posts, last_published, last_revision, last_modified
+
+
+def clear_cache():
+    with _feed_cache_lock:
+        _feed_cache.clear()
+
+
+NSMAP = {
+    'content': 'http://purl.org/rss/1.0/modules/content/',
+    # 'wfw': 'http://wellformedweb.org/CommentAPI/',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'atom': 'http://www.w3.org/2005/Atom',
+    'sy': 'http://purl.org/rss/1.0/modules/syndication/',
+    'slash': 'http://purl.org/rss/1.0/modules/slash/'
+}
+
+
+def _ns(prefix, tag):
+    return '{{{}}}{}'.format(NSMAP[prefix], tag)
+
+
+def _write_element(xf, tag, text=None, attrib=None):
+    with xf.element(tag, attrib or {}):
+        if text is not None:
+            xf.write(text)
+
+
+def _format_datetime(dt):
+    # Wed, 28 Jan 2015 19:51:49 +0000
+    return dt.strftime('%a, %d %b %Y %H:%M:%S +0000')
+
+
+def get_page_number():
+    """
+    :return: The page of the feed requested in the query string
+    """
+    try:
+        return max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        return 1
+
+
+def get_page_url(page):
+    args = request.args.to_dict()
+    args['page'] = page
+    return '{}?{}'.format(request.base_url, urllib.parse.urlencode(args))
+
+
+def iter_rss_xml(website_name=None, website_description=None, page=None, state=None):
+    """
+    Generates the RSS feed one item at a time, so that the whole feed never needs to be held in memory.
+    Only settings.rss_max_items posts are included in each page of the feed, with RFC 5005 paging links
+    to the other pages.  This always runs exactly two queries, no matter how many posts are in the feed
+
+    :param page: The page of the feed to generate.  If None this will be read from the query string
+    :param state: The value returned by get_feed_state(), if it has already been loaded
+    :return: Generator yielding chunks of xml as strings
+    """
     settings = get_settings()
 
     if settings.view_post_url_function is None:
@@ -31,90 +163,137 @@ def generate_rss_xml(website_name=None, website_description=None):
     if website_description is None:
         website_description = 'RSS feed of all posts for {}'.format(website_name)
 
+    if page is None:
+        page = get_page_number()
+
     get_url = settings.view_post_url_function
+    max_items = settings.rss_max_items
+
+    if state is None:
+        state = get_feed_state()
+
+    num_posts, last_published, last_revision, last_modified = state
+    num_pages = max(1, (num_posts + max_items - 1) // max_items)
+
+    last_build_date = last_revision if last_revision else datetime.datetime(1900, 1, 1)
+
+    posts = get_all_posts_query().options(
+        joinedload(models.CmsPost.author),
+        joinedload(models.CmsPost.category)
+    ).offset((page - 1) * max_items).limit(max_items).all()
+
+    buffer = io.BytesIO()
+
+    def flush():
+        xf.flush()
+        chunk = buffer.getvalue().decode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    with etree.xmlfile(buffer, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element('rss', {'version': '2.0'}, nsmap=NSMAP):
+            with xf.element('channel'):
+                _write_element(xf, 'title', website_name)
+                _write_element(xf, _ns('atom', 'link'),
+                               attrib={'href': request.url, 'rel': 'self', 'type': 'application/rss+xml'})
+
+                # RFC 5005 paging links
+                _write_element(xf, _ns('atom', 'link'), attrib={'href': get_page_url(1), 'rel': 'first'})
+                if page > 1:
+                    _write_element(xf, _ns('atom', 'link'),
+                                   attrib={'href': get_page_url(page - 1), 'rel': 'previous'})
+                if page < num_pages:
+                    _write_element(xf, _ns('atom', 'link'),
+                                   attrib={'href': get_page_url(page + 1), 'rel': 'next'})
+                _write_element(xf, _ns('atom', 'link'), attrib={'href': get_page_url(num_pages), 'rel': 'last'})
+
+                _write_element(xf, 'link', request.url)
+                _write_element(xf, 'description', website_description)
+                _write_element(xf, 'lastBuildDate', _format_datetime(last_build_date))
+                _write_element(xf, 'language', 'en-GB')
+                _write_element(xf, _ns('sy', 'updatePeriod'), 'hourly')
+                _write_element(xf, _ns('sy', 'updateFrequency'), '1')
+                _write_element(xf, 'generator', 'http://littlefish.solutions/')
+                xf.write('\n')
+                yield flush()
+
+                for post in posts:
+                    post_url = get_url(post)
+                    rss_description = post.description + '&hellip; <a href="{}">Read More</a>'.format(post_url)
+                    rss_content = post.content
+
+                    if post.main_image_url:
+                        rss_content = '<img src="{}"><br><br>{}'.format(post.main_image_url, rss_content)
+
+                    with xf.element('item'):
+                        _write_element(xf, 'title', post.title)
+                        _write_element(xf, 'link', post_url)
+                        _write_element(xf, 'pubDate', _format_datetime(post.published))
+                        _write_element(xf, _ns('dc', 'creator'), CDATA(post.author.name))
+                        _write_element(xf, 'category', CDATA(post.category.name))
+                        _write_element(xf, 'guid', post_url, attrib={'isPermaLink': 'false'})
+                        _write_element(xf, 'description', CDATA(rss_description))
+                        _write_element(xf, _ns('content', 'encoded'), CDATA(rss_content))
+                        _write_element(xf, _ns('slash', 'comments'), str(0))
 
-    posts = get_all_posts_query().all()
-
-    nsmap = {
-        'content': 'http://purl.org/rss/1.0/modules/content/',
-        # 'wfw': 'http://wellformedweb.org/CommentAPI/',
-        'dc': 'http://purl.org/dc/elements/1.1/',
-        'atom': 'http://www.w3.org/2005/Atom',
-        'sy': 'http://purl.org/rss/1.0/modules/syndication/',
-        'slash': 'http://purl.org/rss/1.0/modules/slash/'
-    }
-    E = ElementMaker(nsmap=nsmap)
-
-    CONTENT = ElementMaker(nsmap={None: nsmap['content']}, namespace=nsmap['content'])
-    # WFW = ElementMaker(nsmap={None: nsmap['wfw']}, namespace=nsmap['wfw'])
-    DC = ElementMaker(nsmap={None: nsmap['dc']}, namespace=nsmap['dc'])
-    ATOM = ElementMaker(nsmap={None: nsmap['atom']}, namespace=nsmap['atom'])
-    SY = ElementMaker(nsmap={None: nsmap['sy']}, namespace=nsmap['sy'])
-    SLASH = ElementMaker(nsmap={None: nsmap['slash']}, namespace=nsmap['slash'])
-
-    def format_datetime(dt):
-        # Wed, 28 Jan 2015 19:51:49 +0000
-        return dt.strftime('%a, %d %b %Y %H:%M:%S +0000')
-
-    last_build_date = datetime.datetime(1900, 1, 1)
-
-    for post in posts:
-        build_date = post.revisions[0].timestamp
-        if build_date > last_build_date:
-            last_build_date = build_date
-
-    channel = E.channel(
-        E.title(website_name),
-        ATOM.link(href=request.url, rel='self', type='application/rss+xml'),
-        E.link(request.url),
-        E.description(website_description),
-        E.lastBuildDate(format_datetime(last_build_date)),
-        E.language('en-GB'),
-        SY.updatePeriod('hourly'),
-        SY.updateFrequency('1'),
-        E.generator('http://littlefish.solutions/')
-    )
-
-    for post in posts:
-        # comments = 0
-        # for comment in post.comments:
-        #     if comment.approved and not comment.deleted:
-        #         comments += 1
-        
-        rss_description = post.description + '&hellip; <a href="{}">Read More</a>'.format(get_url(post))
-        rss_content = post.content
-
-        if post.main_image_url:
-            rss_content = '<img src="{}"><br><br>{}'.format(post.main_image_url, rss_content)
-        
-        channel.append(
-            E.item(
-                E.title(post.title),
-                E.link(get_url(post)),
-                # E.link(url_for('blog.view_post', nice_name=post.nice_name, _external=True) + '#comments-%s' % post.id),
-                E.pubDate(format_datetime(post.published)),
-                DC.creator(CDATA(post.author.name)),
-                E.category(CDATA(post.category.name)),
-                E.guid({'isPermaLink': 'false'}, get_url(post)),
-                E.description(CDATA(rss_description)),
-                CONTENT.encoded(CDATA(rss_content)),
-                # WFW.commentRss(),
-                SLASH.comments(str(0))
-            )
-        )
-
-    rss = E.rss(
-        {'version': '2.0'},
-        channel
-    )
-
-    xml = '<?xml version="1.0" encoding="UTF-8"?>' + etree.tostring(rss, pretty_print=True).decode('utf-8')
-    
-    return xml
+                    xf.write('\n')
+                    yield flush()
+
+    yield buffer.getvalue().decode('utf-8')
+
+
+def generate_rss_xml(website_name=None, website_description=None, page=None, state=None):
+    return ''.join(iter_rss_xml(website_name, website_description, page, state))
+
+
+def get_rss_feed(website_name=None, website_description=None):
+    """
+    Returns the RSS feed for the current request, only regenerating it if a post has been
+    published or edited since it was cached
+
+    :return: CachedFeed
+    """
+    timeout = get_settings().rss_cache_timeout
+    state = get_feed_state()
+    key = (website_name, website_description, request.url)
+
+    with _feed_cache_lock:
+        feed = _feed_cache.get(key)
+
+    if feed and feed.is_valid(state, timeout):
+        return feed
+
+    # The size of the feed is limited by settings.rss_max_items, so it's safe to hold in memory
+
+    feed = CachedFeed(state, generate_rss_xml(website_name, website_description, state=state))
+
+    if timeout:
+        with _feed_cache_lock:
+            _feed_cache[key] = feed
+            _feed_cache.move_to_end(key)
+            while len(_feed_cache) > MAX_CACHED_FEEDS:
+                _feed_cache.popitem(last=False)
+
+    return feed
 
 
 def rss_flask_view(website_name=None, website_description=None):
-    xml = generate_rss_xml(website_name, website_description)
-    response = make_response(xml)
+    """
+    Flask view for the RSS feed.  Supports conditional requests (If-None-Match and If-Modified-Since)
+    and will return 304 Not Modified if the feed hasn't changed
+    """
+    if not get_settings().rss_cache_timeout:
+        # Caching is disabled - stream the feed out as it is generated
+        return Response(stream_with_context(iter_rss_xml(website_name, website_description)),
+                        content_type='text/xml')
+
+    feed = get_rss_feed(website_name, website_description)
+    response = make_response(feed.xml)
     response.headers['Content-Type'] = 'text/xml'  # 'application/rss+xml'
-    return response
+    response.set_etag(feed.etag)
+    if feed.last_modified:
+        response.last_modified = feed.last_modified
+
+    return response.make_conditional(request)
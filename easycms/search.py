@@ -0,0 +1,143 @@
+"""
+Full text search of posts, using PostgreSQL text search.  Each post has a search_vector column built from
+its title, tagline and the text of its content (see CmsPost.make_search_vector), which is kept up to
+date whenever a post is saved and has a GIN index, so searches only look at the posts that match.
+
+The search terms use the same syntax as web search engines: "quoted phrases", OR and -excluded words.
+Results are ranked with ts_rank and the matches in each result are highlighted with ts_headline, which
+is only run on the posts that are displayed
+"""
+
+import logging
+
+from flask import Markup, escape
+from sqlalchemy import Float, cast
+from sqlalchemy.sql import func, select
+from unidecode import unidecode
+
+from . import models, cmsutil
+from .settings import get_settings
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+# Number of posts to update in each transaction when rebuilding the search vectors
+BATCH_SIZE = 500
+
+# ts_rank normalisation: divide the rank by 1 + the logarithm of the document length, so that long
+# posts don't always outrank short posts
+RANK_NORMALISATION = 1
+
+
+class SearchResult(object):
+    def __init__(self, post, rank, headline=None):
+        """
+        :param post: The CmsPost
+        :param rank: The ts_rank of the post.  Higher is better
+        :param headline: Markup of the parts of the content that match the search terms, with the matching
+                         words highlighted, or None if it wasn't requested
+        """
+        self.post = post
+        self.rank = rank
+        self.headline = headline
+
+
+def get_ts_query(search_terms):
+    """
+    :return: SQL expression for the tsquery of the search terms
+    """
+    # The indexed text has been through unidecode (see CmsPost.make_search_vector), so the search terms need to
+    # be too
+    return func.websearch_to_tsquery(get_settings().search_config, unidecode(search_terms))
+
+
+def get_rank(ts_query):
+    """
+    :return: SQL expression for the rank of a post
+    """
+    # ts_rank returns a real.  It is converted to a double so that the value in the pager cursors compares
+    # exactly with the rank in the database
+    return cast(func.ts_rank(models.CmsPost.search_vector, ts_query, RANK_NORMALISATION), Float)
+
+
+def get_headlines(search_terms, post_ids, session=None):
+    """
+    Highlight the search terms in the content of some posts.  The headlines are made from the same
+    unidecoded text as the search vectors, so that accented words are highlighted
+
+    :return: Dict of post id to Markup
+    """
+    if session is None:
+        session = models.session
+
+    if not post_ids:
+        return {}
+
+    settings = get_settings()
+    posts = models.CmsPost.__table__
+
+    rows = session.execute(
+        select([posts.c.id, posts.c.content]).where(posts.c.id.in_(list(post_ids)))
+    ).fetchall()
+
+    if not rows:
+        return {}
+
+    ts_query = get_ts_query(search_terms)
+    # The text is escaped before ts_headline adds the highlighting tags, so the headline is safe to display
+    texts = [str(escape(cmsutil.get_text(cmsutil.parse_html(content or '')))) for post_id, content in rows]
+
+    # All of the headlines are made in one query
+    headlines = session.execute(select([
+        func.ts_headline(settings.search_config, text, ts_query, settings.search_headline_options)
+        for text in texts
+    ])).fetchone()
+
+    return {post_id: Markup(headline) for (post_id, content), headline in zip(rows, headlines)}
+
+
+def rebuild_search_vectors(only_missing=False, session=None):
+    """
+    Rebuild the search vectors of all posts, in batches.  Each batch is committed.  Use this after
+    changing settings.search_config
+
+    :param only_missing: Only update posts that don't have a search vector yet
+    :return: The number of posts that were updated
+    """
+    if session is None:
+        session = models.session
+
+    posts = models.CmsPost.__table__
+    last_id = None
+    num_updated = 0
+
+    while True:
+        query = select([
+            posts.c.id, posts.c.title, posts.c.tagline, posts.c.content
+        ]).order_by(
+            posts.c.id
+        ).limit(BATCH_SIZE)
+
+        if last_id is not None:
+            query = query.where(posts.c.id > last_id)
+
+        if only_missing:
+            query = query.where(posts.c.search_vector == None)
+
+        rows = session.execute(query).fetchall()
+        if not rows:
+            break
+
+        for post_id, title, tagline, content in rows:
+            session.execute(posts.update().where(posts.c.id == post_id).values(
+                search_vector=models.CmsPost.make_search_vector(title, tagline, content)
+            ))
+
+        session.commit()
+
+        last_id = rows[-1][0]
+        num_updated += len(rows)
+        log.info('Updated search vectors of {} posts'.format(num_updated))
+
+    return num_updated
@@ -54,8 +54,11 @@ class EasyCmsSettings(object):
             snippet_image_width=350,
             snippet_image_height=200,
             snippet_image_subfolder='cms-snippet-images',
+            snippet_image_widths=None,
             snippet_description_max_length=170,
             snippet_missing_image_url=None,
+            snippet_image_workers=2,
+            snippet_image_download_timeout=10,
             pil_saved_image_quality=98,
             pil_saved_image_subsampling=0,
             pil_saved_image_compression_level=9,
@@ -70,13 +73,33 @@ class EasyCmsSettings(object):
             post_main_image_width=None,
             post_main_image_height=None,
             post_main_image_required=False,
+            main_image_widths=None,
+            main_image_variant_subfolder='cms-main-images',
+            image_webp_enabled=True,
             post_code_is_edittable=False,
             view_post_url_function=None,
             comments_enabled=False,
             comment_added_hook=None,
             comment_reply_hook=None,
             page_publishing_enabled=False,
-            page_needs_publishing_hook=None
+            page_needs_publishing_hook=None,
+            rss_cache_timeout=600,
+            rss_max_items=50,
+            comment_rate_limits=None,
+            comment_rate_limit_backend=None,
+            page_cache_timeout=0,
+            page_cache_max_size=100,
+            cache_invalidation_channel=None,
+            query_cache_timeout=0,
+            query_cache_max_size=1000,
+            query_cache_backend=None,
+            query_cache_key_prefix='easycms:',
+            related_posts_max=10,
+            related_posts_tag_weight=1.0,
+            related_posts_category_weight=0.5,
+            related_posts_decay_days=None,
+            search_config='english',
+            search_headline_options='MaxFragments=2, MaxWords=30, MinWords=15, StartSel=<mark>, StopSel=</mark>'
     ):
         """
         :param home_link_text: Text for home link in editor
@@ -95,8 +118,16 @@ class EasyCmsSettings(object):
         :param snippet_image_width: Width of snippet image in pixels
         :param snippet_image_height: Height of snippet image in pixels
         :param snippet_image_subfolder: Subfolder inside filemanager directory to store snippet images
+        :param snippet_image_widths: List of extra widths to save each snippet image at, for responsive images
+                                     (srcset).  The heights keep the same aspect ratio as the snippet image
         :param snippet_description_max_length: Maximum length of snippet text
         :param snippet_missing_image_url: URL of image to use when there is no snippet image
+        :param snippet_image_workers: Number of background threads used to create snippet images when a post is
+                                      saved.  Set to 0 to create them during the request instead.  The job
+                                      status is only held in the process that queued the job (see
+                                      snippetworker.py)
+        :param snippet_image_download_timeout: Timeout in seconds when downloading an image to create a snippet
+                                               image from
         :param pil_saved_image_quality: Quality to save system generated images i.e. snippet images
         :param pil_saved_image_subsampling: Subsampling to save system generated images i.e. snippet images
         :param pil_saved_image_compression_level: Compression to save system generated images i.e. snippet images
@@ -111,6 +142,12 @@ class EasyCmsSettings(object):
         :param post_main_image_width: Unused
         :param post_main_image_height: Unused
         :param post_main_image_required: Is a "main" image required? Otherwise it will be optional
+        :param main_image_widths: List of widths to save scaled down copies of each post's main image at, for
+                                  responsive images (srcset).  Set to None to disable
+        :param main_image_variant_subfolder: Subfolder inside filemanager directory to store the scaled down
+                                             copies of main images
+        :param image_webp_enabled: Also save snippet and main image variants in WebP format, if Pillow
+                                   supports it
         :param post_code_is_edittable: Can the code of a post be editted?
         :param view_post_url_function: Set to a function that takes a post as its only argument and returns a url
                                        to view that post. The returned URL must be a full URL (i.e. use
@@ -130,6 +167,52 @@ class EasyCmsSettings(object):
                                     called every time a page is saved when page publishing is enabled and can
                                     be used to send an email notifying someone that the page needs to be
                                     published if you want to implement an approval system
+        :param rss_cache_timeout: Maximum number of seconds to cache the generated RSS feed for.  The feed
+                                  is always regenerated after a post is published or edited, so this only
+                                  limits how long other changes (i.e. to categories) can take to appear.
+                                  Set to 0 to disable caching
+        :param rss_max_items: Maximum number of posts in each page of the RSS feed.  Older posts can be
+                              reached by following the (RFC 5005) paging links in the feed
+        :param comment_rate_limits: List of easycms.ratelimit.RateLimit objects limiting how often comments can
+                                    be made from each IP address.  Limits can apply to each post or to the
+                                    whole site.  Defaults to 1 comment per post every 2 minutes
+        :param comment_rate_limit_backend: easycms.ratelimit backend used to check the rate limits.  Defaults
+                                           to DatabaseRateLimitBackend, which counts the comments in the
+                                           database.  Use MemoryRateLimitBackend or CacheRateLimitBackend to
+                                           reject floods of comments without touching the database
+        :param page_cache_timeout: Maximum number of seconds to cache pages and published pages for.  Pages are
+                                   removed from the cache when they are edited or published.  Defaults to
+                                   0, which disables the page cache
+        :param page_cache_max_size: Maximum number of pages to keep in the page cache
+        :param cache_invalidation_channel: PostgreSQL NOTIFY channel used to tell the other processes when
+                                           cached content has changed, so that every worker evicts it from
+                                           its cache, e.g. 'easycms_cache_invalidation'.  Defaults to
+                                           None, which disables the notifications.  Set it when the page
+                                           or query cache is used with more than one process
+        :param query_cache_timeout: Maximum number of seconds to cache the results of query functions such as
+                                    get_post_by_code, get_recent_posts, get_all_categories and get_all_tags
+                                    for.  Results are invalidated when the content changes, but posts that
+                                    are scheduled to be published can take this long to appear.  Defaults to
+                                    0, which disables the query cache
+        :param query_cache_max_size: Maximum number of results to keep in the default (in-process) query cache
+        :param query_cache_backend: Cache to store query results in.  Can be an easycms.cache.MemoryCache,
+                                    FileSystemCache or MemcachedCache, or any cache with the same interface
+                                    as cachelib (i.e. a cachelib RedisCache).  Defaults to a MemoryCache in
+                                    each process
+        :param query_cache_key_prefix: Prefix for all query cache keys, so that a shared backend can be used
+                                       by more than one site
+        :param related_posts_max: Number of related posts to store for each post
+        :param related_posts_tag_weight: Score given to a related post for each tag it shares with the post
+        :param related_posts_category_weight: Score given to a related post if it is in the same category as
+                                              the post
+        :param related_posts_decay_days: If set, the score of a related post is halved for every this many
+                                         days between it and the post.  Call
+                                         relatedposts.rebuild_all_related_posts() (or run the
+                                         rebuild-related-posts command) after changing any of these
+        :param search_config: PostgreSQL text search configuration (language) used to index and search posts.
+                              Run the rebuild-search-index command after changing this
+        :param search_headline_options: Options passed to ts_headline when highlighting the search terms in
+                                        search results
         """
         self.home_link_text = home_link_text
         self.home_link_endpoint = home_link_endpoint
@@ -141,8 +224,11 @@ class EasyCmsSettings(object):
         self.snippet_image_width = snippet_image_width
         self.snippet_image_height = snippet_image_height
         self.snippet_image_subfolder = snippet_image_subfolder
+        self.snippet_image_widths = snippet_image_widths
         self.snippet_description_max_length = snippet_description_max_length
         self.snippet_missing_image_url = snippet_missing_image_url
+        self.snippet_image_workers = snippet_image_workers
+        self.snippet_image_download_timeout = snippet_image_download_timeout
         self.pil_saved_image_quality = pil_saved_image_quality
         self.pil_saved_image_subsampling = pil_saved_image_subsampling
         self.pil_saved_image_compression_level = pil_saved_image_compression_level
@@ -157,6 +243,9 @@ class EasyCmsSettings(object):
         self.post_main_image_width = post_main_image_width
         self.post_main_image_height = post_main_image_height
         self.post_main_image_required = post_main_image_required
+        self.main_image_widths = main_image_widths
+        self.main_image_variant_subfolder = main_image_variant_subfolder
+        self.image_webp_enabled = image_webp_enabled
         self.post_code_is_edittable = post_code_is_edittable
         self.view_post_url_function = view_post_url_function
         self.comments_enabled = comments_enabled
@@ -164,6 +253,23 @@ class EasyCmsSettings(object):
         self.comment_reply_hook = comment_reply_hook
         self.page_publishing_enabled = page_publishing_enabled
         self.page_needs_publishing_hook = page_needs_publishing_hook
+        self.rss_cache_timeout = rss_cache_timeout
+        self.rss_max_items = rss_max_items
+        self.comment_rate_limits = comment_rate_limits
+        self.comment_rate_limit_backend = comment_rate_limit_backend
+        self.page_cache_timeout = page_cache_timeout
+        self.page_cache_max_size = page_cache_max_size
+        self.cache_invalidation_channel = cache_invalidation_channel
+        self.query_cache_timeout = query_cache_timeout
+        self.query_cache_max_size = query_cache_max_size
+        self.query_cache_backend = query_cache_backend
+        self.query_cache_key_prefix = query_cache_key_prefix
+        self.related_posts_max = related_posts_max
+        self.related_posts_tag_weight = related_posts_tag_weight
+        self.related_posts_category_weight = related_posts_category_weight
+        self.related_posts_decay_days = related_posts_decay_days
+        self.search_config = search_config
+        self.search_headline_options = search_headline_options
         
         if self._ckeditor_config is None:
             self._ckeditor_config = CkeditorConfig()
@@ -173,6 +279,11 @@ class EasyCmsSettings(object):
         filemanager_path = filemanager.get_root_path()
         return os.path.join(filemanager_path, self.snippet_image_subfolder)
 
+    @property
+    def main_image_variant_file_path(self):
+        filemanager_path = filemanager.get_root_path()
+        return os.path.join(filemanager_path, self.main_image_variant_subfolder)
+
     @property
     def front_end_post_urls_enabled(self):
         return self.view_post_url_function is not None
@@ -0,0 +1,230 @@
+"""
+Creates snippet images (and the responsive versions of main images) in a background thread pool, so that
+saving a post doesn't have to wait for the image to be downloaded, resized and saved.  The editor polls the
+job status and the post's snippet image is set when the job completes.  Set snippet_image_workers to 0 to
+process images in the request instead.
+
+Jobs should only be queued after the post has been committed, as the worker only updates the post if its
+image hasn't changed since the job was queued.  The queue and the job status are held in the memory of
+the process that queued the job, so with several worker processes a status request may be handled by a
+process that doesn't know about the job.  In that case the snippet image status endpoint only reports
+whether the post has a snippet image yet
+"""
+
+import logging
+import threading
+import uuid
+import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+
+from . import models, cmsutil, invalidation
+from .settings import get_settings
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Job types
+SNIPPET_IMAGE = 'snippet'
+MAIN_IMAGE_VARIANTS = 'main'
+
+# Maximum number of finished jobs to remember the status of
+MAX_FINISHED_JOBS = 1000
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Maps job id to SnippetImageJob, oldest first
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+class SnippetImageJob(object):
+    def __init__(self, post_id, image_url, only_if_missing, job_type=SNIPPET_IMAGE):
+        """
+        :param post_id: Id of the post to set the snippet image on
+        :param image_url: Url of the image to make the snippet image from
+        :param only_if_missing: If True, the snippet image will only be set if the post still doesn't have one
+        :param job_type: SNIPPET_IMAGE or MAIN_IMAGE_VARIANTS
+        """
+        self.id = uuid.uuid4().hex
+        self.job_type = job_type
+        self.post_id = post_id
+        self.image_url = image_url
+        self.only_if_missing = only_if_missing
+        self.created = datetime.datetime.utcnow()
+        self.status = PENDING
+        self.snippet_image = None
+        self.error = None
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'type': self.job_type,
+            'postId': self.post_id,
+            'status': self.status,
+            'snippetImage': self.snippet_image,
+            'error': self.error
+        }
+
+
+def _get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            num_workers = get_settings().snippet_image_workers
+            log.info('Starting {} snippet image worker threads'.format(num_workers))
+            _executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='easycms-snippet')
+
+        return _executor
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def get_latest_job_for_post(post_id, job_type=SNIPPET_IMAGE):
+    """
+    :return: The most recently queued SnippetImageJob of this type for the post, or None
+    """
+    with _jobs_lock:
+        for job in reversed(_jobs.values()):
+            if job.post_id == post_id and job.job_type == job_type:
+                return job
+
+    return None
+
+
+def _add_job(job):
+    with _jobs_lock:
+        _jobs[job.id] = job
+
+        # Forget about the oldest finished jobs
+        num_finished = sum(1 for j in _jobs.values() if j.finished)
+        for old_job in list(_jobs.values()):
+            if num_finished <= MAX_FINISHED_JOBS:
+                break
+
+            if old_job.finished:
+                del _jobs[old_job.id]
+                num_finished -= 1
+
+
+def _run_job(job, full_image_url):
+    job.status = RUNNING
+    session = models.Session()
+
+    try:
+        image_data = cmsutil.download_image_data(full_image_url)
+        extension = cmsutil.get_image_extension(job.image_url)
+        post_table = models.CmsPost.__table__
+        update = post_table.update().where(post_table.c.id == job.post_id)
+
+        if job.job_type == MAIN_IMAGE_VARIANTS:
+            variants = cmsutil.save_main_image_variants(image_data, extension)
+            # Only store the variants if the main image hasn't been changed again since the job was queued
+            update = update.where(post_table.c.main_image_url == job.image_url).values(
+                main_image_variants=models.CmsPost.make_image_variants(job.image_url, variants,
+                                                                       cmsutil.get_image_size(image_data))
+            )
+        else:
+            fm_path = cmsutil.save_snippet_image(image_data, extension)
+            job.snippet_image = cmsutil.get_userfile_url(fm_path)
+            variants = cmsutil.save_snippet_image_variants(image_data, extension)
+
+            if job.only_if_missing:
+                update = update.where(post_table.c.snippet_image == None)
+
+            update = update.values(
+                snippet_image=job.snippet_image,
+                snippet_image_variants=models.CmsPost.make_image_variants(job.snippet_image, variants)
+            )
+
+        session.execute(update)
+        invalidation.notify(session, invalidation.POST, job.post_id)
+        session.commit()
+
+        job.status = DONE
+        log.info('{} image job for post {} finished'.format(job.job_type, job.post_id))
+    except Exception as e:
+        session.rollback()
+        job.error = str(e)
+        job.status = FAILED
+        log.exception('{} image job for post {} failed for {}'.format(job.job_type, job.post_id, job.image_url))
+    finally:
+        session.close()
+
+
+def queue_snippet_image(post, image_url, only_if_missing=False, job_type=SNIPPET_IMAGE):
+    """
+    Queue a job to create the snippet image for a post.  Must be called inside a request.  If the same
+    image is already queued for the post, the existing job is returned
+
+    :param post: The CmsPost
+    :param image_url: The url of the image to make the snippet image from
+    :param only_if_missing: If True, the snippet image will only be set if the post doesn't have one when
+                            the job completes
+    :param job_type: SNIPPET_IMAGE or MAIN_IMAGE_VARIANTS
+    :return: The SnippetImageJob
+    """
+    job = get_latest_job_for_post(post.id, job_type)
+    if job and not job.finished and job.image_url == image_url:
+        return job
+
+    job = SnippetImageJob(post.id, image_url, only_if_missing, job_type)
+    full_image_url = cmsutil.get_full_image_url(image_url)
+    _add_job(job)
+
+    # The job needs a request context to generate the url of the saved image
+    run_job = flask.copy_current_request_context(_run_job)
+    _get_executor().submit(run_job, job, full_image_url)
+
+    return job
+
+
+def add_default_snippet(post):
+    """
+    Create the snippet image for a post from the first image in its content.  If snippet_image_workers is
+    0 this is done immediately, otherwise it is queued
+
+    :return: The SnippetImageJob, or None if the post has no images or the image was created immediately
+    """
+    imgs = post.get_images()
+    if not imgs:
+        return None
+
+    if not get_settings().snippet_image_workers:
+        cmsutil.add_default_snippet(post)
+        return None
+
+    log.info('Queueing snippet image for post {}: {}'.format(post.id, imgs[0]))
+    return queue_snippet_image(post, imgs[0], only_if_missing=True)
+
+
+def add_main_image_variants(post):
+    """
+    Create the responsive versions of a post's main image.  If snippet_image_workers is 0 this is done
+    immediately, otherwise it is queued
+
+    :return: The SnippetImageJob, or None if the variants were created immediately
+    """
+    if not get_settings().snippet_image_workers:
+        cmsutil.process_and_save_main_image_variants(post)
+        return None
+
+    log.info('Queueing main image variants for post {}: {}'.format(post.id, post.main_image_url))
+    return queue_snippet_image(post, post.main_image_url, job_type=MAIN_IMAGE_VARIANTS)
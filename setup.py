@@ -8,12 +8,12 @@ setup(
     name='easycms',
     packages=['easycms', 'easycms.templates', 'easycms.static', 'easycms.customfields'],
     include_package_data=True,
-    version='0.3.15',
+    version='0.14.0',
     description='CMS and Blogging Sysetm for Flask',
     author='Stephen Brown (Little Fish Solutions LTD)',
     author_email='opensource@littlefish.solutions',
     url='https://github.com/stevelittlefish/easycms',
-    download_url='https://github.com/stevelittlefish/easycms/archive/v0.3.15.tar.gz',
+    download_url='https://github.com/stevelittlefish/easycms/archive/v0.14.0.tar.gz',
     keywords=['flask', 'jinja2', 'easy', 'cms', 'blog'],
     license='LGPLv3',
     classifiers=[
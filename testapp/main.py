@@ -71,7 +71,7 @@ def index():
 
     pager = easycms.get_all_posts_pager(
         request.args.get('page', 1), num_per_page=CMS_NUM_PER_PAGE, post_type=posttypes.NEWS,
-        session=db.session, allow_unpublished=has_permission(Permissions.admin)
+        session=db.session, allow_unpublished=has_permission(Permissions.admin), defer_content=True
     )
 
     homepage = easycms.get_published_page_by_code(pagecodes.HOMEPAGE)
@@ -87,13 +87,10 @@ def view_blog_post(post_code):
         abort(404)
     
     can_view_all = has_permission(Permissions.admin)
-    prev_post = post.get_prev_post(include_non_published=can_view_all)
-    next_post = post.get_next_post(include_non_published=can_view_all)
+    prev_post, next_post = post.get_prev_and_next_posts(include_non_published=can_view_all)
 
     # Related posts
-    related_posts = easycms.get_all_posts_query(post_type=post.post_type).filter(
-        easycms.models.CmsPost.id != post.id
-    )[:4]
+    related_posts = easycms.get_related_posts(post, num_posts=4, allow_unpublished=can_view_all)
 
     can_edit = has_permission(Permissions.admin)
     can_edit_seo = has_permission(Permissions.admin)
@@ -118,11 +115,13 @@ def view_blog_post(post_code):
             reply_to_id = None
 
     comments_form = easycms.comments.create_and_process_comment_form(post, action='#leave-a-comment')
+    comment_tree = easycms.get_comment_tree(post)
 
     return render_template('view_post.html', post=post, prev_post=prev_post,
                            next_post=next_post, can_edit=can_edit, can_edit_seo=can_edit_seo,
                            show_tools=show_tools, related_posts=related_posts,
-                           comments_form=comments_form, can_manage_comments=can_manage_comments,
+                           comments_form=comments_form, comment_tree=comment_tree,
+                           can_manage_comments=can_manage_comments,
                            reply_to_author_name=reply_to_author_name, reply_to_id=reply_to_id)
 
 
@@ -0,0 +1,183 @@
+"""
+Base class for tests that need a PostgreSQL database.  Set EASYCMS_TEST_DATABASE_URL to the SQLAlchemy
+url of an empty database that can be used for testing.  The tests are skipped if it isn't set or the
+database can't be reached.
+
+EasyCMS is initialised once per process.  All of the posts, tags, categories, authors and users (and
+everything that references them) are deleted after each test, so the database must not be used for
+anything else
+"""
+
+import os
+import datetime
+import tempfile
+import unittest
+
+import sqlalchemy
+import sqlalchemy.exc
+from flask import Flask
+
+import easycms
+from easycms import models, querycache, pagecache, accesscontrol
+from easycms.settings import EasyCmsSettings, get_settings
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+DATABASE_URL_VARIABLE = 'EASYCMS_TEST_DATABASE_URL'
+
+_app = None
+_engine = None
+
+
+def _connect():
+    """
+    :return: The engine for the test database, or None if it isn't available
+    """
+    url = os.environ.get(DATABASE_URL_VARIABLE)
+    if not url:
+        return None
+
+    engine = sqlalchemy.create_engine(url)
+    try:
+        engine.connect().close()
+    except sqlalchemy.exc.OperationalError:
+        return None
+
+    return engine
+
+
+def get_app():
+    """
+    Initialise EasyCMS against the test database, the first time this is called
+
+    :return: The Flask app
+    :raises unittest.SkipTest: If the test database isn't available
+    """
+    global _app, _engine
+
+    if _app is not None:
+        return _app
+
+    engine = _connect()
+    if engine is None:
+        raise unittest.SkipTest('PostgreSQL is not available - set {} to run this test'
+                                .format(DATABASE_URL_VARIABLE))
+
+    app = Flask(__name__)
+    app.secret_key = 'EasyCmsTests'
+    app.config['FLASKFILEMANAGER_FILE_PATH'] = tempfile.mkdtemp(prefix='easycms-tests-')
+
+    # The caches are turned off so that every test sees the database.  Tests of the caches turn them on
+    settings = EasyCmsSettings(
+        view_post_url_function=lambda post: 'http://example.com/posts/' + post.code,
+        comments_enabled=True,
+        snippet_image_workers=0,
+        rss_cache_timeout=0,
+        page_cache_timeout=0,
+        query_cache_timeout=0,
+        cache_invalidation_channel=None
+    )
+
+    with app.app_context():
+        easycms.init(app, engine, settings=settings, update_db=True, instrument_queries=True)
+
+    app.register_blueprint(easycms.blueprint, url_prefix='/cms')
+
+    _app = app
+    _engine = engine
+    return app
+
+
+class VisitorAccessControl(accesscontrol.AccessControlConfig):
+    """
+    A visitor to the website, who can't use the editor
+    """
+
+    def can_view_editor(self):
+        return False
+
+    def can_edit_post(self):
+        return False
+
+    def can_moderate_comments(self):
+        return False
+
+
+class DatabaseTestCase(unittest.TestCase):
+    # Settings to change for every test in the class.  They are put back after each test
+    settings = {}
+    # AccessControlConfig to use for every test in the class, or None for the default (which allows everything)
+    access_control = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = get_app()
+
+    def setUp(self):
+        self.session = models.session
+
+        settings = get_settings()
+        self._old_settings = {name: getattr(settings, name) for name in self.settings}
+        for name, value in self.settings.items():
+            setattr(settings, name, value)
+
+        self._old_access_control = accesscontrol.get_access_control()
+        if self.access_control is not None:
+            accesscontrol.init(self.access_control)
+
+        self._num_created = 0
+
+    def tearDown(self):
+        self.session.rollback()
+        self.session.close()
+
+        tables = [model.__table__.name for model in (models.CmsPost, models.CmsTag, models.CmsCategory,
+                                                     models.CmsUser, models.CmsAuthor)]
+        with _engine.begin() as connection:
+            connection.execute('TRUNCATE {} CASCADE'.format(', '.join(tables)))
+
+        settings = get_settings()
+        for name, value in self._old_settings.items():
+            setattr(settings, name, value)
+
+        accesscontrol.init(self._old_access_control)
+        querycache.init(settings)
+        pagecache.init(settings)
+
+    def _get_number(self):
+        self._num_created += 1
+        return self._num_created
+
+    def create_category(self, name=None):
+        number = self._get_number()
+        category = models.CmsCategory('post', name or 'Category {}'.format(number), 'category-{}'.format(number))
+        self.session.add(category)
+        return category
+
+    def create_author(self):
+        number = self._get_number()
+        author = models.CmsAuthor('Author {}'.format(number), 'author-{}'.format(number))
+        self.session.add(author)
+        return author
+
+    def create_post(self, title=None, content='<p>Content</p>', tagline='Tagline', category=None, author=None,
+                    published=True, tags=()):
+        """
+        Create a post, with a new category and author if they aren't given.  The post isn't committed
+
+        :param published: True to publish the post in the past, a datetime, or None for a draft
+        """
+        number = self._get_number()
+
+        post = models.CmsPost('post', category or self.create_category(), title or 'Post {}'.format(number),
+                              content, author or self.create_author(), tagline)
+
+        if published is True:
+            # The published dates are unique
+            post.published = datetime.datetime.utcnow() - datetime.timedelta(minutes=number)
+        else:
+            post.published = published
+
+        post.tags = list(tags)
+        self.session.add(post)
+        return post
@@ -0,0 +1,29 @@
+"""
+Tests for the html helpers in cmsutil.py
+"""
+
+import unittest
+
+from easycms import cmsutil
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+
+class GetImageUrlsTest(unittest.TestCase):
+    def get_image_urls(self, html):
+        return cmsutil.get_image_urls(cmsutil.parse_html(html))
+
+    def test_image_urls_are_in_order(self):
+        html = '<p><img src="/a.png">Text</p><div><img src="http://example.com/b.jpg"></div>'
+        self.assertEqual(self.get_image_urls(html), ['/a.png', 'http://example.com/b.jpg'])
+
+    def test_images_without_src_are_skipped(self):
+        html = '<img><img src=""><img data-src="/lazy.png"><img src="/a.png">'
+        self.assertEqual(self.get_image_urls(html), ['/a.png'])
+
+    def test_no_images(self):
+        self.assertEqual(self.get_image_urls('<p>Text</p>'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
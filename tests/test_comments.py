@@ -0,0 +1,237 @@
+"""
+Tests for the comment counts, comment tree and comment pager.  These need a PostgreSQL database (see
+dbtest.py)
+"""
+
+import datetime
+import unittest
+
+import easycms
+from easycms import models, constants, accesscontrol, querystats
+
+from dbtest import DatabaseTestCase, VisitorAccessControl
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+
+class CommentTestCase(DatabaseTestCase):
+    access_control = VisitorAccessControl()
+
+    def setUp(self):
+        super().setUp()
+
+        self.post = self.create_post()
+        self.session.commit()
+
+        self._timestamp = datetime.datetime(2020, 1, 1)
+
+    def create_comment(self, post=None, approved=True, reply_to=None, email='commenter@example.com'):
+        """
+        Create a comment.  Each comment is a minute newer than the last.  The comment isn't committed
+        """
+        comment = models.CmsComment(post or self.post, 'Comment', author_name='Commenter',
+                                    author_email=email, reply_to=reply_to)
+        comment.approved = approved
+
+        self._timestamp += datetime.timedelta(minutes=1)
+        comment.timestamp = self._timestamp
+
+        self.session.add(comment)
+        return comment
+
+
+class CommentCountTest(CommentTestCase):
+    def assert_counts(self, post, num_approved, num_pending):
+        self.session.refresh(post)
+        self.assertEqual((post.num_approved_comments, post.num_pending_comments), (num_approved, num_pending))
+
+    def test_new_post_has_no_comments(self):
+        self.assert_counts(self.post, 0, 0)
+        self.assertFalse(self.post.has_visible_comments())
+
+    def test_counts_follow_approval_and_deletion(self):
+        comment = self.create_comment(approved=False)
+        self.create_comment()
+        self.session.commit()
+        self.assert_counts(self.post, 1, 1)
+
+        comment.approved = True
+        self.session.commit()
+        self.assert_counts(self.post, 2, 0)
+
+        comment.deleted = True
+        self.session.commit()
+        self.assert_counts(self.post, 1, 0)
+
+    def test_counts_follow_deleted_rows(self):
+        comment = self.create_comment()
+        self.session.commit()
+        self.assert_counts(self.post, 1, 0)
+
+        self.session.delete(comment)
+        self.session.commit()
+        self.assert_counts(self.post, 0, 0)
+
+    def test_counts_follow_comment_moved_to_another_post(self):
+        other_post = self.create_post()
+        comment = self.create_comment()
+        self.session.commit()
+
+        comment.post = other_post
+        self.session.commit()
+        self.assert_counts(self.post, 0, 0)
+        self.assert_counts(other_post, 1, 0)
+
+    def test_visible_comments_include_own_pending_comments(self):
+        self.create_comment()
+        self.create_comment(approved=False, email='mine@example.com')
+        self.create_comment(approved=False, email='other@example.com')
+        self.session.commit()
+
+        with self.app.test_request_context('/'):
+            self.assertEqual(self.post.num_visible_comments(), 1)
+
+        with self.app.test_request_context('/', headers={'Cookie': '{}=mine@example.com'.format(
+                constants.COMMENT_EMAIL_COOKIE_NAME)}):
+            self.assertEqual(self.post.num_visible_comments(), 2)
+
+
+class CommentTreeTestCase(CommentTestCase):
+    def get_tree(self, email=None):
+        """
+        :return: List of (comment, depth) in display order
+        """
+        # Load the post first, so that only the query for the tree is counted
+        self.session.expire_all()
+        self.session.refresh(self.post)
+
+        headers = {}
+        if email:
+            headers['Cookie'] = '{}={}'.format(constants.COMMENT_EMAIL_COOKIE_NAME, email)
+
+        with self.app.test_request_context('/', headers=headers):
+            with querystats.track_queries() as stats:
+                roots = easycms.get_comment_tree(self.post)
+
+        self.assertEqual(stats.num_queries, 1)
+        return [(node.comment, node.depth) for root in roots for node in root]
+
+
+class CommentTreeTest(CommentTreeTestCase):
+    def test_tree_order_and_depth(self):
+        first = self.create_comment()
+        second = self.create_comment()
+        reply = self.create_comment(reply_to=first)
+        reply_to_reply = self.create_comment(reply_to=reply)
+        second_reply = self.create_comment(reply_to=first)
+        self.create_comment(post=self.create_post())
+        self.session.commit()
+
+        self.assertEqual(self.get_tree(), [
+            (first, 0), (reply, 1), (reply_to_reply, 2), (second_reply, 1), (second, 0)
+        ])
+
+    def test_replies_to_hidden_comments_move_up(self):
+        deleted = self.create_comment()
+        deleted.deleted = True
+        reply_to_deleted = self.create_comment(reply_to=deleted)
+
+        root = self.create_comment()
+        pending = self.create_comment(reply_to=root, approved=False)
+        reply_to_pending = self.create_comment(reply_to=pending)
+        self.session.commit()
+
+        self.assertEqual(self.get_tree(), [(reply_to_deleted, 0), (root, 0), (reply_to_pending, 1)])
+
+    def test_own_pending_comments_are_visible(self):
+        root = self.create_comment()
+        mine = self.create_comment(reply_to=root, approved=False, email='mine@example.com')
+        self.create_comment(reply_to=root, approved=False, email='other@example.com')
+        self.session.commit()
+
+        self.assertEqual(self.get_tree(), [(root, 0)])
+        self.assertEqual(self.get_tree(email='mine@example.com'), [(root, 0), (mine, 1)])
+
+
+class ModeratorCommentTreeTest(CommentTreeTestCase):
+    access_control = accesscontrol.AccessControlConfig()
+
+    def test_moderators_see_every_comment(self):
+        deleted = self.create_comment()
+        deleted.deleted = True
+        pending = self.create_comment(reply_to=deleted, approved=False)
+        self.session.commit()
+
+        self.assertEqual(self.get_tree(), [(deleted, 0), (pending, 1)])
+
+
+class CommentPagerTest(CommentTestCase):
+    def get_page(self, cursor=None):
+        self.session.expire_all()
+        self.session.refresh(self.post)
+
+        with self.app.test_request_context('/'):
+            with querystats.track_queries() as stats:
+                pager = easycms.get_comment_threads_keyset_pager(self.post, cursor, num_per_page=2)
+
+        self.assertEqual(stats.num_queries, 2)
+        return pager
+
+    def get_roots(self, pager):
+        return [node.comment for node in pager.items]
+
+    def test_pages_forwards_and_backwards(self):
+        roots = [self.create_comment() for i in range(5)]
+        # Comments made at the same moment are sorted by id
+        roots[3].timestamp = roots[2].timestamp
+        self.session.commit()
+
+        first_page = self.get_page()
+        self.assertEqual(self.get_roots(first_page), roots[:2])
+        self.assertFalse(first_page.has_prev)
+        self.assertIsNone(first_page.prev_cursor)
+
+        second_page = self.get_page(first_page.next_cursor)
+        self.assertEqual(self.get_roots(second_page), roots[2:4])
+
+        last_page = self.get_page(second_page.next_cursor)
+        self.assertEqual(self.get_roots(last_page), roots[4:])
+        self.assertIsNone(last_page.next_cursor)
+
+        self.assertEqual(self.get_roots(self.get_page(last_page.prev_cursor)), roots[2:4])
+        self.assertEqual(self.get_roots(self.get_page(second_page.prev_cursor)), roots[:2])
+
+    def test_replies_are_loaded_with_each_thread(self):
+        first = self.create_comment()
+        second = self.create_comment()
+        third = self.create_comment()
+        reply = self.create_comment(reply_to=first)
+        reply_to_third = self.create_comment(reply_to=third)
+        self.session.commit()
+
+        first_page = self.get_page()
+        self.assertEqual([node.comment for root in first_page.items for node in root], [first, reply, second])
+
+        last_page = self.get_page(first_page.next_cursor)
+        self.assertEqual([node.comment for root in last_page.items for node in root], [third, reply_to_third])
+
+    def test_hidden_threads_are_skipped(self):
+        first = self.create_comment()
+        hidden = self.create_comment(approved=False)
+        self.create_comment(reply_to=hidden)
+        second = self.create_comment()
+        self.session.commit()
+
+        pager = self.get_page()
+        self.assertEqual(self.get_roots(pager), [first, second])
+        self.assertIsNone(pager.next_cursor)
+
+    def test_invalid_cursor_loads_the_first_page(self):
+        roots = [self.create_comment() for i in range(3)]
+        self.session.commit()
+
+        self.assertEqual(self.get_roots(self.get_page('not-a-cursor')), roots[:2])
+
+
+if __name__ == '__main__':
+    unittest.main()
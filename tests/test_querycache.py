@@ -0,0 +1,130 @@
+"""
+Tests for the query cache in querycache.py.  These need a PostgreSQL database (see dbtest.py)
+"""
+
+import unittest
+
+import easycms
+from easycms import models, querycache, querystats
+from easycms.cache import MemoryCache
+from easycms.settings import get_settings
+
+from dbtest import DatabaseTestCase
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+
+class QueryCacheTest(DatabaseTestCase):
+    settings = {
+        'query_cache_timeout': 60
+    }
+
+    def setUp(self):
+        super().setUp()
+
+        # A new backend for each test, so that nothing is left over from the last one
+        get_settings().query_cache_backend = MemoryCache()
+        querycache.init(get_settings())
+
+    def tearDown(self):
+        get_settings().query_cache_backend = None
+        super().tearDown()
+
+    def get_post(self, code):
+        with querystats.track_queries() as stats:
+            post = easycms.get_post_by_code('post', code)
+
+        return post, stats.num_queries
+
+    def test_cached_post_is_merged_without_queries(self):
+        post = self.create_post(tags=[models.CmsTag('post', 'Tag')])
+        self.session.commit()
+        code = post.code
+        self.session.close()
+
+        cached_post, num_queries = self.get_post(code)
+        self.assertGreater(num_queries, 0)
+
+        self.session.close()
+        cached_post, num_queries = self.get_post(code)
+        self.assertEqual(num_queries, 0)
+        self.assertIn(cached_post, self.session)
+
+        # The relationships were cached with the post
+        with querystats.track_queries() as stats:
+            self.assertEqual(cached_post.code, code)
+            self.assertEqual([tag.name for tag in cached_post.tags], ['Tag'])
+            self.assertTrue(cached_post.category.name)
+            self.assertTrue(cached_post.author.name)
+
+        self.assertEqual(stats.num_queries, 0)
+
+    def test_unsaved_changes_are_not_overwritten(self):
+        post = self.create_post()
+        self.session.commit()
+
+        self.get_post(post.code)
+
+        post.title = 'Changed'
+        cached_post, num_queries = self.get_post(post.code)
+        self.assertIs(cached_post, post)
+        self.assertEqual(cached_post.title, 'Changed')
+
+    def test_saving_a_post_starts_a_new_generation(self):
+        post = self.create_post(title='Old title')
+        self.session.commit()
+
+        self.get_post(post.code)
+
+        post.title = 'New title'
+        self.session.commit()
+        code = post.code
+        self.session.close()
+
+        cached_post, num_queries = self.get_post(code)
+        self.assertGreater(num_queries, 0)
+        self.assertEqual(cached_post.title, 'New title')
+
+    def test_saving_a_category_starts_a_new_posts_generation(self):
+        post = self.create_post(category=self.create_category('Old name'))
+        self.session.commit()
+
+        self.get_post(post.code)
+
+        post.category.name = 'New name'
+        self.session.commit()
+        code = post.code
+        self.session.close()
+
+        cached_post, num_queries = self.get_post(code)
+        self.assertGreater(num_queries, 0)
+        self.assertEqual(cached_post.category.name, 'New name')
+
+    def test_missing_post_is_cached_until_one_is_saved(self):
+        self.assertEqual(self.get_post('new-post'), (None, 1))
+        self.assertEqual(self.get_post('new-post'), (None, 0))
+
+        post = self.create_post(title='New post')
+        self.session.commit()
+        self.assertEqual(post.code, 'new-post')
+        self.session.close()
+
+        cached_post, num_queries = self.get_post('new-post')
+        self.assertEqual(cached_post.id, post.id)
+
+    def test_disabled_cache_always_queries(self):
+        get_settings().query_cache_timeout = 0
+        querycache.init(get_settings())
+
+        post = self.create_post()
+        self.session.commit()
+
+        self.get_post(post.code)
+        self.session.close()
+
+        cached_post, num_queries = self.get_post(post.code)
+        self.assertGreater(num_queries, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
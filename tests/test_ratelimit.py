@@ -0,0 +1,148 @@
+"""
+Tests for the comment rate limits.  The comment form tests need a PostgreSQL database (see dbtest.py)
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from easycms import models, comments
+from easycms.cache import MemoryCache, FileSystemCache
+from easycms.ratelimit import RateLimit, MemoryRateLimitBackend, CacheRateLimitBackend
+
+from dbtest import DatabaseTestCase, VisitorAccessControl
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+
+class FakePost(object):
+    def __init__(self, post_id):
+        self.id = post_id
+
+
+# Two comments on the whole site, and one on each post
+LIMITS = [RateLimit(2, 600), RateLimit(1, 600, per_post=True)]
+
+
+class RateLimitBackendTests(object):
+    """
+    Tests for every backend that counts the attempts
+    """
+
+    def make_backend(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.backend = self.make_backend()
+
+    def check(self, post_id, ip_address='10.0.0.1'):
+        return self.backend.check(LIMITS, ip_address, FakePost(post_id), None)
+
+    def test_limits(self):
+        self.assertIsNone(self.check(1))
+        self.assertIs(self.check(1), LIMITS[1])
+        self.assertIsNone(self.check(2))
+        self.assertIs(self.check(3), LIMITS[0])
+
+    def test_ip_addresses_are_limited_separately(self):
+        self.assertIsNone(self.check(1))
+        self.assertIsNone(self.check(1, '10.0.0.2'))
+
+    def test_rejected_attempts_are_not_counted(self):
+        self.assertIsNone(self.check(1))
+
+        # Rejected by the per post limit, so they mustn't use up the site wide limit
+        for i in range(5):
+            self.assertIs(self.check(1), LIMITS[1])
+
+        self.assertIsNone(self.check(2))
+
+
+class MemoryRateLimitBackendTest(RateLimitBackendTests, unittest.TestCase):
+    def make_backend(self):
+        return MemoryRateLimitBackend()
+
+
+class MemoryCacheRateLimitBackendTest(RateLimitBackendTests, unittest.TestCase):
+    def make_backend(self):
+        return CacheRateLimitBackend(MemoryCache())
+
+
+class FileSystemCacheRateLimitBackendTest(RateLimitBackendTests, unittest.TestCase):
+    def make_backend(self):
+        self.cache_dir = tempfile.mkdtemp()
+        return CacheRateLimitBackend(FileSystemCache(self.cache_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+class CacheRateLimitBackendTest(unittest.TestCase):
+    def test_cache_without_inc_is_rejected(self):
+        class CacheWithoutInc(object):
+            def get_many(self, *keys):
+                return [None] * len(keys)
+
+            def add(self, key, value, timeout=None):
+                return True
+
+        with self.assertRaises(TypeError):
+            CacheRateLimitBackend(CacheWithoutInc())
+
+
+class CommentFormRateLimitTest(DatabaseTestCase):
+    access_control = VisitorAccessControl()
+    backend = MemoryRateLimitBackend()
+
+    # One comment every 10 minutes
+    settings = {
+        'comment_rate_limits': [RateLimit(1, 600)],
+        'comment_rate_limit_backend': backend
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.backend.clear()
+
+        self.post = self.create_post()
+        self.session.commit()
+
+    def submit_comment(self, content, nickname=''):
+        data = {
+            '--form-submitted--': 'yes',
+            'name': 'Commenter',
+            'nickname': nickname,
+            'email': 'commenter@example.com',
+            'content': content,
+            'reply-to': ''
+        }
+
+        with self.app.test_request_context('/', method='POST', data=data,
+                                           environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            comments.create_and_process_comment_form(self.post, session=self.session)
+
+    def count_comments(self):
+        return self.session.query(models.CmsComment).filter(models.CmsComment.post_id == self.post.id).count()
+
+    def test_spam_does_not_use_up_the_rate_limit(self):
+        self.submit_comment('Buy things', nickname='bot')
+        self.assertEqual(self.count_comments(), 0)
+
+        self.submit_comment('A real comment')
+        self.assertEqual(self.count_comments(), 1)
+
+    def test_duplicates_do_not_use_up_the_rate_limit(self):
+        self.submit_comment('A real comment')
+        self.backend.clear()
+
+        self.submit_comment('A real comment')
+        self.submit_comment('Another comment')
+        self.assertEqual(self.count_comments(), 2)
+
+        # Now the limit has been reached
+        self.submit_comment('A third comment')
+        self.assertEqual(self.count_comments(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Tests for the precomputed related posts in relatedposts.py.  These need a PostgreSQL database (see
+dbtest.py)
+"""
+
+import datetime
+import unittest
+
+import easycms
+from easycms import models, relatedposts
+from easycms.settings import get_settings
+
+from dbtest import DatabaseTestCase
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+
+class RelatedPostsTest(DatabaseTestCase):
+    settings = {
+        'related_posts_max': 10,
+        'related_posts_tag_weight': 1.0,
+        'related_posts_category_weight': 0.5,
+        'related_posts_decay_days': None
+    }
+
+    def setUp(self):
+        super().setUp()
+
+        self.tags = [models.CmsTag('post', 'Tag {}'.format(i)) for i in range(3)]
+        self.session.add_all(self.tags)
+
+    def get_stored_related_post_ids(self, post):
+        """
+        :return: Ids of the related posts stored for a post, most related first
+        """
+        return [row.related_post_id for row in self.session.query(
+            models.CmsRelatedPost
+        ).filter(
+            models.CmsRelatedPost.post_id == post.id
+        ).order_by(
+            models.CmsRelatedPost.score.desc(), models.CmsRelatedPost.related_post_id.desc()
+        )]
+
+    def test_related_posts_are_scored_by_shared_tags_and_category(self):
+        category = self.create_category()
+        post = self.create_post(category=category, tags=self.tags)
+        one_tag = self.create_post(tags=self.tags[:1])
+        one_tag_same_category = self.create_post(category=category, tags=self.tags[1:2])
+        two_tags = self.create_post(tags=self.tags[:2])
+        self.create_post(category=category)
+        self.session.commit()
+
+        relatedposts.rebuild_all_related_posts()
+        self.session.commit()
+
+        self.assertEqual(self.get_stored_related_post_ids(post), [two_tags.id, one_tag_same_category.id, one_tag.id])
+        self.assertEqual([p.id for p in easycms.get_related_posts(post, num_posts=2)],
+                         [two_tags.id, one_tag_same_category.id])
+
+    def test_rebuild_leaves_out_unpublished_posts(self):
+        post = self.create_post(tags=self.tags)
+        published = self.create_post(tags=self.tags)
+        draft = self.create_post(tags=self.tags, published=None)
+        self.session.commit()
+
+        relatedposts.rebuild_all_related_posts()
+        self.session.commit()
+
+        self.assertEqual(self.get_stored_related_post_ids(post), [published.id])
+        self.assertEqual(self.get_stored_related_post_ids(draft), [published.id, post.id])
+
+    def test_rebuild_keeps_the_best_related_posts(self):
+        get_settings().related_posts_max = 2
+
+        post = self.create_post(tags=self.tags)
+        best = self.create_post(tags=self.tags)
+        second = self.create_post(tags=self.tags[:2])
+        self.create_post(tags=self.tags[:1])
+        self.session.commit()
+
+        relatedposts.rebuild_all_related_posts()
+        self.session.commit()
+
+        self.assertEqual(self.get_stored_related_post_ids(post), [best.id, second.id])
+
+    def test_publishing_and_unpublishing_update_the_related_posts(self):
+        post = self.create_post(tags=self.tags)
+        other = self.create_post(tags=self.tags, published=None)
+        self.session.commit()
+        relatedposts.update_related_posts([post.id, other.id])
+        self.session.commit()
+
+        self.assertEqual(self.get_stored_related_post_ids(post), [])
+
+        other.published = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        relatedposts.update_related_posts_if_changed(other)
+        self.session.commit()
+        self.assertEqual(self.get_stored_related_post_ids(post), [other.id])
+
+        # Unpublished without loading the date first
+        self.session.expire(other)
+        other.published = None
+        relatedposts.update_related_posts_if_changed(other)
+        self.session.commit()
+        self.assertEqual(self.get_stored_related_post_ids(post), [])
+
+    def test_changing_tags_updates_the_related_posts(self):
+        post = self.create_post(tags=self.tags[:1])
+        other = self.create_post(tags=self.tags[1:])
+        self.session.commit()
+
+        other.tags.append(self.tags[0])
+        relatedposts.update_related_posts([other.id])
+        self.session.commit()
+        self.assertEqual(self.get_stored_related_post_ids(post), [other.id])
+
+        removed_tag_ids = [self.tags[0].id]
+        other.tags.remove(self.tags[0])
+        relatedposts.update_related_posts([other.id], tag_ids=removed_tag_ids)
+        self.session.commit()
+        self.assertEqual(self.get_stored_related_post_ids(post), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+Regression tests for the RSS feed.  These need a PostgreSQL database (see dbtest.py)
+"""
+
+import unittest
+
+from easycms import querystats, rssfeed
+
+from dbtest import DatabaseTestCase
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+# Number of posts in the larger feed
+NUM_POSTS = 10
+
+
+class RssFeedQueryCountTest(DatabaseTestCase):
+    def add_posts(self, num_posts):
+        # Each post has its own author and category, so loading them separately for each post would run
+        # more queries for the bigger feed
+        for i in range(num_posts):
+            self.create_post()
+
+        self.session.commit()
+
+    def generate_feed(self):
+        """
+        :return: (number of queries, number of items in the feed)
+        """
+        # Nothing can be left in the session, or loading the posts wouldn't need to run any queries
+        self.session.expire_all()
+
+        with self.app.test_request_context('/rss'):
+            with querystats.track_queries() as stats:
+                xml = rssfeed.generate_rss_xml(page=1)
+
+        return stats.num_queries, xml.count('<item>')
+
+    def test_query_count_does_not_depend_on_number_of_posts(self):
+        self.add_posts(1)
+        num_queries, num_items = self.generate_feed()
+
+        self.add_posts(NUM_POSTS - 1)
+        num_queries_many, num_items_many = self.generate_feed()
+
+        self.assertEqual(num_items, 1)
+        self.assertEqual(num_items_many, NUM_POSTS)
+        self.assertEqual(num_queries_many, num_queries)
+
+
+if __name__ == '__main__':
+    unittest.main()
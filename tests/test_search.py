@@ -0,0 +1,117 @@
+"""
+Tests for the full text search of posts in search.py.  These need a PostgreSQL database (see dbtest.py)
+"""
+
+import unittest
+
+import easycms
+
+from dbtest import DatabaseTestCase
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+
+class SearchTest(DatabaseTestCase):
+    def search(self, search_terms, **kwargs):
+        return easycms.search_posts_query(search_terms, **kwargs).all()
+
+    def search_pages(self, search_terms, num_per_page):
+        """
+        :return: List of the search results on each page, following the next cursors
+        """
+        pages = []
+        cursor = None
+
+        while True:
+            pager = easycms.search_posts_keyset_pager(search_terms, cursor, num_per_page=num_per_page)
+            pages.append(pager.items)
+
+            cursor = pager.next_cursor
+            if cursor is None:
+                return pages
+
+    def test_title_matches_rank_above_tagline_and_content(self):
+        in_content = self.create_post(title='First', content='<p>We went out in a kayak</p>')
+        in_title = self.create_post(title='Kayak trips', content='<p>Boats</p>')
+        in_tagline = self.create_post(title='Third', tagline='All about kayaks', content='<p>Boats</p>')
+        self.create_post(title='Canoe trips', content='<p>Boats</p>')
+        self.session.commit()
+
+        self.assertEqual(self.search('kayak'), [in_title, in_tagline, in_content])
+
+    def test_search_syntax(self):
+        river = self.create_post(title='River kayaking', content='<p>White water</p>')
+        sea = self.create_post(title='Sea kayaking', content='<p>Calm water</p>')
+        self.session.commit()
+
+        self.assertEqual(self.search('kayaking -river'), [sea])
+        self.assertEqual(self.search('"white water"'), [river])
+        self.assertEqual(set(self.search('river OR sea')), {river, sea})
+        self.assertEqual(self.search('  '), [])
+
+    def test_unpublished_posts_are_left_out(self):
+        published = self.create_post(title='Published kayak')
+        draft = self.create_post(title='Draft kayak', published=None)
+        self.session.commit()
+
+        self.assertEqual(self.search('kayak'), [published])
+        self.assertEqual(set(self.search('kayak', allow_unpublished=True)), {published, draft})
+
+    def test_search_vector_is_updated_when_the_post_is_saved(self):
+        post = self.create_post(title='Canoe')
+        self.session.commit()
+
+        post.title = 'Kayak'
+        self.session.commit()
+
+        self.assertEqual(self.search('kayak'), [post])
+        self.assertEqual(self.search('canoe'), [])
+
+    def test_accented_words_match(self):
+        post = self.create_post(title='Café crème', content='<p>A café on the river</p>')
+        self.session.commit()
+
+        self.assertEqual(self.search('cafe'), [post])
+        self.assertEqual(self.search('café'), [post])
+
+    def test_pager_follows_rank(self):
+        posts = [
+            self.create_post(title='Kayak', content='<p>kayak</p>'),
+            self.create_post(title='Kayak trips'),
+            self.create_post(tagline='Kayak'),
+            self.create_post(content='<p>kayak</p>')
+        ]
+        self.create_post(title='Canoe')
+        self.session.commit()
+
+        with self.app.test_request_context('/'):
+            pages = self.search_pages('kayak', num_per_page=3)
+
+        self.assertEqual([[result.post for result in page] for page in pages], [posts[:3], posts[3:]])
+
+        ranks = [result.rank for page in pages for result in page]
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+    def test_headlines_highlight_the_search_terms(self):
+        post = self.create_post(content='<p>We took the <b>kayak</b> to the café &lt;script&gt;</p>')
+        self.session.commit()
+
+        with self.app.test_request_context('/'):
+            pager = easycms.search_posts_keyset_pager('kayak cafe', num_per_page=10)
+
+        [result] = pager.items
+        self.assertEqual(result.post, post)
+        self.assertIn('<mark>kayak</mark>', result.headline)
+        self.assertIn('<mark>cafe</mark>', result.headline)
+        # Only the highlighting is html
+        self.assertNotIn('<b>', result.headline)
+        self.assertNotIn('<script', result.headline)
+
+        with self.app.test_request_context('/'):
+            pager = easycms.search_posts_keyset_pager('kayak', num_per_page=10, highlight=False)
+
+        self.assertIsNone(pager.items[0].headline)
+
+
+if __name__ == '__main__':
+    unittest.main()
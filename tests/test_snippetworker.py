@@ -0,0 +1,137 @@
+"""
+Tests for the background image jobs in snippetworker.py.  These need a PostgreSQL database (see dbtest.py).
+Downloading the images is replaced with a generated image
+"""
+
+import io
+import os
+import threading
+import time
+import unittest
+
+import PIL.Image
+
+from easycms import models, cmsutil, snippetworker
+from easycms.settings import get_settings
+
+from dbtest import DatabaseTestCase
+
+__author__ = 'Stephen Brown (Little Fish Solutions LTD)'
+
+# Seconds to wait for a job to finish
+JOB_TIMEOUT = 10
+
+IMAGE_WIDTH = 400
+IMAGE_HEIGHT = 300
+
+
+def make_image_data():
+    buffer = io.BytesIO()
+    PIL.Image.new('RGB', (IMAGE_WIDTH, IMAGE_HEIGHT), (200, 100, 50)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class SnippetWorkerTest(DatabaseTestCase):
+    settings = {
+        'snippet_image_workers': 1,
+        'main_image_widths': [100, 200]
+    }
+
+    def setUp(self):
+        super().setUp()
+
+        os.makedirs(get_settings().main_image_variant_file_path, exist_ok=True)
+
+        # The jobs wait for this before "downloading" the image, so that the tests can change the post first
+        self.download_allowed = threading.Event()
+        self.download_allowed.set()
+
+        image_data = make_image_data()
+
+        def download_image_data(full_image_url, timeout=None):
+            self.download_allowed.wait(JOB_TIMEOUT)
+            return image_data
+
+        self._download_image_data = cmsutil.download_image_data
+        cmsutil.download_image_data = download_image_data
+
+    def tearDown(self):
+        cmsutil.download_image_data = self._download_image_data
+        super().tearDown()
+
+    def wait_for(self, job):
+        end = time.monotonic() + JOB_TIMEOUT
+        while not job.finished and time.monotonic() < end:
+            time.sleep(0.05)
+
+        self.assertEqual(job.status, snippetworker.DONE, job.error)
+
+    def load_post(self, post_id):
+        self.session.expire_all()
+        return self.session.query(models.CmsPost).filter(models.CmsPost.id == post_id).one()
+
+    def test_main_image_variants_are_stored_on_the_post(self):
+        post = self.create_post()
+        post.main_image_url = 'http://example.com/images/main.png'
+        self.session.commit()
+
+        with self.app.test_request_context('/'):
+            job = snippetworker.add_main_image_variants(post)
+            self.wait_for(job)
+
+        post = self.load_post(post.id)
+        self.assertTrue(post.has_current_main_image_variants())
+        self.assertEqual(post.main_image_variants['width'], IMAGE_WIDTH)
+        self.assertEqual({variant['width'] for variant in post.main_image_variants['variants']}, {100, 200})
+        self.assertTrue(post.get_main_image_srcset().endswith('{} {}w'.format(post.main_image_url, IMAGE_WIDTH)))
+
+    def test_main_image_variants_are_dropped_if_the_image_changes(self):
+        post = self.create_post()
+        post.main_image_url = 'http://example.com/images/old.png'
+        self.session.commit()
+
+        self.download_allowed.clear()
+        with self.app.test_request_context('/'):
+            job = snippetworker.add_main_image_variants(post)
+
+            post.main_image_url = 'http://example.com/images/new.png'
+            self.session.commit()
+            self.download_allowed.set()
+
+            self.wait_for(job)
+
+        post = self.load_post(post.id)
+        self.assertIsNone(post.main_image_variants)
+
+    def test_snippet_image_is_set_from_content(self):
+        post = self.create_post(content='<p>Text</p><img src="http://example.com/images/content.png">')
+        self.session.commit()
+
+        with self.app.test_request_context('/'):
+            job = snippetworker.add_default_snippet(post)
+            self.wait_for(job)
+
+        post = self.load_post(post.id)
+        self.assertEqual(post.snippet_image, job.snippet_image)
+        self.assertTrue(post.get_snippet_image_sources())
+
+    def test_snippet_image_is_not_replaced(self):
+        post = self.create_post(content='<p>Text</p><img src="http://example.com/images/content.png">')
+        self.session.commit()
+
+        self.download_allowed.clear()
+        with self.app.test_request_context('/'):
+            job = snippetworker.add_default_snippet(post)
+
+            post.snippet_image = 'http://example.com/images/chosen.png'
+            self.session.commit()
+            self.download_allowed.set()
+
+            self.wait_for(job)
+
+        post = self.load_post(post.id)
+        self.assertEqual(post.snippet_image, 'http://example.com/images/chosen.png')
+
+
+if __name__ == '__main__':
+    unittest.main()